@@ -0,0 +1,58 @@
+'''
+CPU time of a request's handler, with and without the token being
+verified once up front by the request's auth context.
+
+Run from project-backend with:
+    python -m benchmarks.auth_benchmark [num_requests]
+'''
+import os
+import sys
+import tempfile
+from time import process_time
+
+import src.helper as helper
+from src import config
+from src.auth import auth_register_v1
+from src.channels import channels_create_v1
+from src.message import message_send_v1, message_edit_v1, message_remove_v1
+from src.other import clear_v1
+
+NUM_REQUESTS = 20_000
+
+def request(token: str, channel_id: int):
+    '''
+    The handlers of a message/send, message/edit and message/remove request,
+    leaving the channel as it was
+    '''
+    message_id = message_send_v1(token, channel_id, 'hello', True)
+    message_edit_v1(token, message_id, 'hello again')
+    message_remove_v1(token, message_id)
+
+def run(num_requests: int) -> dict:
+    '''
+    Seconds of CPU per request (averaged over the three handlers), with the
+    auth context off and on
+    '''
+    clear_v1()
+    token = auth_register_v1('apple@com.au', 'password1', 'Steve', 'Jobs')['token']
+    channel_id = channels_create_v1(token, 'channel1', True)
+    results = {}
+    for context in (False, True):
+        start = process_time()
+        for _ in range(num_requests):
+            reset = helper.begin_request(token) if context else None
+            request(token, channel_id)
+            helper.end_request(reset)
+        results[context] = (process_time() - start) / num_requests / 3
+    return results
+
+def main(num_requests: int):
+    config.journal = False
+    os.chdir(tempfile.mkdtemp())
+    results = run(num_requests)
+    print(f'{"auth context":>12} {"CPU per request (us)":>22}')
+    for context, seconds in results.items():
+        print(f'{"on" if context else "off":>12} {seconds * 1e6:>22.1f}')
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else NUM_REQUESTS)
@@ -0,0 +1,51 @@
+'''
+Dump and load throughput of the persisted database, with the standard
+library's json and (when installed) orjson.
+
+Run from project-backend with:
+    python -m benchmarks.codec_benchmark [dataset_mb]
+'''
+import sys
+from time import perf_counter
+
+import src.data as db
+import src.schema as schema
+from benchmarks.dataset import build
+
+DATASET_MB = 500
+# Size of one encoded benchmark message, to size the dataset up front
+MESSAGE_BYTES = 230
+
+def run(codec, num_messages: int) -> tuple:
+    '''
+    Returns the encoded size in MB and the dump and load throughput in MB/s
+    of a database of num_messages messages encoded with codec
+    '''
+    schema.orjson = codec
+    build(num_messages)
+    start = perf_counter()
+    texts = {name: schema.dumps(collection) for name, collection in db.COLLECTIONS.items()}
+    dumped = perf_counter() - start
+    size = sum(len(text) for text in texts.values()) / 2 ** 20
+
+    # Drop the built database first, so only one copy is ever in memory
+    for collection in db.COLLECTIONS.values():
+        collection.clear()
+    start = perf_counter()
+    for name, text in texts.items():
+        db.COLLECTIONS[name].update(schema.load_collection(name, schema.loads(text)))
+    loaded = perf_counter() - start
+    return size, size / dumped, size / loaded
+
+def main(dataset_mb: float):
+    codecs = {'json': None}
+    if schema.orjson is not None:
+        codecs['orjson'] = schema.orjson
+    num_messages = int(dataset_mb * 2 ** 20 / MESSAGE_BYTES)
+    print(f'{"codec":>8} {"size (MB)":>10} {"dump (MB/s)":>12} {"load (MB/s)":>12}')
+    for name, codec in codecs.items():
+        size, dump, load = run(codec, num_messages)
+        print(f'{name:>8} {size:>10.1f} {dump:>12.1f} {load:>12.1f}')
+
+if __name__ == '__main__':
+    main(float(sys.argv[1]) if len(sys.argv) > 1 else DATASET_MB)
@@ -0,0 +1,58 @@
+'''
+Size and throughput of uncompressed, gzip and zstd JSON snapshots.
+
+Run from project-backend with:
+    python -m benchmarks.compression_benchmark [num_messages ...]
+
+Throughput is in MB/s of uncompressed JSON, so the three are comparable.
+'''
+import os
+import sys
+import tempfile
+from time import perf_counter
+
+import src.data as db
+import src.compressed as compressed
+from src import config
+from src.schema import dumps
+from benchmarks.dataset import build
+
+SIZES = [10_000, 100_000, 1_000_000]
+COMPRESSIONS = [None, 'gzip'] + (['zstd'] if compressed.zstandard else [])
+
+def run(num_messages: int) -> dict:
+    '''
+    Saves and reloads a database of num_messages messages with every
+    snapshot compression, returning compression -> (bytes on disk,
+    compression ratio, save MB/s, load MB/s)
+    '''
+    build(num_messages)
+    raw = sum(len(dumps(collection).encode()) for collection in db.COLLECTIONS.values())
+    results = {}
+    for compression in COMPRESSIONS:
+        config.snapshot_compression = compression
+        start = perf_counter()
+        db.save_db()
+        saved = perf_counter()
+        for collection in db.COLLECTIONS.values():
+            collection.clear()
+        db.load_db()
+        loaded = perf_counter()
+        size = sum(os.path.getsize(db.snapshot_file(name)) for name in db.COLLECTIONS)
+        results[compression or 'none'] = (size, raw / size,
+            raw / 1e6 / (saved - start), raw / 1e6 / (loaded - saved))
+    return results
+
+def main(sizes: list):
+    config.journal = False
+    config.snapshot_format = 'json'
+    os.chdir(tempfile.mkdtemp())
+    print(f'{"messages":>10} {"compression":>12} {"size (MB)":>10} {"ratio":>7} '
+        f'{"save MB/s":>10} {"load MB/s":>10}')
+    for num_messages in sizes:
+        for compression, (size, ratio, save, load) in run(num_messages).items():
+            print(f'{num_messages:>10} {compression:>12} {size / 1e6:>10.1f} {ratio:>7.2f} '
+                f'{save:>10.1f} {load:>10.1f}')
+
+if __name__ == '__main__':
+    main([int(size) for size in sys.argv[1:]] or SIZES)
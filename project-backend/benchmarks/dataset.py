@@ -0,0 +1,52 @@
+'''
+Builds synthetic Dreams databases for the benchmarks
+'''
+from datetime import datetime
+
+import src.data as db
+from src.auth import auth_register_v1
+from src.channels import channels_create_v1
+from src.dm import dm_create_v1
+from src.other import clear_v1
+
+def build(num_messages: int, num_users: int = 100, num_containers: int = 100) -> dict:
+    '''
+    Fills the database with num_users users, num_containers channels and as
+    many dms, and num_messages messages spread evenly across them. Returns
+    the first user and the ids of the channels and dms.
+    '''
+    clear_v1()
+    users = [auth_register_v1(f'user{i}@bench.com', 'password', 'Bench', f'User{i}') \
+        for i in range(num_users)]
+    token = users[0]['token']
+    channel_ids = [channels_create_v1(token, f'channel{i}', True) for i in range(num_containers)]
+    dm_ids = [dm_create_v1(token, [users[(i % (num_users - 1)) + 1]['auth_user_id']])['dm_id'] \
+        for i in range(num_containers)]
+    containers = [db.channels[channel_id] for channel_id in channel_ids] + \
+        [db.dms[dm_id] for dm_id in dm_ids]
+    ids = channel_ids + dm_ids
+    now = int(datetime.now().timestamp())
+    for message_id in range(1, num_messages + 1):
+        container = message_id % len(containers)
+        containers[container]['messages'].append({
+            'message_id': message_id,
+            'dest_id': ids[container],
+            'u_id': users[message_id % num_users]['auth_user_id'],
+            'message': f'benchmark message number {message_id}',
+            'time_created': now,
+            'reacts': [{
+                'react_id': 1,
+                'u_ids': [],
+                'is_this_user_reacted': False,
+            }],
+            'is_pinned': False,
+        })
+    # Built in place, so indexed and persisted from scratch
+    db.rebuild_indexes()
+    db.mark_cleared()
+    db.collect_changes()
+    return {
+        'user': users[0],
+        'channel_ids': channel_ids,
+        'dm_ids': dm_ids,
+    }
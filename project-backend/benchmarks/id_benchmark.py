@@ -0,0 +1,58 @@
+'''
+Multithreaded stress test of the snowflake id generator: several threads
+make ids as fast as they can (or at a target rate), and every id is checked
+to be unique and each thread's ids to be strictly increasing.
+
+Run from project-backend with:
+    python -m benchmarks.id_benchmark [num_threads] [num_ids] [target_rate]
+'''
+import sys
+import threading
+from time import perf_counter, sleep
+
+import src.snowflake as snowflake
+
+THREADS = 8
+IDS = 1_000_000
+RATE = 100_000
+
+def make_ids(count: int, rate: float, ids: list):
+    '''
+    Makes count ids at up to rate ids per second (no limit if 0)
+    '''
+    start = perf_counter()
+    for i in range(count):
+        if rate and i % 100 == 0:
+            ahead = start + i / rate - perf_counter()
+            if ahead > 0:
+                sleep(ahead)
+        ids.append(snowflake.next_id())
+
+def run(num_threads: int, num_ids: int, rate: float) -> dict:
+    made = [[] for _ in range(num_threads)]
+    threads = [threading.Thread(target=make_ids, args=[num_ids // num_threads, \
+        rate / num_threads, ids]) for ids in made]
+    start = perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = perf_counter() - start
+    total = sum(len(ids) for ids in made)
+    return {
+        'ids': total,
+        'ids/s': total / elapsed,
+        'collisions': total - len({snowflake_id for ids in made for snowflake_id in ids}),
+        'out of order': sum(earlier >= later for ids in made for earlier, later in zip(ids, ids[1:])),
+    }
+
+def main(num_threads: int, num_ids: int, rate: int):
+    print(f'{"target/s":>10} {"ids":>10} {"ids/s":>12} {"collisions":>11} {"out of order":>13}')
+    for target in (rate, 0):
+        results = run(num_threads, num_ids, target)
+        print(f'{target or "max":>10} {results["ids"]:>10} {results["ids/s"]:>12.0f} '
+            f'{results["collisions"]:>11} {results["out of order"]:>13}')
+
+if __name__ == '__main__':
+    args = [int(arg) for arg in sys.argv[1:]]
+    main(*(args + [THREADS, IDS, RATE][len(args):]))
@@ -0,0 +1,80 @@
+'''
+Latency of auth/login at growing numbers of users, against the full scan
+of the users that used to find the email.
+
+Run from project-backend with:
+    python -m benchmarks.login_benchmark [num_users ...]
+'''
+import os
+import sys
+import random
+import tempfile
+from time import perf_counter
+
+import src.data as db
+import src.passwords as passwords
+from src import config
+from src.auth import auth_login_v1
+from src.other import clear_v1
+
+SIZES = [1_000, 100_000, 1_000_000]
+LOGINS = 1_000
+PASSWORD = 'password'
+
+def build_users(num_users: int):
+    '''
+    Fills the users collection directly, as registering a million users
+    through auth_register_v1 would take far longer than the benchmark
+    '''
+    clear_v1()
+    password = passwords.make_hash(PASSWORD, *passwords.current_cost())
+    for u_id in range(1, num_users + 1):
+        db.users[u_id] = {
+            'session_id': [],
+            'permission_id': 2,
+            'email': f'user{u_id}@bench.com',
+            'password': password,
+            'name_first': 'Bench',
+            'name_last': f'User{u_id}',
+            'handle_str': f'benchuser{u_id}',
+            'notifications': [],
+            'profile_img_url': '',
+            'reset_code': [],
+        }
+    db.rebuild_indexes()
+
+def scan(email: str):
+    for u_id, user in db.users.items():
+        if user['email'] == email:
+            return u_id
+    return None
+
+def run(num_users: int) -> tuple:
+    '''
+    Mean seconds per login, and per full scan for the same email
+    '''
+    build_users(num_users)
+    emails = [f'user{random.randint(1, num_users)}@bench.com' for _ in range(LOGINS)]
+    start = perf_counter()
+    for email in emails:
+        auth_login_v1(email, PASSWORD)
+    logged_in = perf_counter()
+    for email in emails[:max(1, LOGINS * 1000 // num_users)]:
+        scan(email)
+    scanned = perf_counter()
+    db.collect_changes()
+    return (logged_in - start) / LOGINS, \
+        (scanned - logged_in) / max(1, LOGINS * 1000 // num_users)
+
+def main(sizes: list):
+    config.journal = False
+    # The KDF is measured by password_benchmark; here it would drown out the lookup
+    config.pbkdf2_iterations = 1
+    os.chdir(tempfile.mkdtemp())
+    print(f'{"users":>10} {"login (us)":>12} {"full scan (us)":>16}')
+    for num_users in sizes:
+        login, full_scan = run(num_users)
+        print(f'{num_users:>10} {login * 1e6:>12.1f} {full_scan * 1e6:>16.1f}')
+
+if __name__ == '__main__':
+    main([int(size) for size in sys.argv[1:]] or SIZES)
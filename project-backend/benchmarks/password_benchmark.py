@@ -0,0 +1,94 @@
+'''
+Login throughput and latency with each password KDF, with logins made
+concurrently through the server, and the latency of a read route served
+alongside them.
+
+Run from project-backend with:
+    python -m benchmarks.password_benchmark [num_clients] [logins_per_client]
+'''
+import os
+import sys
+import tempfile
+import threading
+from time import perf_counter
+
+import src.data as db
+import src.server as server
+from src import config
+from src.auth import auth_register_v1
+from src.other import clear_v1
+
+KDFS = ['pbkdf2', 'scrypt']
+CLIENTS = 8
+LOGINS = 25
+
+def percentile(samples: list, fraction: float) -> float:
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+def run(num_clients: int, logins: int) -> dict:
+    '''
+    Logins per second, and the median and 99th percentile latencies of the
+    logins and of the read requests made meanwhile
+    '''
+    clear_v1()
+    token = None
+    for i in range(num_clients):
+        token = auth_register_v1(f'user{i}@bench.com', 'password', 'Bench', f'User{i}')['token']
+    login_times = []
+    read_times = []
+    done = threading.Event()
+
+    def login(client_id: int):
+        client = server.APP.test_client()
+        for _ in range(logins):
+            start = perf_counter()
+            response = client.post('/auth/login/v2', json={
+                'email': f'user{client_id}@bench.com',
+                'password': 'password',
+            })
+            login_times.append(perf_counter() - start)
+            assert response.status_code == 200
+
+    def read():
+        client = server.APP.test_client()
+        while not done.is_set():
+            start = perf_counter()
+            client.get('/channels/listall/v2', query_string={'token': token})
+            read_times.append(perf_counter() - start)
+
+    clients = [threading.Thread(target=login, args=[i]) for i in range(num_clients)]
+    reader = threading.Thread(target=read)
+    start = perf_counter()
+    reader.start()
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    elapsed = perf_counter() - start
+    done.set()
+    reader.join()
+    return {
+        'logins/s': num_clients * logins / elapsed,
+        'login p50 (ms)': percentile(login_times, 0.5) * 1e3,
+        'login p99 (ms)': percentile(login_times, 0.99) * 1e3,
+        'read p50 (ms)': percentile(read_times, 0.5) * 1e3,
+        'read p99 (ms)': percentile(read_times, 0.99) * 1e3,
+    }
+
+def main(num_clients: int, logins: int):
+    config.durability = 'async'
+    os.chdir(tempfile.mkdtemp())
+    columns = None
+    for kdf in KDFS:
+        config.password_kdf = kdf
+        results = run(num_clients, logins)
+        if columns is None:
+            columns = list(results)
+            print(f'{"kdf":>8} ' + ' '.join(f'{column:>15}' for column in columns))
+        print(f'{kdf:>8} ' + ' '.join(f'{results[column]:>15.1f}' for column in columns))
+    db.stop_flusher()
+
+if __name__ == '__main__':
+    args = [int(arg) for arg in sys.argv[1:]]
+    main(*(args + [CLIENTS, LOGINS][len(args):]))
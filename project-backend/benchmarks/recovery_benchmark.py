@@ -0,0 +1,70 @@
+'''
+Restart time after a crash under write load, with and without background
+journal compaction.
+
+Run from project-backend with:
+    python -m benchmarks.recovery_benchmark [num_messages] [num_writes]
+'''
+import os
+import sys
+import tempfile
+from time import perf_counter
+
+import src.data as db
+from src import config
+from src.message import message_send_v1
+from benchmarks.dataset import build
+
+NUM_MESSAGES = 100_000
+NUM_WRITES = 20_000
+
+def percentile(samples: list, fraction: float) -> float:
+    return sorted(samples)[int(len(samples) * fraction)]
+
+def run(num_messages: int, num_writes: int, compact_records: float) -> dict:
+    '''
+    Sends num_writes messages, one commit each, on top of a snapshot of
+    num_messages messages, then "crashes" and times the restart
+    '''
+    os.chdir(tempfile.mkdtemp())
+    config.journal_compact_records = compact_records
+    dataset = build(num_messages)
+    db.save_db()
+    token = dataset['user']['token']
+    latencies = []
+    for write in range(num_writes):
+        channel_id = dataset['channel_ids'][write % len(dataset['channel_ids'])]
+        start = perf_counter()
+        with db.lock:
+            message_send_v1(token, channel_id, f'write number {write}', True)
+            db.commit()
+        latencies.append(perf_counter() - start)
+    db.join_compaction()
+
+    # Crash: drop everything in memory without any further writes
+    for collection in db.COLLECTIONS.values():
+        collection.clear()
+    start = perf_counter()
+    db.load_db()
+    recovery = perf_counter() - start
+    return {
+        'p50': percentile(latencies, 0.5),
+        'p99': percentile(latencies, 0.99),
+        'max': max(latencies),
+        'replayed': db.journal_records,
+        'recovery': recovery,
+    }
+
+def main(num_messages: int, num_writes: int):
+    config.durability = 'sync'
+    config.snapshot_format = 'binary'
+    print(f'{"compaction":>12} {"commit p50 (ms)":>16} {"p99 (ms)":>9} {"max (ms)":>9} '
+          f'{"replayed":>9} {"recovery (s)":>13}')
+    for name, compact_records in (('never', float('inf')), ('every 2000', 2000)):
+        result = run(num_messages, num_writes, compact_records)
+        print(f'{name:>12} {result["p50"] * 1000:>16.2f} {result["p99"] * 1000:>9.2f} '
+              f'{result["max"] * 1000:>9.2f} {result["replayed"]:>9} {result["recovery"]:>13.3f}')
+
+if __name__ == '__main__':
+    args = [int(arg) for arg in sys.argv[1:]]
+    main(*(args + [NUM_MESSAGES, NUM_WRITES][len(args):]))
@@ -0,0 +1,59 @@
+'''
+Latency of message/send against the length of the channel's history: for
+each history size, a channel holding that many messages is sent messages
+one at a time, each committed as its request would be.
+
+Run from project-backend with:
+    python -m benchmarks.send_benchmark [num_sends] [history_size ...]
+'''
+import os
+import sys
+import tempfile
+from time import perf_counter
+
+import src.data as db
+from src import config
+from src.message import message_send_v1
+from benchmarks.dataset import build
+
+NUM_SENDS = 2_000
+HISTORY_SIZES = (1_000, 10_000, 100_000, 1_000_000)
+
+def percentile(samples: list, fraction: float) -> float:
+    return sorted(samples)[int(len(samples) * fraction)]
+
+def run(num_sends: int, history_size: int) -> dict:
+    '''
+    Seconds per send to a channel with history_size messages
+    '''
+    os.chdir(tempfile.mkdtemp())
+    # All of the history in one channel (the other container is a dm)
+    dataset = build(history_size * 2, num_users=2, num_containers=1)
+    token = dataset['user']['token']
+    channel_id = dataset['channel_ids'][0]
+    latencies = []
+    for send in range(num_sends):
+        start = perf_counter()
+        with db.lock:
+            message_send_v1(token, channel_id, f'send number {send}', True)
+            db.commit()
+        latencies.append(perf_counter() - start)
+    return {
+        'history': len(db.channels[channel_id]['messages']) - num_sends,
+        'mean': sum(latencies) / len(latencies),
+        'p50': percentile(latencies, 0.5),
+        'p99': percentile(latencies, 0.99),
+    }
+
+def main(num_sends: int, history_sizes: tuple):
+    config.journal = True
+    config.durability = 'sync'
+    print(f'{"history":>10} {"mean (us)":>10} {"p50 (us)":>10} {"p99 (us)":>10}')
+    for history_size in history_sizes:
+        results = run(num_sends, history_size)
+        print(f'{results["history"]:>10} {results["mean"] * 1e6:>10.1f} '
+            f'{results["p50"] * 1e6:>10.1f} {results["p99"] * 1e6:>10.1f}')
+
+if __name__ == '__main__':
+    args = [int(arg) for arg in sys.argv[1:]]
+    main(args[0] if args else NUM_SENDS, tuple(args[1:]) or HISTORY_SIZES)
@@ -0,0 +1,50 @@
+'''
+Startup time of the JSON, binary and sharded snapshot formats.
+
+Run from project-backend with:
+    python -m benchmarks.startup_benchmark [num_messages ...]
+'''
+import os
+import sys
+import tempfile
+from time import perf_counter
+
+import src.data as db
+from src import config
+from src.channel import channel_messages_v1
+from benchmarks.dataset import build
+
+SIZES = [10_000, 100_000, 1_000_000]
+FORMATS = ['json', 'binary', 'sharded']
+
+def run(num_messages: int) -> dict:
+    '''
+    Times loading a database of num_messages messages in every snapshot
+    format, and the first channel/messages request served after it
+    '''
+    dataset = build(num_messages)
+    results = {}
+    for snapshot_format in FORMATS:
+        config.snapshot_format = snapshot_format
+        db.stale_shards = None
+        db.save_db()
+        for collection in db.COLLECTIONS.values():
+            collection.clear()
+        start = perf_counter()
+        db.load_db()
+        loaded = perf_counter()
+        channel_messages_v1(dataset['user']['token'], dataset['channel_ids'][0], 0)
+        served = perf_counter()
+        results[snapshot_format] = (loaded - start, served - start)
+    return results
+
+def main(sizes: list):
+    config.journal = False
+    os.chdir(tempfile.mkdtemp())
+    print(f'{"messages":>10} {"format":>8} {"load (s)":>10} {"first request (s)":>18}')
+    for num_messages in sizes:
+        for snapshot_format, (load, first) in run(num_messages).items():
+            print(f'{num_messages:>10} {snapshot_format:>8} {load:>10.3f} {first:>18.3f}')
+
+if __name__ == '__main__':
+    main([int(size) for size in sys.argv[1:]] or SIZES)
@@ -1,6 +1,6 @@
 import jwt
 from src.error import InputError, AccessError
-from src.data import users, channels
+from src.data import users, channels, mark_dirty
 import src.helper as helper
 import typing
 
@@ -53,11 +53,15 @@ def admin_user_remove_v1(token: str, u_id: int) -> dict:
     users[u_id]['name_first'] = 'Removed'
     users[u_id]['name_last'] = 'user'
     users[u_id]['permission_id'] = 0
+    mark_dirty('users', u_id)
+    #Removed users are logged out of every session
+    helper.remove_all_sessions(u_id)
     #the contents of the messages they sent will be replaced by 'Removed user'
-    for c in channels:
-        for m in range(len(channels[c]['messages'])):
-            if channels[c]['messages'][m]['u_id'] == u_id:
-                channels[c]['messages'][m]['message'] = 'Removed user'
+    for c, channel in channels.items():
+        for m in range(len(channel['messages'])):
+            if channel['messages'][m]['u_id'] == u_id:
+                channel['messages'][m]['message'] = 'Removed user'
+                mark_dirty('channels', c, channel['messages'][m]['message_id'])
 
     return {}
 
@@ -99,6 +103,7 @@ def admin_userpermission_change_v1(token: str, u_id: int, permission_id: int) ->
 
     #Change permission id
     users[u_id]['permission_id'] = permission_id
+    mark_dirty('users', u_id)
     
     return {}
 
@@ -106,8 +111,8 @@ def admin_userpermission_change_v1(token: str, u_id: int, permission_id: int) ->
 
 def is_only_owner() -> bool:
     owner_num = 0
-    for user in users:
-        if users[user]['permission_id'] == OWNER:
+    for user in users.values():
+        if user['permission_id'] == OWNER:
             owner_num += 1
     if owner_num == 1:
         return True
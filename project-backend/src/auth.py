@@ -2,13 +2,13 @@ import re
 import jwt
 import json
 import uuid
-import hashlib
 import src.helper as helper
-import random
-import smtplib
+from src import passwords
+from src import mail
+from src import config
 from typing import Optional, Union
 from src.error import InputError
-from src.data import users
+from src.data import users, mark_dirty, unlocked
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 #secret for token
@@ -42,12 +42,7 @@ def auth_register_v1(email: str, password: str, name_first: str, name_last: str)
         raise InputError(description='Invalid email')
         
     #Email address is already being used by another
-    email_exists = False 
-    if len(users) > 0:
-        for user in users: 
-            if users[user]['email'] == email:
-                email_exists = True
-    if email_exists is True:
+    if email_search(email) is not None:
         raise InputError(description='Email address is already being used by another')
 
     #Password entered is less than 6 characters long
@@ -62,6 +57,13 @@ def auth_register_v1(email: str, password: str, name_first: str, name_last: str)
     if not (1 <= len(name_last) <= 50):        
         raise InputError(description='Last name is too short or too long')
 
+    #hash the password, letting other requests run meanwhile
+    password_hash = password_encode(password)
+
+    #the email may have been taken while the password was hashed
+    if email_search(email) is not None:
+        raise InputError(description='Email address is already being used by another')
+
     #generate a handle
     handle = make_handle(name_first, name_last)
 
@@ -72,7 +74,7 @@ def auth_register_v1(email: str, password: str, name_first: str, name_last: str)
         'session_id': [],
         'permission_id': 2,
         'email' : email,
-        'password' : hashlib.sha256(password.encode()).hexdigest(),
+        'password' : password_hash,
         'name_first' : name_first,
         'name_last' : name_last,
         'handle_str': handle,
@@ -84,10 +86,12 @@ def auth_register_v1(email: str, password: str, name_first: str, name_last: str)
        
     if u_id == 1:
         users[u_id]['permission_id'] = 1         
+    helper.set_email(u_id, email)
+    helper.set_handle(u_id, handle)
 
     #return a new token
     s_id = new_session_id()
-    users[u_id]['session_id'].append(s_id)
+    helper.add_session(u_id, s_id)
     token = generate_token(s_id)
     return {'token': token, 'auth_user_id': u_id}
 
@@ -115,21 +119,27 @@ def auth_login_v1(email: str, password: str) -> dict:
         raise InputError(description='Invalid email.')
 
     #Email entered does not belong to a user 
-    email_exists = False 
-    for user in users: 
-        if users[user]['email'] == email:
-            u_id = user
-            email_exists = True
-    if email_exists is False:
+    u_id = email_search(email)
+    if u_id is None:
         raise InputError('Email does not belong to a user.')
 
-    #Password is not correct
-    if hashlib.sha256(password.encode()).hexdigest() != users[u_id]['password']:
+    #Password is not correct (checked again if it changed while checking)
+    stored = None
+    while stored != users[u_id]['password']:
+        stored = users[u_id]['password']
+        correct = passwords.verify_password(password, stored)
+    if not correct:
         raise InputError(description='Incorrect password. Please try again.')
+
+    #Hashes made the old way are redone now that the password is known
+    if passwords.needs_rehash(stored):
+        password_hash = password_encode(password)
+        if users[u_id]['password'] == stored:
+            password_change(u_id, password_hash)
         
     #Return auth_user_id and a new token
     s_id = new_session_id()
-    users[u_id]['session_id'].append(s_id)
+    helper.add_session(u_id, s_id)
     token = generate_token(s_id)
     return {'token': token, 'auth_user_id': u_id}
 
@@ -154,15 +164,33 @@ def auth_logout_v1(token: str) -> dict:
     helper.token_check(token)
 
     #Given an active token, invalidates the token to log the user out.
-    decode = jwt.decode(token, SECRET, algorithms = ['HS256'])
-    s_id = decode['session_id']
-    global users
-    for user in users:
-        for status in users[user]['session_id']:
-            if status == s_id:
-                users[user]['session_id'].remove(s_id)
-                return {'is_success': True}
-    return {'is_success': False}
+    return {'is_success': helper.remove_session(helper.decode_session(token))}
+
+def auth_logout_all_v1(token: str) -> dict:
+    '''
+    Given an active token, invalidates every token of its user, logging
+    them out of Dreams everywhere.
+    
+    Arguments:
+        token <str> - unique user token
+    
+    Exceptions:
+        AccessError:
+            Token passed is invalid
+            
+    Return value:
+        return the number of sessions ended.
+    '''
+
+    #Token passed is valid or not
+    token_decoded = helper.check_token(token)
+    helper.token_check(token)
+
+    #End every session of the user
+    auth_user_id = token_decoded['auth_user_id']
+    num_sessions = len(users[auth_user_id]['session_id'])
+    helper.remove_all_sessions(auth_user_id)
+    return {'num_sessions': num_sessions}
 
 
 
@@ -183,18 +211,14 @@ def auth_passwordreset_request_v1(email :str) -> dict:
     
 
     '''
-    #create a random combination of a 4 digit reset code
-    sample_numbers = '1234567890'
-    reset_code = ''.join((random.choice(sample_numbers) for i in range(4)))
-
     #search if registered user has an email
     user = email_search(email)
 
     if (user == None):
         raise InputError(description='Invalid Email: Email is not registered')
 
-    #add reset code to user dict -->making it valid for user
-    users[user]['reset_code'].append(reset_code)
+    #create a random 4 digit reset code, valid for the user until it expires
+    reset_code = helper.new_reset_code(user)
 
     #send an  email containing reset code to user's emsil
     send_email(email, reset_code)
@@ -225,8 +249,18 @@ def auth_passwordreset_reset_v1(reset_code :str, new_password :str) -> dict:
     #check new password is valid
     check_valid_password(new_password)
 
-    #change user's password to new password
-    password_change(u_id, password_encode(new_password))
+    #change user's password to new password, provided the code was not
+    #redeemed while it was hashed
+    password_hash = password_encode(new_password)
+    if check_reset_code(reset_code) != u_id:
+        raise InputError(description="reset_code is not a valid reset code")
+    password_change(u_id, password_hash)
+
+    #every session started with the old password ends
+    helper.remove_all_sessions(u_id)
+
+    #reset codes can only be used once
+    helper.remove_reset_code(reset_code)
 
     return {}
 
@@ -256,33 +290,19 @@ def make_handle(name_first: str, name_last: str) -> str:
     concat = concat.lower()
     if len(concat) > 20:
         concat = concat[:20]
-    copy_concat = concat
-    append_number = 0
-    while True:
-        for user in users:
-            if users[user]['handle_str'] == copy_concat:
-                copy_concat = concat + str(append_number)
-                append_number += 1
-                continue
-        return copy_concat
+    return helper.unique_handle(concat)
 
 def email_search(email: str) -> Optional[int]:
     '''
-    This helper function will Loop through the database to find whether there is a same email in the database
+    This helper function will find the user with the same email in the database
     '''
-    for user in users:
-        if users[user]['email'] == email:
-            return user
-    return None
+    return helper.find_email(email)
 
 def reset_code_check(reset_code: str) -> Optional[int]:
     '''
     This helper function will verify the authenticity of the user with reset code
     '''
-    for user in users:
-        if reset_code in users[user]['reset_code']:
-            return user
-    return None
+    return helper.reset_code_user(reset_code)
 
 def check_reset_code(reset_code: str) -> Optional[int]:
     '''
@@ -304,19 +324,20 @@ def password_encode(password: str) -> str:
     ''' 
     This helper function will Return the encoded password
     '''
-    return hashlib.sha256(password.encode()).hexdigest()    
+    return passwords.hash_password(password)
 
 def password_change(u_id: int, new_password: str):
     ''' 
     This helper function will ccreate a new password
     '''
     users[u_id]['password'] = new_password
+    mark_dirty('users', u_id)
 
 def send_email(email: str, reset_code: str):
     ''' 
     This helper function is responsible for sending the email containing reset code
     '''
-    sender = "dreams.w13cdorito@gmail.com"
+    sender = config.mail_user
     recepient = f"""{email}"""
 
     # Create message container.
@@ -352,10 +373,8 @@ def send_email(email: str, reset_code: str):
     msg.attach(part1)
     msg.attach(part2)
 
-    mail = smtplib.SMTP('smtp.gmail.com', 587)
-    # mail.ehlo()
-    mail.starttls()
-    mail.login('dreams.w13cdorito@gmail.com', 'RudraKaiqi13')
-    mail.sendmail(sender, recepient, msg.as_string())
-    mail.quit()
+    # Sent in the background, see src/mail.py; queueing it fsyncs the spool,
+    # which needs none of the collections
+    with unlocked():
+        mail.enqueue(sender, recepient, msg.as_string())
 
@@ -2,7 +2,6 @@
 Channel features
 '''
 from src.data import users, channels
-from src.channels import channels_list_v1
 from src.error import InputError, AccessError
 from src.other import notify
 from typing import Union
@@ -37,16 +36,12 @@ def channel_invite_v1(token: Union[str, bytes], channel_id: int, u_id: int) -> d
 
     # Access check
     helper.token_check(token)
-    authorised_u_ids = [member['u_id'] for member in channels[channel_id]['all_members']]
-    if token_decoded['auth_user_id'] not in authorised_u_ids:
+    if not helper.is_member(token_decoded['auth_user_id'], channel_id):
         raise AccessError(description='Invalid User: User is not in channel list')
 
-    # If not already a member, add user info of u_id
-    if u_id not in authorised_u_ids:
-        user_info = helper.user_info(u_id)
-        channels[channel_id]['all_members'].append(user_info)
-        if users[u_id]['permission_id'] == 1:
-            channels[channel_id]['owner_members'].append(user_info)
+    # If not already a member, add u_id
+    if not helper.is_member(u_id, channel_id):
+        helper.add_member(u_id, channel_id, owner=users[u_id]['permission_id'] == 1)
         notify(token_decoded['auth_user_id'], u_id, channel_id, -1, "", False)
 
     return {}
@@ -80,12 +75,13 @@ def channel_details_v1(token: Union[str, bytes], channel_id: int) -> dict:
     helper.token_check(token)
     helper.user_in_channel_check(token_decoded['auth_user_id'], channel_id)
 
-    # Access details of channel with channel_id
+    # Access details of channel with channel_id, with the members' current
+    # profiles
     return {
         'name': channels[channel_id]['name'],
         'is_public' : channels[channel_id]['public'],
-        'owner_members': channels[channel_id]['owner_members'],
-        'all_members': channels[channel_id]['all_members'],
+        'owner_members': helper.member_profiles(channels[channel_id]['owner_members']),
+        'all_members': helper.member_profiles(channels[channel_id]['all_members']),
     }
 
 
@@ -118,32 +114,25 @@ def channel_messages_v1(token: Union[str, bytes], channel_id: int, start: int) -
     helper.channel_check(channel_id)
 
     # Check if user is in channel 
-    channel_info = helper.channel_info(channel_id)
-
-    if channel_info not in channels_list_v1(token):
-        raise AccessError(description='Invalid User: User is not in channel list')
-
-    message_list = [message for message in channels[channel_id]['messages']]
-
-    # Change 'is_this_user_reacted'
     u_id = helper.check_token(token)['auth_user_id']
-    for m in message_list:
-        if u_id in m['reacts'][0]['u_ids']:
-            m['reacts'][0]['is_this_user_reacted'] = True
-        else:
-            m['reacts'][0]['is_this_user_reacted'] = False
+    helper.user_in_channel_check(u_id, channel_id)
+
+    message_list = channels[channel_id]['messages']
 
     if start < 0 or start > len(message_list):
         raise InputError(description='Invalid Index Value: Message index does not exist')
 
     # Assuming 0 < start < len(message_list)
-    if len(message_list[start:]) < 50:
+    if len(message_list) - start < 50:
         end = -1
     else:
         end = start + 50
 
+    # Messages are counted from the newest. 'is_this_user_reacted' is set on
+    # copies, so reading never changes the stored messages
+    page = helper.newest_first(message_list, start, start + 50)
     return {
-        'messages': message_list[start:] if end == -1 else message_list[start:end],
+        'messages': [helper.message_view(m, u_id) for m in page],
         'start': start,
         'end': end,
     }
@@ -175,16 +164,9 @@ def channel_leave_v1(token: Union[str, bytes], channel_id: int) -> dict:
     helper.token_check(token)
     helper.user_check(token_decoded['auth_user_id'])
     helper.user_in_channel_check(token_decoded['auth_user_id'], channel_id)
-    
-    user_info = helper.user_info(token_decoded['auth_user_id'])
 
-    # Delete user info from owner members if user is an owner
-    if user_info in channels[channel_id]['owner_members']:
-        idx1 = channels[channel_id]['owner_members'].index(user_info)
-        del channels[channel_id]['owner_members'][idx1]
-    
-    idx2 = channels[channel_id]['all_members'].index(user_info)
-    del channels[channel_id]['all_members'][idx2]
+    # Removes the user from the owner members too if they are an owner
+    helper.remove_member(token_decoded['auth_user_id'], channel_id)
 
     return {}
 
@@ -211,15 +193,14 @@ def channel_join_v1(token: Union[str, bytes], channel_id: int) -> dict:
     helper.token_check(token)
     helper.channel_check(channel_id)
 
-    member_info = helper.user_info(token_decoded['auth_user_id'])
-    
+    auth_user_id = token_decoded['auth_user_id']
+
     # If channel is a public channel
     if channels[channel_id]['public']:
-        channels[channel_id]['all_members'].append(member_info)
+        helper.add_member(auth_user_id, channel_id)
     # user is a global owner
-    elif users[token_decoded['auth_user_id']]['permission_id'] == 1:
-        channels[channel_id]['owner_members'].append(member_info)
-        channels[channel_id]['all_members'].append(member_info)
+    elif users[auth_user_id]['permission_id'] == 1:
+        helper.add_member(auth_user_id, channel_id, owner=True)
     # not a global owner and accessing a private channel
     else:
         raise AccessError(description='Private Channel: User cannot join this channel')
@@ -256,18 +237,14 @@ def channel_addowner_v1(token: Union[str, bytes], channel_id: int, u_id: int) ->
         helper.user_own_channel_check(auth_user_id, channel_id)
     
     helper.user_check(u_id)
-    user_info = helper.user_info(u_id)
 
-    member_list = [members['u_id'] for members in channels[channel_id]['all_members']]
-    
-    if user_info in channels[channel_id]['owner_members']:
+    if helper.is_owner(u_id, channel_id):
         raise InputError(description='User already an owner')
     
-    if u_id not in member_list:
+    if not helper.is_member(u_id, channel_id):
         notify(token_decoded['auth_user_id'], u_id, channel_id, -1, "", False)
-        channels[channel_id]['all_members'].append(user_info)
 
-    channels[channel_id]['owner_members'].append(user_info)
+    helper.add_member(u_id, channel_id, owner=True)
 
     return {}
 
@@ -300,14 +277,11 @@ def channel_removeowner_v1(token: Union[str, bytes], channel_id: int, u_id: int)
     
     helper.user_check(u_id)
 
-    user_info = helper.user_info(u_id)    
-    if user_info not in channels[channel_id]['owner_members']:
+    if not helper.is_owner(u_id, channel_id):
         raise InputError(description='User already not an owner')
     if len(channels[channel_id]['owner_members']) == 1:
         raise InputError(description='User is the only owner')
 
-    idx = channels[channel_id]['owner_members'].index(user_info)
-
-    del channels[channel_id]['owner_members'][idx]
+    helper.remove_owner(u_id, channel_id)
     return {}
 
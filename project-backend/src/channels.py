@@ -24,15 +24,10 @@ def channels_list_v1(token: Union[str, bytes]) -> list:
     #Intialise an empty dictionary that has a 'channels' list
     user_channels = []
 
-    #Get u_id, name_first, name_last to see if they are a member of a channel
-    user_check = helper.user_info(token_decoded['auth_user_id'])
-
-    #Search through each channel in data
-    #If the user is a member of a channel:  append it to the channel_list
-    for channel_id in channels:
-        if user_check in channels[channel_id]['all_members']:
-            channel_tmp = helper.channel_info(channel_id)
-            user_channels.append(channel_tmp)
+    #Look up the channels the user is a member of and append each to the channel_list
+    for channel_id in helper.channels_include_user(token_decoded['auth_user_id']):
+        channel_tmp = helper.channel_info(channel_id)
+        user_channels.append(channel_tmp)
 
     return user_channels
 
@@ -87,21 +82,21 @@ def channels_create_v1(token: Union[str, bytes], name: str, is_public: bool) ->
     if len(name)>20:
         raise InputError('Channel name is too long')
     
-    creator_info = helper.user_info(token_decoded['auth_user_id'])
+    creator = token_decoded['auth_user_id']
 
     # Create channel
     new_channel = {
         'name': name,
         'public' : is_public,
-        'owner_members': [creator_info],
-        'all_members': [creator_info],
+        'owner_members': [creator],
+        'all_members': [creator],
         'messages': [],
         'is_active': False,
         'buffer': []
     }
     
     channel_id = helper.uniqid()
-    channels[channel_id] = new_channel
+    helper.add_channel(channel_id, new_channel)
 
     return channel_id
 
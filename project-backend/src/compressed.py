@@ -0,0 +1,97 @@
+'''
+Compressed JSON snapshot files.
+
+A compressed snapshot of a collection holds one [key, entry] JSON line per
+entry, so it is encoded and decoded one entry at a time and the collection
+never exists in memory as a single JSON string. 'gzip' uses the standard
+library; 'zstd' needs the zstandard package.
+'''
+import io
+import gzip
+from typing import BinaryIO, Iterator
+
+from src import schema
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+EXTENSIONS = {
+    'gzip': '.jsonl.gz',
+    'zstd': '.jsonl.zst',
+}
+
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+def path_for(path: str, compression: str) -> str:
+    '''
+    Name of the compressed snapshot replacing the JSON snapshot at path,
+    e.g. channelsdb.json -> channelsdb.jsonl.gz
+    '''
+    return path[:-len('.json')] + EXTENSIONS[compression]
+
+def require(compression: str):
+    if compression not in EXTENSIONS:
+        raise ValueError(f'Unknown snapshot compression {compression!r}')
+    if compression == 'zstd' and zstandard is None:
+        raise ImportError("snapshot_compression = 'zstd' needs the zstandard package")
+
+def write(stream: BinaryIO, collection: dict, compression: str) -> int:
+    '''
+    Streams a compressed snapshot of collection to a binary stream,
+    returning the number of compressed bytes written
+    '''
+    require(compression)
+    start = stream.tell()
+    if compression == 'gzip':
+        writer = gzip.GzipFile(fileobj=stream, mode='wb', compresslevel=GZIP_LEVEL, mtime=0)
+    else:
+        writer = zstandard.ZstdCompressor(level=ZSTD_LEVEL).stream_writer(stream, closefd=False)
+    with writer:
+        for key, entry in collection.items():
+            writer.write(schema.dumps([key, schema.stored(entry)]).encode())
+            writer.write(b'\n')
+    return stream.tell() - start
+
+def encode(collection: dict, compression: str) -> bytes:
+    stream = io.BytesIO()
+    write(stream, collection, compression)
+    return stream.getvalue()
+
+def entries(stream: BinaryIO, compression: str) -> Iterator:
+    '''
+    Decodes a compressed snapshot from a binary stream one entry at a time
+    '''
+    require(compression)
+    if compression == 'gzip':
+        reader = gzip.GzipFile(fileobj=stream, mode='rb')
+    else:
+        reader = zstandard.ZstdDecompressor().stream_reader(stream, closefd=False)
+    with reader:
+        for line in split_lines(reader):
+            yield schema.loads(line)
+
+def split_lines(reader: BinaryIO, chunk_size: int = 1 << 20) -> Iterator[bytes]:
+    pending = bytearray()
+    while True:
+        chunk = reader.read(chunk_size)
+        if not chunk:
+            break
+        pending += chunk
+        end = chunk.rfind(b'\n')
+        if end != -1:
+            end += len(pending) - len(chunk)
+            yield from bytes(pending[:end]).split(b'\n')
+            del pending[:end + 1]
+    if pending:
+        yield bytes(pending)
+
+def read(path: str, name: str, compression: str) -> dict:
+    '''
+    Loads the compressed snapshot of the collection called name
+    '''
+    with open(path, 'rb') as FILE:
+        return {key: schema.load_entry(name, key, entry) \
+            for key, entry in entries(FILE, compression)}
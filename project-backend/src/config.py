@@ -1,3 +1,107 @@
+import os
+
 port = 8080
 
 url = f"http://localhost:{port}/"
+
+# Id of this server, 0 to 1023, put in every id it makes so that servers
+# sharing a database never make the same id (see src/snowflake.py)
+node_id = 0
+
+# Storage engine: 'json' (snapshot files plus journal) or 'sqlite'
+storage = 'json'
+sqlite_path = 'dreams.sqlite3'
+
+# JSON persistence: append each request's changes to the journal instead of
+# rewriting the whole database, and fold the journal into the snapshot in
+# the background once it holds this many records. checkpoint_path records
+# how much of the journal the snapshot includes.
+journal = True
+journal_path = 'journaldb.jsonl'
+journal_compact_records = 10000
+checkpoint_path = 'checkpointdb.json'
+
+# Snapshot written by the JSON engine:
+#   'json'    - usersdb.json, channelsdb.json and dmsdb.json
+#   'binary'  - one memory-mapped file at snapshot_path that starts up
+#               without decoding any message history
+#   'sharded' - a file per channel and per dm under shard_dir, decoded in
+#               parallel on startup by shard_workers threads or processes
+#               (shard_pool 'thread' or 'process')
+# A database with no snapshot in the chosen format yet starts from the JSON
+# files.
+snapshot_format = 'json'
+snapshot_path = 'dreamsdb.bin'
+# Most message lists of a 'binary' snapshot kept decoded at once. Past it,
+# the oldest decoded lists that were not changed since are dropped between
+# requests and decoded again when next read, so message history need not
+# fit in memory. None keeps every list once decoded.
+decoded_lists_max = None
+shard_dir = 'dreamsdb'
+shard_workers = 4
+shard_pool = 'thread'
+# Compression of 'json' snapshots: None, 'gzip' or 'zstd' (needs the
+# zstandard package). Compressed snapshots are written as channelsdb.jsonl.gz
+# and so on, encoded and decoded one entry at a time.
+snapshot_compression = None
+
+# When a request's changes are durable: 'sync' writes them inside the
+# request; 'group' has a background flusher write the changes of every
+# request committed within group_commit_ms (or after group_commit_marks
+# changes, if sooner) in one go, holding each request until that write is
+# done; 'async' does the same without holding the request
+durability = 'group'
+group_commit_ms = 10
+group_commit_marks = 1000
+
+# Number of verified tokens of active sessions kept, least recently used
+# first out, so that polling clients are not verified on every request
+token_cache_size = 10000
+
+# Seconds a password reset code stays valid
+reset_code_ttl = 15 * 60
+# Unredeemed reset codes a user may hold; requesting another revokes their oldest
+reset_codes_per_user = 5
+
+# Seconds a session lasts without being used, and at most; and how many
+# sessions a user may have, the least recently used ending first
+session_idle_s = 24 * 60 * 60
+session_max_age_s = 30 * 24 * 60 * 60
+sessions_per_user = 20
+
+# How often (in seconds) the sweeper removes expired reset codes and sessions
+sweep_s = 1
+
+# How passwords are hashed ('pbkdf2' or 'scrypt', see src/passwords.py) and
+# at what cost. Hashes made otherwise are redone when their user next logs in.
+password_kdf = 'pbkdf2'
+pbkdf2_iterations = 100000
+scrypt_n = 2 ** 14
+scrypt_r = 8
+scrypt_p = 1
+# Pool ('thread' or 'process') the hashing runs on, its size, and how many
+# hashing jobs may be queued or running before logins wait, then fail
+password_pool = 'thread'
+password_workers = os.cpu_count() or 1
+password_queue = 64
+password_queue_timeout = 5
+
+# Outbound mail (see src/mail.py): the SMTP server, the spool messages are
+# queued in, how many are sent per batch, how long an idle connection is
+# kept open, and the retry backoff (doubling from mail_retry_s)
+mail_host = 'smtp.gmail.com'
+mail_port = 587
+mail_starttls = True
+mail_user = 'dreams.w13cdorito@gmail.com'
+mail_password = 'RudraKaiqi13'
+mail_timeout_s = 30
+mail_spool_path = 'maildb.jsonl'
+mail_batch = 50
+mail_idle_s = 30
+mail_retry_s = 1
+mail_retry_max_s = 300
+mail_max_attempts = 10
+
+# Check that read (GET) routes leave the database exactly as they found it.
+# Compares a dump of the whole database around each read, so development only
+debug_routes = False
@@ -1,16 +1,336 @@
-from json import loads, dumps
-
-try:
-    with open('usersdb.json', 'r') as FILE1:
-        users = loads(FILE1.read())
-    with open('channelsdb.json', 'r') as FILE2:
-        channels = loads(FILE2.read())
-    with open('dmsdb.json', 'r') as FILE3:
-        dms = loads(FILE3.read())
-except FileNotFoundError:
-    users = {}
-    channels = {}
-    dms = {}
+'''
+In-memory Dreams database and its persistence.
+
+The three collections below are imported by reference throughout src/, so
+they are only ever mutated in place and never rebound. Every feature that
+changes them reports the change through mark_dirty()/mark_cleared(), and
+commit() persists those changes at the end of each request through the
+storage engine chosen by config.storage:
+    'json'   - small records appended to the journal, or (with the journal
+               disabled) a rewrite of the snapshot files that changed
+    'sqlite' - the same records applied as row updates (src/sqlite_storage.py)
+JSON snapshots are the three *db.json files (streamed through gzip or zstd
+when config.snapshot_compression is set, see src/compressed.py), or as set
+by config.snapshot_format:
+    'binary'  - a single memory-mapped file whose message lists are only
+                decoded when first read (src/snapshot.py), and dropped
+                again past config.decoded_lists_max unless changed
+    'sharded' - a file per channel and per dm, so only the shards of
+                changed entries are rewritten (src/shards.py)
+
+With the journal enabled, every record carries a log sequence number (lsn)
+and the snapshot manager (see SNAPSHOTS below) keeps a checkpoint of the lsn
+the snapshot on disk is up to date with. Snapshots are only ever replaced
+atomically, and the journal is folded into them in the background.
+
+The indexes (see INDEXES below) are derived from the collections: the
+features keep them up to date as they change what they index, and they are
+rebuilt whenever the collections are loaded or cleared.
+
+Anything touching the collections must hold lock: the server takes it for
+the whole of each request, and timer callbacks take it through locked().
+'''
+import os
+import uuid
+import atexit
+import threading
+import itertools
+import traceback
+from contextlib import contextmanager
+from collections import OrderedDict
+from src.schema import loads, dumps
+from typing import Optional, Callable
+from src import config
+from src import sqlite_storage
+from src import snapshot
+from src import shards
+from src import schema
+from src import durable
+from src import compressed
+from src import metrics
+from src.wheel import TimingWheel
+from time import time
+
+users = {}
+channels = {}
+dms = {}
+
+COLLECTIONS = {
+    'users': users,
+    'channels': channels,
+    'dms': dms,
+}
+
+SNAPSHOT_FILES = {
+    'users': 'usersdb.json',
+    'channels': 'channelsdb.json',
+    'dms': 'dmsdb.json',
+}
+
+lock = threading.RLock()
+
+# Changes made since the last commit: collection -> key -> touched ids.
+# An id of None means the entry itself (without its messages) changed,
+# any other id is the message_id of a message inside the channel/dm.
+dirty = {collection: {} for collection in COLLECTIONS}
+cleared = False
+# Number of mark_dirty() calls since the changes were last collected
+pending_marks = 0
+
+# Number of records in the journal files not yet folded into the snapshot
+journal_records = 0
+# Log sequence number of the next journal record, and of the last record
+# the snapshot on disk includes
+next_lsn = 1
+snapshot_lsn = 0
+
+# Entries changed since the sharded snapshot was last written, as
+# collection -> keys; None when every shard needs writing
+stale_shards = None
+
+###
+# INDEXES
+###
+
+# session_id -> u_id of every active session
+sessions = {}
+# session_id -> [issued, last seen] of every active session, with each
+# session also scheduled on session_wheel to expire by session_expiry().
+# Sessions are issued when their uuid1 session_id says; when they were last
+# seen is not persisted, so it is the load time for sessions loaded from disk.
+session_times = {}
+session_wheel = TimingWheel(config.sweep_s, 4096)
+# email_key(email) -> u_id of every user
+emails = {}
+# handle_str -> u_id of every user
+handles = {}
+# Base handle -> suffix of the next handle to try when generating a handle
+# from that base (-1 for the base itself); every earlier one is taken
+handle_suffixes = {}
+# reset_code -> (u_id, expiry) of every unredeemed password reset code, with
+# the codes also scheduled to expire on reset_wheel. Expiry times are not
+# persisted, so codes loaded from disk are valid for a full ttl again.
+reset_codes = {}
+reset_wheel = TimingWheel(config.sweep_s, 1024)
+# Every reset code that is not in reset_codes, in no particular order, so a
+# free code is picked in constant time however many are taken
+RESET_CODE_DIGITS = 4
+free_reset_codes = []
+# channel_id -> set of the u_ids in the channel's all_members, and in its
+# owner_members. The lists hold the same u_ids in the order they were added,
+# for rendering; user profiles are only joined in when a channel is rendered.
+channel_members = {}
+channel_owners = {}
+# u_id -> set of the channel_ids of the channels the user is a member of,
+# and of the dm_ids of the dms they own or are a member of
+user_channels = {}
+user_dms = {}
+# message_id -> (collection, channel_id or dm_id, message) of every message
+# in a channel or dm. Message lists of a binary snapshot that were never
+# decoded are not indexed on load, so loading stays lazy: their
+# (collection, key) is kept in unindexed_messages instead, and each is
+# indexed when it is decoded, or when a lookup misses (see locate_message()).
+message_ids = {}
+unindexed_messages = set()
+# message_id -> order in which each indexed message was added to its list.
+# Messages are only ever appended, and are indexed as they are, so a list's
+# orders increase along it and a message's position is found by bisection.
+message_orders = {}
+next_order = itertools.count()
+# (collection, key) -> entry of the binary snapshot message lists that are
+# decoded, oldest decoded first. Past config.decoded_lists_max, the oldest
+# that were never changed are dropped back to their snapshot blocks (see
+# evict_decoded()), and indexed again when next decoded.
+decoded_lists = OrderedDict()
+
+def session_issued(session_id: str, default: float) -> float:
+    '''
+    Time a session was issued, read from its uuid1 session_id
+    '''
+    try:
+        issued = uuid.UUID(session_id)
+    except ValueError:
+        return default
+    if issued.version != 1:
+        return default
+    return (issued.time - UUID1_EPOCH) / 1e7
+
+# uuid1 times count 100ns intervals from 15 October 1582
+UUID1_EPOCH = 0x01b21dd213814000
+
+def session_expiry(session_id: str) -> float:
+    issued, last_seen = session_times[session_id]
+    return min(issued + config.session_max_age_s, last_seen + config.session_idle_s)
+
+def index_session(session_id: str, u_id: int, issued: float, last_seen: float):
+    sessions[session_id] = u_id
+    session_times[session_id] = [issued, last_seen]
+    session_wheel.schedule(session_id, session_expiry(session_id))
+
+def unindex_session(session_id: str) -> Optional[int]:
+    session_times.pop(session_id, None)
+    session_wheel.cancel(session_id)
+    return sessions.pop(session_id, None)
+
+def index_channel(channel_id: int, channel: dict):
+    channel_members[channel_id] = set(channel['all_members'])
+    channel_owners[channel_id] = set(channel['owner_members'])
+    for u_id in channel_members[channel_id]:
+        user_channels.setdefault(u_id, set()).add(channel_id)
+
+def dm_users(dm: dict) -> set:
+    '''
+    u_ids of the owner and members of a dm
+    '''
+    return {dm['owner'], *dm['members']} - {None}
+
+def index_dm(dm_id: int, dm: dict):
+    for u_id in dm_users(dm):
+        user_dms.setdefault(u_id, set()).add(dm_id)
+
+def unindex_dm(dm_id: int, dm: dict):
+    for u_id in dm_users(dm):
+        user_dms.get(u_id, set()).discard(dm_id)
+
+def index_message(collection: str, key: int, message: dict):
+    message_ids[message['message_id']] = (collection, key, message)
+    message_orders[message['message_id']] = next(next_order)
+
+def unindex_message(message_id: int):
+    message_ids.pop(message_id, None)
+    message_orders.pop(message_id, None)
+
+def remove_message(collection: str, key: int, message: dict):
+    '''
+    Removes an indexed message from its channel or dm, finding it in
+    O(log n) rather than comparing it against every message
+    '''
+    messages = COLLECTIONS[collection][key]['messages']
+    order = message_orders[message['message_id']]
+    low, high = 0, len(messages)
+    while low < high:
+        middle = (low + high) // 2
+        if message_orders[messages[middle]['message_id']] < order:
+            low = middle + 1
+        else:
+            high = middle
+    if low < len(messages) and messages[low] is message:
+        del messages[low]
+    else:
+        messages.remove(message)
+    unindex_message(message['message_id'])
+
+def index_messages(collection: str, key: int, entry: dict):
+    if snapshot.raw_messages(entry) is not None:
+        unindexed_messages.add((collection, key))
+        entry.on_load = lambda: decoded(collection, key, entry)
+        return
+    for message in entry['messages']:
+        index_message(collection, key, message)
+
+def decoded(collection: str, key: int, entry: dict):
+    decoded_lists[(collection, key)] = entry
+    index_unindexed(collection, key, entry)
+
+def index_unindexed(collection: str, key: int, entry: dict):
+    '''
+    Indexes the messages of an entry left unindexed on load, decoding them
+    if they still need it
+    '''
+    if (collection, key) not in unindexed_messages:
+        return
+    unindexed_messages.discard((collection, key))
+    for message in entry['messages']:
+        index_message(collection, key, message)
+
+def unindex_messages(collection: str, key: int, entry: dict):
+    unindexed_messages.discard((collection, key))
+    decoded_lists.pop((collection, key), None)
+    # Undecoded messages were never indexed
+    if snapshot.raw_messages(entry) is None:
+        for message in entry['messages']:
+            unindex_message(message['message_id'])
+
+def locate_message(message_id: int) -> Optional[tuple]:
+    '''
+    (collection, channel_id or dm_id, message) of a message, or None if no
+    channel or dm holds it
+    '''
+    if message_id not in message_ids:
+        # Decodes the lists left unindexed until one holds the message. Once
+        # none are left, a miss is answered from the index alone.
+        for collection, key in list(unindexed_messages):
+            index_unindexed(collection, key, COLLECTIONS[collection][key])
+            if message_id in message_ids:
+                break
+    return message_ids.get(message_id)
+
+def evict_decoded():
+    '''
+    Drops the oldest decoded message lists past config.decoded_lists_max
+    back to their snapshot blocks, keeping any changed since they were
+    decoded. Only called between requests, when nothing holds on to the
+    messages.
+    '''
+    if config.decoded_lists_max is None:
+        return
+    while len(decoded_lists) > config.decoded_lists_max:
+        (collection, key), entry = decoded_lists.popitem(last=False)
+        if COLLECTIONS[collection].get(key) is not entry or entry.block is None:
+            continue
+        messages = dict.get(entry, 'messages')
+        if entry.unload():
+            for message in messages:
+                unindex_message(message['message_id'])
+            unindexed_messages.add((collection, key))
+            metrics.increment('message_lists_evicted')
+
+def email_key(email: str) -> str:
+    '''
+    Emails are matched regardless of case
+    '''
+    return email.lower()
+
+def rebuild_indexes():
+    '''
+    Rebuilds every index from the collections
+    '''
+    sessions.clear()
+    session_times.clear()
+    session_wheel.clear()
+    emails.clear()
+    handles.clear()
+    handle_suffixes.clear()
+    reset_codes.clear()
+    reset_wheel.clear()
+    channel_members.clear()
+    channel_owners.clear()
+    user_channels.clear()
+    user_dms.clear()
+    message_ids.clear()
+    unindexed_messages.clear()
+    message_orders.clear()
+    decoded_lists.clear()
+    now = time()
+    expiry = now + config.reset_code_ttl
+    for u_id, user in users.items():
+        for session_id in user['session_id']:
+            index_session(session_id, u_id, session_issued(session_id, now), now)
+        emails[email_key(user['email'])] = u_id
+        handles[user['handle_str']] = u_id
+        for reset_code in user['reset_code']:
+            reset_codes[reset_code] = (u_id, expiry)
+            reset_wheel.schedule(reset_code, expiry)
+    free_reset_codes[:] = [reset_code for reset_code in
+        (f'{n:0{RESET_CODE_DIGITS}d}' for n in range(10 ** RESET_CODE_DIGITS))
+        if reset_code not in reset_codes]
+    for channel_id, channel in channels.items():
+        index_channel(channel_id, channel)
+        index_messages('channels', channel_id, channel)
+    for dm_id, dm in dms.items():
+        index_dm(dm_id, dm)
+        index_messages('dms', dm_id, dm)
+    metrics.set_value('sessions_live', len(sessions))
 
 def get_users():
     global users
@@ -24,21 +344,620 @@ def get_dms():
     global dms
     return dms
 
-def save_users():
-    with open('usersdb.json', 'w') as FILE1:
-        FILE1.write(dumps(get_users()))
+def mark_dirty(collection: str, key: int, message_id: Optional[int] = None):
+    '''
+    Records that an entry of a collection, or a single message inside a
+    channel/dm when message_id is given, was created, changed or removed
+    '''
+    global pending_marks
+    dirty[collection].setdefault(key, {})[message_id] = True
+    entry_changed(COLLECTIONS[collection].get(key))
+    pending_marks += 1
+    if pending_marks == config.group_commit_marks and flusher is not None:
+        with flush_cond:
+            flush_cond.notify()
 
-def save_channels():
-    with open('channelsdb.json', 'w') as FILE2:
-        FILE2.write(dumps(get_channels()))
+def entry_changed(entry: Optional[dict]):
+    '''
+    Keeps a changed channel/dm's decoded messages from being unloaded
+    '''
+    if isinstance(entry, snapshot.LazyEntry):
+        entry.changed()
 
-def save_dms():
-    with open('dmsdb.json', 'w') as FILE3:
-        FILE3.write(dumps(get_dms()))
+def copy_marks() -> tuple:
+    return cleared, {collection: {key: dict(touched) for key, touched in keys.items()} \
+        for collection, keys in dirty.items()}
 
-def save_db():
-    global users
-    save_users()
-    save_channels()
-    save_dms()
+def restore_marks(marks: tuple):
+    '''
+    Marks again the changes copied by copy_marks() before a write of them
+    failed, ahead of any marked since, so the next commit retries them
+    '''
+    global cleared, pending_marks
+    was_cleared, marked = marks
+    if cleared:
+        # Wiped since, which supersedes them
+        return
+    cleared = was_cleared
+    for collection, keys in marked.items():
+        for key, touched in keys.items():
+            touched.update(dirty[collection].get(key, {}))
+            dirty[collection][key] = touched
+            pending_marks += len(touched)
+
+def mark_cleared():
+    '''
+    Records that every collection was wiped
+    '''
+    global cleared
+    cleared = True
+    for collection in dirty.values():
+        collection.clear()
+
+def dirty_collections() -> list:
+    '''
+    Names of the collections changed since the last commit
+    '''
+    if cleared:
+        return list(COLLECTIONS)
+    return [collection for collection in COLLECTIONS if dirty[collection]]
+
+def fingerprint() -> tuple:
+    '''
+    Value that changes whenever the collections or the pending marks do
+    '''
+    return cleared, pending_marks, dumps(COLLECTIONS)
+
+def snapshot_file(collection: str) -> str:
+    if config.snapshot_compression:
+        return compressed.path_for(SNAPSHOT_FILES[collection], config.snapshot_compression)
+    return SNAPSHOT_FILES[collection]
+
+def encode_collection(collection: dict):
+    '''
+    Contents of a JSON snapshot file, compressed if so configured
+    '''
+    if config.snapshot_compression:
+        return compressed.encode(collection, config.snapshot_compression)
+    return dumps(schema.stored_collection(collection))
+
+def write_snapshot(name: str, data) -> int:
+    return durable.write_atomic(snapshot_file(name), data)
+
+def save_collection(name: str, collection: dict) -> int:
+    '''
+    Writes the JSON snapshot file of a collection; compressed snapshots are
+    streamed to disk an entry at a time
+    '''
+    if config.snapshot_compression:
+        with durable.atomic_file(snapshot_file(name)) as FILE:
+            return compressed.write(FILE, collection, config.snapshot_compression)
+    return write_snapshot(name, dumps(schema.stored_collection(collection)))
+
+def read_collection(name: str) -> dict:
+    '''
+    Reads the JSON snapshot file of a collection. A compressed database
+    with no compressed snapshot yet reads the uncompressed one.
+    '''
+    path = snapshot_file(name)
+    if config.snapshot_compression and os.path.exists(path):
+        return compressed.read(path, name, config.snapshot_compression)
+    with open(SNAPSHOT_FILES[name], 'r', encoding='utf-8') as FILE:
+        return schema.load_collection(name, loads(FILE.read()))
+
+def save_db() -> int:
+    '''
+    Writes a complete snapshot of the database as it is now, returning the
+    number of bytes written. Must be called with lock held.
+    '''
+    global stale_shards
+    if config.storage == 'sqlite':
+        return sqlite_storage.write(all_records())
+    with compaction_lock:
+        if config.snapshot_format == 'binary':
+            written = snapshot.save(config.snapshot_path, snapshot.encode_bytes(users, channels, dms))
+        elif config.snapshot_format == 'sharded':
+            written = shards.save(config.shard_dir, shards.encode(users, channels, dms, None), True)
+            stale_shards = {collection: set() for collection in COLLECTIONS}
+        else:
+            written = sum(save_collection(name, collection) \
+                for name, collection in COLLECTIONS.items())
+        # Everything journaled so far is in the snapshot
+        write_checkpoint(next_lsn - 1)
+    return written
+
+def commit() -> Optional[int]:
+    '''
+    Persists every change marked since the last commit, as set by
+    config.durability:
+        'sync'  - the changes are written and fsynced before commit returns
+        'group' - the background flusher writes them together with those of
+                  every other request in the same window; returns a ticket
+                  for wait_durable(), which blocks until that write is done
+        'async' - the background flusher writes them; nothing to wait for
+    Must be called with lock held.
+    '''
+    if config.durability == 'sync':
+        marks = copy_marks()
+        try:
+            write_changes(collect_changes())
+        except Exception:
+            restore_marks(marks)
+            raise
+        return None
+    start_flusher()
+    if config.durability == 'group' and (cleared or pending_marks):
+        return collected_generation + 1
+    return None
+
+def collect_changes() -> Optional[tuple]:
+    '''
+    Encodes every change marked since the last collection and resets the
+    marks. Must be called with lock held; the result no longer refers to the
+    collections, so it can be written out once the lock is released.
+    '''
+    global cleared, pending_marks, next_lsn
+    if config.storage == 'sqlite' or config.journal:
+        records = pending_records()
+        if config.storage == 'json':
+            for record in records:
+                record['lsn'] = next_lsn
+                next_lsn += 1
+        payload = ('records', [dumps(record) for record in records]) if records else None
+    elif config.snapshot_format == 'binary':
+        payload = ('binary', snapshot.encode_bytes(users, channels, dms)) \
+            if dirty_collections() else None
+    elif config.snapshot_format == 'sharded':
+        mark_stale_shards()
+        payload = ('shards', encode_stale_shards()) if dirty_collections() else None
+    else:
+        collections = dirty_collections()
+        payload = ('snapshot', {collection: encode_collection(COLLECTIONS[collection]) \
+            for collection in collections}) if collections else None
+    cleared = False
+    pending_marks = 0
+    for collection in dirty.values():
+        collection.clear()
+    return payload
+
+def write_changes(payload: Optional[tuple]) -> int:
+    '''
+    Writes out changes encoded by collect_changes(), returning the number of
+    bytes written
+    '''
+    if payload is None:
+        return 0
+    if payload[0] == 'binary':
+        written = snapshot.save(config.snapshot_path, payload[1])
+    elif payload[0] == 'shards':
+        written = shards.save(config.shard_dir, *payload[1])
+    elif payload[0] == 'snapshot':
+        written = sum(write_snapshot(collection, data) for collection, data in payload[1].items())
+    elif config.storage == 'sqlite':
+        written = sqlite_storage.write([loads(line) for line in payload[1]])
+    else:
+        written = append_journal(payload[1])
+    metrics.increment('commits')
+    metrics.increment('bytes_written', written)
+    metrics.set_value('bytes_written_last_commit', written)
+    return written
+
+def mark_stale_shards():
+    '''
+    Adds the marked changes to the shards awaiting the next sharded snapshot
+    '''
+    global stale_shards
+    if cleared:
+        stale_shards = None
+    elif stale_shards is not None:
+        for collection, keys in dirty.items():
+            stale_shards[collection].update(keys)
+
+def encode_stale_shards() -> tuple:
+    '''
+    Encodes the stale shards for shards.save() and marks every shard up to
+    date
+    '''
+    global stale_shards
+    files = shards.encode(users, channels, dms, stale_shards)
+    complete = stale_shards is None
+    stale_shards = {collection: set() for collection in COLLECTIONS}
+    return files, complete
+
+############################## JOURNAL ##############################
+
+def pending_records() -> list:
+    '''
+    Turns the marked changes into journal records. Entries are journaled
+    without their message history; messages are journaled one by one, so
+    a record is as large as the change it describes.
+    '''
+    records = [{'op': 'clear'}] if cleared else []
+    for collection, touched_keys in dirty.items():
+        for key, touched in touched_keys.items():
+            entry = COLLECTIONS[collection].get(key)
+            if entry is None:
+                records.append({'op': 'del', 'col': collection, 'key': key})
+                continue
+            if None in touched:
+                value = schema.stored({field: entry[field] for field in entry if field != 'messages'})
+                records.append({'op': 'put', 'col': collection, 'key': key, 'value': value})
+            for message_id in touched:
+                if message_id is not None:
+                    records.append({'op': 'msg', 'col': collection, 'key': key, \
+                        'id': message_id, 'value': find_message(entry, message_id)})
+    return records
+
+def all_records() -> list:
+    '''
+    Records that rebuild the whole database from scratch
+    '''
+    records = [{'op': 'clear'}]
+    for name, collection in COLLECTIONS.items():
+        for key, entry in collection.items():
+            value = schema.stored({field: entry[field] for field in entry if field != 'messages'})
+            records.append({'op': 'put', 'col': name, 'key': key, 'value': value})
+            for msg in entry.get('messages', []):
+                records.append({'op': 'msg', 'col': name, 'key': key, \
+                    'id': msg['message_id'], 'value': msg})
+    return records
+
+def find_message(entry: dict, message_id: int) -> Optional[dict]:
+    # Changed messages are most often the newest, at the end
+    for msg in reversed(entry['messages']):
+        if msg['message_id'] == message_id:
+            return msg
+    return None
+
+def append_journal(lines: list) -> int:
+    '''
+    Appends JSON-encoded records to the journal, and starts a background
+    compaction once the journal outgrows config.journal_compact_records.
+    Returns the number of bytes written.
+    '''
+    global journal_records
+    with journal_lock:
+        with open(config.journal_path, 'a', encoding='utf-8') as FILE:
+            start = FILE.tell()
+            try:
+                written = FILE.write(''.join(line + '\n' for line in lines))
+                FILE.flush()
+                os.fsync(FILE.fileno())
+            except OSError:
+                # Cut off whatever part was written, or replay would stop at
+                # the torn record and miss the ones appended after it
+                os.truncate(config.journal_path, start)
+                raise
+        journal_records += len(lines)
+        if journal_records >= config.journal_compact_records:
+            start_compaction()
+    return written
+
+def read_journal(path: str) -> list:
+    '''
+    Reads and checks the records of a journal file. A torn final line from a
+    crash mid-append is ignored.
+    '''
+    try:
+        with open(path, 'r', encoding='utf-8') as FILE:
+            lines = FILE.readlines()
+    except FileNotFoundError:
+        return []
+    records = []
+    for line in lines:
+        try:
+            record = loads(line)
+        except ValueError:
+            break
+        check_record(record)
+        records.append(record)
+    return records
+
+def replay_journal() -> int:
+    '''
+    Applies the records the snapshot does not include yet, from the journal
+    being compacted and then the live journal, returning how many there were
+    '''
+    global next_lsn
+    replayed = 0
+    for path in (frozen_journal_path(), config.journal_path):
+        for record in read_journal(path):
+            # Records from before log sequence numbers are always replayed
+            if record.get('lsn', snapshot_lsn + 1) > snapshot_lsn:
+                apply_record(record)
+                replayed += 1
+            next_lsn = max(next_lsn, record.get('lsn', 0) + 1)
+    return replayed
+
+def check_record(record: dict):
+    '''
+    Checks the shape of the value carried by a journal record
+    '''
+    if record['op'] == 'put':
+        schema.load_entry(record['col'], record['key'], record['value'], with_messages=False)
+    elif record['op'] == 'msg' and record['value'] is not None:
+        schema.check(record['value'], schema.MESSAGE, f"{record['col']}[{record['key']}].messages")
+
+def apply_record(record: dict, collections: dict = COLLECTIONS):
+    '''
+    Applies a journal record to the live collections, or to the given ones
+    '''
+    if record['op'] == 'clear':
+        for collection in collections.values():
+            collection.clear()
+        return
+    collection = collections[record['col']]
+    key = record['key']
+    if record['op'] == 'del':
+        collection.pop(key, None)
+    elif record['op'] == 'put':
+        messages = collection[key]['messages'] if key in collection \
+            and 'messages' in collection[key] else None
+        collection[key] = record['value']
+        if record['col'] != 'users':
+            collection[key]['messages'] = messages if messages is not None else []
+    elif record['op'] == 'msg' and key in collection:
+        entry_changed(collection[key])
+        messages = collection[key]['messages']
+        msg = find_message(collection[key], record['id'])
+        if record['value'] is None:
+            if msg is not None:
+                messages.remove(msg)
+        elif msg is not None:
+            msg.clear()
+            msg.update(record['value'])
+        else:
+            messages.append(record['value'])
+
+############################## SNAPSHOTS ##############################
+
+# Held by whoever is writing the snapshot, and by journal appends/rotation
+compaction_lock = threading.Lock()
+journal_lock = threading.Lock()
+compactor = None
+
+def frozen_journal_path() -> str:
+    return config.journal_path + '.compacting'
+
+def write_checkpoint(lsn: int):
+    '''
+    Records that the snapshot on disk includes every journal record up to
+    lsn. Written only once the snapshot itself is durable, so after a crash
+    the checkpoint may lag the snapshot but never lead it; replaying records
+    the snapshot already has is harmless.
+    '''
+    global snapshot_lsn
+    durable.write_atomic(config.checkpoint_path, dumps({'lsn': lsn}))
+    snapshot_lsn = lsn
+
+def read_checkpoint() -> int:
+    try:
+        with open(config.checkpoint_path, 'r', encoding='utf-8') as FILE:
+            return loads(FILE.read())['lsn']
+    except FileNotFoundError:
+        return 0
+
+def load_snapshot(collections: dict) -> Optional[str]:
+    '''
+    Fills empty collections from the snapshot on disk, returning the format
+    it was found in (None if there is no snapshot yet). A format other than
+    'json' falls back to the JSON files until its first snapshot is written.
+    '''
+    if config.snapshot_format == 'binary' and os.path.exists(config.snapshot_path):
+        snapshot.load(config.snapshot_path, *collections.values())
+        return 'binary'
+    if config.snapshot_format == 'sharded' and \
+        os.path.exists(os.path.join(config.shard_dir, shards.MANIFEST)):
+        shards.load(config.shard_dir, *collections.values(), \
+            workers=config.shard_workers, pool=config.shard_pool)
+        return 'sharded'
+    try:
+        for name, collection in collections.items():
+            collection.update(read_collection(name))
+    except FileNotFoundError:
+        for collection in collections.values():
+            collection.clear()
+        return None
+    return 'json'
+
+def fold_journal(records: list) -> int:
+    '''
+    Applies journal records to the snapshot on disk, without touching the
+    live collections, and rewrites only what they changed. Returns the
+    number of bytes written.
+    '''
+    cleared_in = any(record['op'] == 'clear' for record in records)
+    if config.snapshot_format == 'sharded' and not cleared_in and \
+        os.path.exists(os.path.join(config.shard_dir, shards.MANIFEST)):
+        return shards.fold(config.shard_dir, records, apply_record)
+    state = {name: {} for name in COLLECTIONS}
+    source = load_snapshot(state)
+    for record in records:
+        apply_record(record, state)
+    if config.snapshot_format == 'binary':
+        return snapshot.save(config.snapshot_path, snapshot.encode_bytes(*state.values()))
+    if config.snapshot_format == 'sharded':
+        return shards.save(config.shard_dir, shards.encode(*state.values(), None), True)
+    changed = COLLECTIONS if cleared_in or source is None else \
+        {record['col'] for record in records if record['op'] != 'clear'}
+    return sum(save_collection(name, state[name]) for name in changed)
+
+def compact_journal() -> int:
+    '''
+    Folds the journal into the snapshot and starts a new, empty journal.
+    The journal is first renamed aside, so appends carry on in a fresh file,
+    then folded into the snapshot read back from disk; requests are never
+    held up by it. Returns the number of bytes written.
+    '''
+    global journal_records
+    with compaction_lock:
+        written = 0
+        # Left behind if the last compaction was interrupted
+        if os.path.exists(frozen_journal_path()):
+            written += compact_frozen_journal()
+        with journal_lock:
+            if os.path.exists(config.journal_path):
+                durable.rename(config.journal_path, frozen_journal_path())
+            journal_records = 0
+        written += compact_frozen_journal()
+    metrics.increment('compactions')
+    metrics.increment('bytes_compacted', written)
+    return written
+
+def compact_frozen_journal() -> int:
+    records = read_journal(frozen_journal_path())
+    lsn = max([snapshot_lsn] + [record.get('lsn', 0) for record in records])
+    records = [record for record in records if record.get('lsn', snapshot_lsn + 1) > snapshot_lsn]
+    written = fold_journal(records) if records else 0
+    write_checkpoint(lsn)
+    if os.path.exists(frozen_journal_path()):
+        os.remove(frozen_journal_path())
+    return written
+
+def start_compaction():
+    '''
+    Compacts the journal on a background thread, unless a compaction is
+    already running
+    '''
+    global compactor
+    if compactor is None or not compactor.is_alive():
+        compactor = threading.Thread(target=compact_in_background, name='db-compactor', daemon=True)
+        compactor.start()
+
+def compact_in_background():
+    try:
+        compact_journal()
+    except Exception:
+        metrics.increment('compaction_errors')
+        traceback.print_exc()
+
+def join_compaction():
+    '''
+    Waits for a running background compaction to finish
+    '''
+    if compactor is not None:
+        compactor.join()
+
+############################## GROUP COMMIT ##############################
+
+flusher = None
+flush_cond = threading.Condition()
+# Each flush collects the marked changes, then writes them. A request that
+# commits while collected_generation == n is durable once flushed_generation
+# reaches n + 1.
+collected_generation = 0
+flushed_generation = 0
+
+def start_flusher():
+    global flusher
+    with flush_cond:
+        if flusher is None:
+            flusher = threading.Thread(target=flush_loop, name='db-flusher', daemon=True)
+            flusher.start()
+
+@atexit.register
+def stop_flusher():
+    '''
+    Stops the flusher once it has written out every pending change
+    '''
+    global flusher
+    with flush_cond:
+        thread, flusher = flusher, None
+        if thread is None:
+            return
+        flush_cond.notify()
+    thread.join()
+
+def flush_loop():
+    '''
+    Flushes every config.group_commit_ms, or as soon as
+    config.group_commit_marks changes have been marked, until stopped
+    '''
+    while flusher is threading.current_thread():
+        with flush_cond:
+            flush_cond.wait(config.group_commit_ms / 1000)
+        flush()
+
+def flush():
+    '''
+    Collects and writes out every pending change, then wakes the requests
+    waiting on them
+    '''
+    global collected_generation, flushed_generation
+    with lock:
+        marks = copy_marks()
+        payload = collect_changes()
+        collected_generation += 1
+        generation = collected_generation
+    try:
+        write_changes(payload)
+    except Exception:
+        metrics.increment('flush_errors')
+        traceback.print_exc()
+        # The requests waiting on these changes keep waiting, until a later
+        # flush writes them
+        with lock:
+            restore_marks(marks)
+        return
+    with flush_cond:
+        flushed_generation = max(flushed_generation, generation)
+        flush_cond.notify_all()
+
+def wait_durable(ticket: Optional[int]):
+    '''
+    Blocks until the changes behind a ticket returned by commit() are written
+    '''
+    if ticket is None:
+        return
+    with flush_cond:
+        flush_cond.wait_for(lambda: flushed_generation >= ticket)
+
+def locked(function: Callable) -> Callable:
+    '''
+    Wraps a function that changes the collections outside of a request, such
+    as a threading.Timer callback, so that it runs holding lock. Its changes
+    are persisted by the next commit, or by the flusher once one is running.
+    '''
+    def run_locked(*args, **kwargs):
+        with lock:
+            return function(*args, **kwargs)
+    return run_locked
+
+@contextmanager
+def unlocked():
+    '''
+    Lets other requests run while the current one waits on slow work that
+    does not touch the collections. Anything read from the collections
+    before the block must be checked again after it.
+    '''
+    try:
+        lock.release()
+    except RuntimeError:
+        # Not held, as when the features are called directly
+        yield
+        return
+    try:
+        yield
+    finally:
+        lock.acquire()
+
+############################## STARTUP ##############################
+
+def load_db():
+    '''
+    Loads the last snapshot and replays the journal written since
+    '''
+    global journal_records, stale_shards, snapshot_lsn, next_lsn
+    stale_shards = None
+    if config.storage == 'sqlite':
+        sqlite_storage.load(users, channels, dms)
+    else:
+        source = load_snapshot(COLLECTIONS)
+        if source == 'sharded':
+            stale_shards = {collection: set() for collection in COLLECTIONS}
+        snapshot_lsn = read_checkpoint()
+        next_lsn = snapshot_lsn + 1
+        journal_records = replay_journal()
+    rebuild_indexes()
 
+load_db()
@@ -61,11 +61,11 @@ def dm_list_v1(token: Union[str, bytes]) -> list:
     auth_user_id = token_decoded['auth_user_id']
     helper.user_check(auth_user_id)
 
-    related_dms = list(filter(lambda dm: auth_user_id in dm['members'], dms.values()))
-    owners = list(filter(lambda dm: auth_user_id == dm['owner'], dms.values()))
-    related_dms = related_dms + owners
-    related_dms = list(map(lambda dm: {'dm_id': dm['dm_id'], 'name': dm['name']}, related_dms))
-    return related_dms
+    # The dms the user is a member of, then the dms they own
+    dm_ids = helper.dms_include_user(auth_user_id)
+    related_dms = [dm_id for dm_id in dm_ids if auth_user_id in dms[dm_id]['members']]
+    owners = [dm_id for dm_id in dm_ids if auth_user_id == dms[dm_id]['owner']]
+    return [{'dm_id': dm_id, 'name': dms[dm_id]['name']} for dm_id in related_dms + owners]
  
 
 def dm_create_v1(token: Union[str, bytes], u_ids: list) -> dict:
@@ -99,13 +99,13 @@ def dm_create_v1(token: Union[str, bytes], u_ids: list) -> dict:
     u_handles = sorted(u_handles)
     name = ','.join(u_handles)
 
-    dms[dm_id] = {
+    helper.add_dm(dm_id, {
         'dm_id': dm_id,
         'name': name,
         'owner': auth_user_id,
         'members': u_ids,
         'messages': []
-    }
+    })
     
     for u_id in u_ids:
         notify(token_decoded['auth_user_id'], u_id, -1, dm_id, "", False)
@@ -143,7 +143,7 @@ def dm_remove_v1(token: Union[str, bytes], dm_id: int) -> dict:
     helper.dm_check(dm_id)
     helper.user_own_dm_check(auth_user_id, dm_id)
 
-    del dms[dm_id]
+    helper.remove_dm(dm_id)
     return {}
 
 def dm_invite_v1(token: Union[str, bytes], dm_id: int, u_id: int) -> dict:
@@ -180,8 +180,8 @@ def dm_invite_v1(token: Union[str, bytes], dm_id: int, u_id: int) -> dict:
     helper.user_check(u_id)
 
     # Add user with u_id
-    if u_id not in dms[dm_id]['members'] and u_id != dms[dm_id]['owner']:
-        dms[dm_id]['members'].append(u_id)
+    if not helper.is_dm_member(u_id, dm_id):
+        helper.add_dm_member(u_id, dm_id)
         notify(token_decoded['auth_user_id'], u_id, -1, dm_id, "", False)
 
     return {}
@@ -213,11 +213,7 @@ def dm_leave_v1(token: Union[str, bytes], dm_id: int) -> dict:
     helper.dm_check(dm_id)
     helper.user_in_dm_check(auth_user_id, dm_id)
     
-    if auth_user_id == dms[dm_id]['owner']:
-        dms[dm_id]['owner'] = None
-    else:
-        idx = dms[dm_id]['members'].index(auth_user_id)
-        del dms[dm_id]['members'][idx]
+    helper.remove_dm_user(auth_user_id, dm_id)
 
     return {}
 
@@ -251,26 +247,21 @@ def dm_messages_v1(token: Union[str, bytes], dm_id: int, start: int) -> dict:
     helper.dm_check(dm_id)
     helper.user_in_dm_check(token_decoded['auth_user_id'], dm_id)
 
-    message_list = [message for message in dms[dm_id]['messages']]
+    message_list = dms[dm_id]['messages']
     if start < 0 or start > len(message_list):
         raise InputError('Invalid Index Value: Message index does not exist')
 
-    # Change 'is_this_user_reacted'
-    u_id = helper.check_token(token)['auth_user_id']
-    for m in dms[dm_id]['messages']:
-        if u_id in message_list:
-            m['reacts'][0]['is_this_user_reacted'] = True
-        else:
-            m['reacts'][0]['is_this_user_reacted'] = False
-
     # Assuming 0 < start < len(message_list)
-    if len(message_list[start:]) < 50:
+    if len(message_list) - start < 50:
         end = -1
     else:
         end = start + 50
 
+    # Messages are counted from the newest. 'is_this_user_reacted' is set on
+    # copies, so reading never changes the stored messages
+    page = helper.newest_first(message_list, start, start + 50)
     return {
-        'messages': message_list[start:] if end == -1 else message_list[start:end],
+        'messages': [helper.message_view(m, token_decoded['auth_user_id']) for m in page],
         'start': start,
         'end': end
     }
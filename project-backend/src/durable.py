@@ -0,0 +1,54 @@
+'''
+Crash-safe file writes for the snapshots and the journal
+'''
+import os
+from contextlib import contextmanager
+from typing import Union, BinaryIO, Iterator
+
+def fsync_directory(path: str):
+    '''
+    Makes the creation, rename or removal of the file at path durable
+    '''
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def write_atomic(path: str, data: Union[str, bytes], sync_directory: bool = True) -> int:
+    '''
+    Replaces the file at path with data, returning the number of bytes or
+    characters written. The data goes to a temporary file that is fsynced and
+    then renamed over path, so after a crash path holds either the old data
+    or the new, never a mix. Pass sync_directory=False when writing several
+    files to one directory, and call fsync_directory() once at the end.
+    '''
+    tmp_path = path + '.tmp'
+    binary = isinstance(data, bytes)
+    with open(tmp_path, 'wb' if binary else 'w', encoding=None if binary else 'utf-8') as FILE:
+        written = FILE.write(data)
+        FILE.flush()
+        os.fsync(FILE.fileno())
+    os.replace(tmp_path, path)
+    if sync_directory:
+        fsync_directory(path)
+    return written
+
+@contextmanager
+def atomic_file(path: str) -> Iterator[BinaryIO]:
+    '''
+    Binary file to stream the new contents of path into, with the same
+    guarantees as write_atomic(); path is only replaced if the block
+    completes
+    '''
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as FILE:
+        yield FILE
+        FILE.flush()
+        os.fsync(FILE.fileno())
+    os.replace(tmp_path, path)
+    fsync_directory(path)
+
+def rename(path: str, new_path: str):
+    os.replace(path, new_path)
+    fsync_directory(new_path)
@@ -7,3 +7,11 @@ class AccessError(HTTPException):
 class InputError(HTTPException):
     code = 400
     message = 'No message specified'
+
+class RouteContractError(HTTPException):
+    code = 500
+    message = 'No message specified'
+
+class ServiceUnavailableError(HTTPException):
+    code = 503
+    message = 'No message specified'
@@ -1,25 +1,193 @@
 import jwt
-from time import time
+import random
+import threading
+import contextvars
+from time import time, sleep
 from datetime import datetime
-from src.data import users, channels, dms
+from collections import OrderedDict
+from src import config
+from src import metrics
+from src import snowflake
+from src.data import users, channels, dms, sessions, session_times, session_wheel, \
+    session_issued, session_expiry, index_session, unindex_session, emails, email_key, \
+    handles, handle_suffixes, reset_codes, reset_wheel, free_reset_codes, channel_members, channel_owners, \
+    user_channels, user_dms, index_channel, index_dm, unindex_dm, unindex_messages, mark_dirty, locked
 from src.error import InputError, AccessError
-from typing import Union, NoReturn
+from typing import Union, NoReturn, Optional
 
 #secret for token
 SECRET = 'This is a very safe secret'
 
-def check_token(token: Union[str, bytes]) -> dict:
+# Token of the request being served and its session_id (None if its
+# signature is invalid), set by begin_request()
+request_auth = contextvars.ContextVar('request_auth', default=None)
+
+class TokenCache:
+    '''
+    Bounded, thread-safe LRU of verified tokens of active sessions, as
+    token -> session_id, with tokens given as bytes keyed by their str form.
+    Entries are evicted as soon as their session ends.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        # session_id -> set of the cached tokens of the session
+        self.tokens = {}
+
+    def get(self, token: Union[str, bytes]) -> Optional[str]:
+        token = token_key(token)
+        with self.lock:
+            session_id = self.entries.get(token)
+            if session_id is not None:
+                self.entries.move_to_end(token)
+        metrics.increment('token_cache_hits' if session_id is not None else 'token_cache_misses')
+        return session_id
+
+    def put(self, token: Union[str, bytes], session_id: str):
+        token = token_key(token)
+        evicted = 0
+        with self.lock:
+            self.entries[token] = session_id
+            self.tokens.setdefault(session_id, set()).add(token)
+            while len(self.entries) > config.token_cache_size:
+                old_token, old_session_id = self.entries.popitem(last=False)
+                self.forget(old_token, old_session_id)
+                evicted += 1
+        if evicted:
+            metrics.increment('token_cache_evictions', evicted)
+
+    def forget(self, token: str, session_id: str):
+        tokens = self.tokens.get(session_id, set())
+        tokens.discard(token)
+        if not tokens:
+            self.tokens.pop(session_id, None)
+
+    def evict(self, session_id: str):
+        with self.lock:
+            tokens = self.tokens.pop(session_id, set())
+            for token in tokens:
+                del self.entries[token]
+        if tokens:
+            metrics.increment('token_cache_evictions', len(tokens))
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.tokens.clear()
+
+def token_key(token: Union[str, bytes]) -> str:
+    # latin-1 decodes any bytes, and valid tokens are ascii so decode the same
+    return token.decode('latin-1') if isinstance(token, bytes) else token
+
+token_cache = TokenCache()
+
+def begin_request(token: Union[str, bytes, None]):
+    '''
+    Verifies the token of a request once, so that the auth checks made
+    while serving it do not verify it again. Returns the value to pass to
+    end_request() when the request is done.
+    '''
+    if token is None:
+        return None
+    try:
+        session_id = decode_session(token)
+    except jwt.PyJWTError:
+        # Left for the request's own checks to report
+        return None
+    return request_auth.set((token, session_id))
+
+def end_request(reset) -> None:
+    if reset is not None:
+        request_auth.reset(reset)
+
+def decode_session(token: Union[str, bytes]) -> Optional[str]:
+    '''
+    Verifies a token and returns its session_id, or None if its signature
+    is invalid
+    '''
+    context = request_auth.get()
+    if context is not None and context[0] == token:
+        return context[1]
+    session_id = token_cache.get(token)
+    if session_id is not None:
+        return session_id
     try:
-        payload = jwt.decode(token, SECRET, algorithms=["HS256"])
-        session_id = payload['session_id'] 
-        status = True
-        for user in users:
-            if session_id in users[user]['session_id']:
-                return {'status' : status, 'auth_user_id' : user}
-        user = None
+        session_id = jwt.decode(token, SECRET, algorithms=["HS256"])['session_id']
     except jwt.InvalidSignatureError:
-        status = False
-    return {'status' : status, 'auth_user_id' : None}
+        return None
+    if session_id in sessions:
+        token_cache.put(token, session_id)
+    return session_id
+
+def check_token(token: Union[str, bytes]) -> dict:
+    session_id = decode_session(token)
+    if session_id is None:
+        return {'status' : False, 'auth_user_id' : None}
+    auth_user_id = sessions.get(session_id)
+    if auth_user_id is not None:
+        now = time()
+        if session_expiry(session_id) <= now:
+            # Expired, and left for the sweeper to remove
+            auth_user_id = None
+        else:
+            session_times[session_id][1] = now
+    return {'status' : True, 'auth_user_id' : auth_user_id}
+
+def add_session(auth_user_id: int, session_id: str):
+    '''
+    Starts a session for the user, ending their least recently used
+    sessions beyond config.sessions_per_user
+    '''
+    user_sessions = users[auth_user_id]['session_id']
+    while user_sessions and len(user_sessions) >= config.sessions_per_user:
+        remove_session(min(user_sessions, key=lambda old: session_times.get(old, (0, 0))[1]))
+        metrics.increment('sessions_evicted')
+    now = time()
+    user_sessions.append(session_id)
+    index_session(session_id, auth_user_id, session_issued(session_id, now), now)
+    mark_dirty('users', auth_user_id)
+    metrics.set_value('sessions_live', len(sessions))
+    start_sweeper()
+
+def remove_session(session_id: str) -> bool:
+    '''
+    Ends a session, returning whether it was active
+    '''
+    auth_user_id = unindex_session(session_id)
+    if auth_user_id is None:
+        return False
+    token_cache.evict(session_id)
+    users[auth_user_id]['session_id'].remove(session_id)
+    mark_dirty('users', auth_user_id)
+    metrics.set_value('sessions_live', len(sessions))
+    return True
+
+def remove_all_sessions(auth_user_id: int):
+    '''
+    Ends every session of the user
+    '''
+    for session_id in users[auth_user_id]['session_id']:
+        unindex_session(session_id)
+        token_cache.evict(session_id)
+    users[auth_user_id]['session_id'].clear()
+    mark_dirty('users', auth_user_id)
+    metrics.set_value('sessions_live', len(sessions))
+
+def expire_sessions(now: Optional[float] = None):
+    '''
+    Ends the sessions that expired by now
+    '''
+    now = time() if now is None else now
+    for session_id in session_wheel.advance(now):
+        if session_id not in sessions:
+            continue
+        expiry = session_expiry(session_id)
+        if expiry > now:
+            # Used since it was scheduled
+            session_wheel.schedule(session_id, expiry)
+        else:
+            remove_session(session_id)
+            metrics.increment('sessions_expired')
 
 def token_check(token: Union[str, bytes]) -> None:
     '''
@@ -29,14 +197,106 @@ def token_check(token: Union[str, bytes]) -> None:
     if token_decoded['status'] is False or token_decoded['auth_user_id'] is None:
         raise AccessError(description='Invalid Token: Token does not exist')
 
+def find_email(email: str) -> Optional[int]:
+    '''
+    u_id of the user with the given email, if any
+    '''
+    return emails.get(email_key(email))
+
+def set_email(auth_user_id: int, email: str):
+    '''
+    Changes the user's email
+    '''
+    old_key = email_key(users[auth_user_id]['email'])
+    if emails.get(old_key) == auth_user_id:
+        del emails[old_key]
+    users[auth_user_id]['email'] = email
+    emails[email_key(email)] = auth_user_id
+    mark_dirty('users', auth_user_id)
+
+def new_reset_code(auth_user_id: int) -> str:
+    '''
+    Issues the user a reset code, unique among the unredeemed codes, that
+    expires after config.reset_code_ttl seconds. A user's oldest code makes
+    way once they hold config.reset_codes_per_user, and the oldest code of
+    all once every code is taken.
+    '''
+    issued = users[auth_user_id]['reset_code']
+    while issued and len(issued) >= config.reset_codes_per_user:
+        remove_reset_code(issued[0])
+    if not free_reset_codes:
+        remove_reset_code(next(iter(reset_codes)))
+    pick = random.randrange(len(free_reset_codes))
+    free_reset_codes[pick], free_reset_codes[-1] = free_reset_codes[-1], free_reset_codes[pick]
+    reset_code = free_reset_codes.pop()
+    expiry = time() + config.reset_code_ttl
+    users[auth_user_id]['reset_code'].append(reset_code)
+    reset_codes[reset_code] = (auth_user_id, expiry)
+    reset_wheel.schedule(reset_code, expiry)
+    mark_dirty('users', auth_user_id)
+    start_sweeper()
+    return reset_code
+
+def reset_code_user(reset_code: str) -> Optional[int]:
+    '''
+    u_id of the user a reset code was issued to, if it has not expired
+    '''
+    u_id, expiry = reset_codes.get(reset_code, (None, None))
+    if u_id is None or expiry <= time():
+        return None
+    return u_id
+
+def remove_reset_code(reset_code: str):
+    '''
+    Revokes an unredeemed reset code, freeing it to be issued again
+    '''
+    u_id, _ = reset_codes.pop(reset_code)
+    reset_wheel.cancel(reset_code)
+    free_reset_codes.append(reset_code)
+    users[u_id]['reset_code'].remove(reset_code)
+    mark_dirty('users', u_id)
+
+def expire_reset_codes(now: Optional[float] = None):
+    '''
+    Removes the reset codes that expired by now
+    '''
+    for reset_code in reset_wheel.advance(time() if now is None else now):
+        u_id, _ = reset_codes.pop(reset_code)
+        free_reset_codes.append(reset_code)
+        users[u_id]['reset_code'].remove(reset_code)
+        mark_dirty('users', u_id)
+
+def sweep(now: Optional[float] = None):
+    '''
+    Removes the reset codes and sessions that expired by now
+    '''
+    now = time() if now is None else now
+    expire_reset_codes(now)
+    expire_sessions(now)
+
+sweeper = None
+sweeper_lock = threading.Lock()
+
+def start_sweeper():
+    global sweeper
+    with sweeper_lock:
+        if sweeper is None:
+            sweeper = threading.Thread(target=sweep_loop, name='sweeper', daemon=True)
+            sweeper.start()
+
+def sweep_loop():
+    sweep_locked = locked(sweep)
+    while True:
+        sleep(config.sweep_s)
+        sweep_locked()
+
 def user_check(auth_user_id: int) -> Union[bool, NoReturn]:
     '''
     Checks for valid auth_user_id
     '''
-    for user in users:
-        if int(auth_user_id) == user:
-            return True
-    raise InputError(description='Invalid User: User does not exist')
+    if int(auth_user_id) not in users:
+        raise InputError(description='Invalid User: User does not exist')
+    return True
 
 def channel_check(channel_id: int):
     '''
@@ -56,15 +316,14 @@ def user_in_channel_check(auth_user_id: int, channel_id: int):
     '''
     Checks if user is in channel
     '''
-    info = user_info(auth_user_id)
-    if info not in channels[channel_id]['all_members']:
+    if auth_user_id not in channel_members[channel_id]:
         raise AccessError(description='Invalid User: User is not in channel list')
 
 def user_in_dm_check(auth_user_id: int, dm_id: int):
     '''
     Checks if user is in dm
     '''
-    if auth_user_id != dms[dm_id]['owner'] and auth_user_id not in dms[dm_id]['members']:
+    if not is_dm_member(auth_user_id, dm_id):
         raise AccessError(description='Invalid User: User is not in dm list')
 
 def user_own_dm_check(auth_user_id: int, dm_id: int):
@@ -91,42 +350,170 @@ def channel_info(channel_id: int) -> dict:
     }
 
 def check_handle(handle: str) -> Union[int, None]:
-    for user in users:
-        if users[user]['handle_str'] == handle:
-            return user
-    return None
+    return handles.get(handle)
+
+def set_handle(auth_user_id: int, handle: str):
+    '''
+    Changes the user's handle
+    '''
+    old_handle = users[auth_user_id]['handle_str']
+    if handles.get(old_handle) == auth_user_id:
+        del handles[old_handle]
+        free_handle(old_handle)
+    users[auth_user_id]['handle_str'] = handle
+    handles[handle] = auth_user_id
+    mark_dirty('users', auth_user_id)
+
+def unique_handle(base: str) -> str:
+    '''
+    First handle not taken out of base, base0, base1, ...
+    '''
+    suffix = handle_suffixes.get(base, -1)
+    handle = base if suffix == -1 else base + str(suffix)
+    while handle in handles:
+        suffix += 1
+        handle = base + str(suffix)
+    handle_suffixes[base] = suffix
+    return handle
+
+def free_handle(handle: str):
+    '''
+    Lets unique_handle() hand out a handle that is no longer taken
+    '''
+    if handle in handle_suffixes:
+        handle_suffixes[handle] = -1
+    for split in range(1, len(handle)):
+        base, suffix = handle[:split], handle[split:]
+        if base in handle_suffixes and suffix.isascii() and suffix.isdigit() \
+                and str(int(suffix)) == suffix:
+            handle_suffixes[base] = min(handle_suffixes[base], int(suffix))
+
+def add_channel(channel_id: int, channel: dict):
+    channels[channel_id] = channel
+    index_channel(channel_id, channel)
+    mark_dirty('channels', channel_id)
+
+def is_member(u_id: int, channel_id: int) -> bool:
+    return u_id in channel_members[channel_id]
+
+def is_owner(u_id: int, channel_id: int) -> bool:
+    return u_id in channel_owners[channel_id]
+
+def add_member(u_id: int, channel_id: int, owner: bool = False):
+    '''
+    Adds a user to a channel, and to its owners when owner is set
+    '''
+    if u_id not in channel_members[channel_id]:
+        channel_members[channel_id].add(u_id)
+        user_channels.setdefault(u_id, set()).add(channel_id)
+        channels[channel_id]['all_members'].append(u_id)
+    if owner and u_id not in channel_owners[channel_id]:
+        channel_owners[channel_id].add(u_id)
+        channels[channel_id]['owner_members'].append(u_id)
+    mark_dirty('channels', channel_id)
+
+def remove_owner(u_id: int, channel_id: int):
+    if u_id in channel_owners[channel_id]:
+        channel_owners[channel_id].discard(u_id)
+        channels[channel_id]['owner_members'].remove(u_id)
+        mark_dirty('channels', channel_id)
+
+def remove_member(u_id: int, channel_id: int):
+    '''
+    Removes a user from a channel, and from its owners if they were one
+    '''
+    remove_owner(u_id, channel_id)
+    if u_id in channel_members[channel_id]:
+        channel_members[channel_id].discard(u_id)
+        user_channels[u_id].discard(channel_id)
+        channels[channel_id]['all_members'].remove(u_id)
+        mark_dirty('channels', channel_id)
+
+def is_dm_member(u_id: int, dm_id: int) -> bool:
+    '''
+    Whether a user owns or is a member of a dm
+    '''
+    return dm_id in user_dms.get(u_id, ())
+
+def add_dm(dm_id: int, dm: dict):
+    dms[dm_id] = dm
+    index_dm(dm_id, dm)
+    mark_dirty('dms', dm_id)
+
+def remove_dm(dm_id: int):
+    dm = dms.pop(dm_id)
+    unindex_dm(dm_id, dm)
+    unindex_messages('dms', dm_id, dm)
+    mark_dirty('dms', dm_id)
+
+def add_dm_member(u_id: int, dm_id: int):
+    if not is_dm_member(u_id, dm_id):
+        dms[dm_id]['members'].append(u_id)
+        user_dms.setdefault(u_id, set()).add(dm_id)
+        mark_dirty('dms', dm_id)
+
+def remove_dm_user(u_id: int, dm_id: int):
+    '''
+    Removes a user from a dm, as its owner and as a member
+    '''
+    dm = dms[dm_id]
+    if dm['owner'] == u_id:
+        dm['owner'] = None
+    while u_id in dm['members']:
+        dm['members'].remove(u_id)
+    user_dms.get(u_id, set()).discard(dm_id)
+    mark_dirty('dms', dm_id)
+
+def member_profiles(u_ids: list) -> list:
+    '''
+    Profiles of the given members, as they are now
+    '''
+    return [user_info(u_id) for u_id in u_ids]
 
 def user_own_channel_check(auth_user_id: int, channel_id: int) -> None:
     '''
     Checks if user is the owner of channel
     '''
-    if user_info(auth_user_id) not in channels[channel_id]['owner_members']:
+    if auth_user_id not in channel_owners[channel_id]:
         raise AccessError(description='Invalid User: User is not the owner')
 
 def uniqid() -> int:
-    x=time()*10000000
-    return int(x)
+    '''
+    New unique, time-ordered id (see src/snowflake.py)
+    '''
+    return snowflake.next_id()
     
+def newest_first(messages: list, start: int, end: int) -> list:
+    '''
+    Messages start to end (not included) of a message list counting back
+    from its newest message, newest first. Message lists are kept oldest
+    first, so this is a slice off their end.
+    '''
+    stop = max(len(messages) - start, 0)
+    return messages[max(len(messages) - end, 0):stop][::-1]
+
+def message_view(message: dict, auth_user_id: int) -> dict:
+    '''
+    copy of a stored message as seen by the given user, leaving the stored
+    message untouched
+    '''
+    view = dict(message)
+    view['reacts'] = [dict(react, is_this_user_reacted=auth_user_id in react['u_ids']) \
+        for react in message['reacts']]
+    return view
+
 def channels_include_user(auth_user_id: int) -> list:
     '''
     checking for which channels the user is included in 
     '''
-    user_channels = []
-    info = user_info(auth_user_id)
-    for channel_id in channels:
-        if info in channels[channel_id]['all_members']:
-            user_channels.append(channel_id)
-    return user_channels 
+    # ids are time-ordered, so this is the order the channels were made in
+    return sorted(user_channels.get(auth_user_id, ()))
 
 def dms_include_user(auth_user_id: int) -> list:
     '''
     checking for user in all dms 
     '''
-    user_dms = []
-    for dm_id in dms:
-        if auth_user_id == dms[dm_id]['owner'] or auth_user_id in dms[dm_id]['members']:
-            user_dms.append(dm_id)
-    return user_dms 
+    return sorted(user_dms.get(auth_user_id, ()))
             
 def num_users_in_at_least_1_channel_or_dm():
     '''
@@ -134,7 +521,7 @@ def num_users_in_at_least_1_channel_or_dm():
     '''
     num_users = 0
     for auth_user_id in users:
-        if len(channels_include_user(auth_user_id)) > 0 or len(dms_include_user(auth_user_id)) > 0: 
+        if user_channels.get(auth_user_id) or user_dms.get(auth_user_id):
             num_users += 1
     return num_users
 
@@ -143,9 +530,9 @@ def num_messages_exist():
     counting all existing messages sent 
     '''
     total_messages = 0
-    for channel_id in channels:
-        total_messages += len(channels[channel_id]['messages'])
-    for dm_id in dms:
-        total_messages += len(dms[dm_id]['messages'])
+    for channel in channels.values():
+        total_messages += len(channel['messages'])
+    for dm in dms.values():
+        total_messages += len(dm['messages'])
     return total_messages
     
@@ -0,0 +1,226 @@
+'''
+Persistent outbound mail queue.
+
+enqueue() appends the message to the spool file (config.mail_spool_path)
+and returns, so requests never wait on the mail server. A background
+sender thread sends the queued messages in batches of up to
+config.mail_batch over one SMTP connection, which it keeps open for
+config.mail_idle_s seconds after the last batch. When sending fails the
+connection is dropped, and the batch is retried after a backoff that
+doubles from config.mail_retry_s up to config.mail_retry_max_s. A message
+is dropped after config.mail_max_attempts failed attempts.
+
+The spool holds one JSON line per event:
+    {"op": "queue", "id": ..., "from": ..., "to": ..., "body": ...}
+    {"op": "done", "id": ..., "sent": true|false}
+so messages queued but not done when the server stopped are sent after it
+restarts. Once every queued message is done the spool is emptied.
+'''
+import os
+import json
+import atexit
+import smtplib
+import threading
+from time import monotonic
+from typing import Optional
+
+from src import config
+from src import durable
+from src import metrics
+
+# Messages queued and not yet done, by id, in the order they were queued
+pending = {}
+attempts = {}
+next_id = 1
+spool_loaded = False
+
+cond = threading.Condition()
+sender = None
+connection = None
+
+def append_spool(*records: dict):
+    with open(config.mail_spool_path, 'a', encoding='utf-8') as FILE:
+        FILE.write(''.join(json.dumps(record) + '\n' for record in records))
+        FILE.flush()
+        os.fsync(FILE.fileno())
+
+def load_spool():
+    '''
+    Reads back the messages left queued in the spool
+    '''
+    global next_id, spool_loaded
+    spool_loaded = True
+    try:
+        with open(config.mail_spool_path, 'r', encoding='utf-8') as FILE:
+            lines = FILE.read().splitlines()
+    except FileNotFoundError:
+        return
+    for line in lines:
+        try:
+            record = json.loads(line)
+        except ValueError:
+            # A line cut short by a crash while it was being appended
+            continue
+        if record['op'] == 'queue':
+            pending[record['id']] = record
+            next_id = max(next_id, record['id'] + 1)
+        else:
+            pending.pop(record['id'], None)
+
+def enqueue(sender_address: str, recipient: str, body: str) -> int:
+    '''
+    Queues a message to be sent, returning its id
+    '''
+    global next_id
+    with cond:
+        if not spool_loaded:
+            load_spool()
+        record = {'op': 'queue', 'id': next_id, 'from': sender_address, 'to': recipient, 'body': body}
+        next_id += 1
+        append_spool(record)
+        pending[record['id']] = record
+        metrics.increment('mail_queued')
+        start_sender()
+        cond.notify_all()
+    return record['id']
+
+def finish(message_id: int, sent: bool):
+    '''
+    Records that a message was sent, or given up on
+    '''
+    with cond:
+        pending.pop(message_id, None)
+        attempts.pop(message_id, None)
+        if pending:
+            append_spool({'op': 'done', 'id': message_id, 'sent': sent})
+        else:
+            durable.write_atomic(config.mail_spool_path, '')
+        cond.notify_all()
+    metrics.increment('mail_sent' if sent else 'mail_dropped')
+
+def connect() -> smtplib.SMTP:
+    smtp = smtplib.SMTP(config.mail_host, config.mail_port, timeout=config.mail_timeout_s)
+    if config.mail_starttls:
+        smtp.starttls()
+    if config.mail_user:
+        smtp.login(config.mail_user, config.mail_password)
+    metrics.increment('mail_connections')
+    return smtp
+
+def disconnect():
+    global connection
+    if connection is not None:
+        try:
+            connection.quit()
+        except (smtplib.SMTPException, OSError):
+            connection.close()
+        connection = None
+
+def send_batch(batch: list):
+    '''
+    Sends a batch over the open connection, opening one if needed. Raises
+    on the first message that fails.
+    '''
+    global connection
+    if connection is None:
+        try:
+            connection = connect()
+        except (smtplib.SMTPException, OSError):
+            # None of the batch could be sent, so a server that stays
+            # unreachable drops the messages rather than retrying forever
+            for message in batch:
+                count_attempt(message)
+            raise
+    for message in batch:
+        try:
+            connection.sendmail(message['from'], message['to'], message['body'])
+        except smtplib.SMTPRecipientsRefused:
+            # Retrying will not help
+            finish(message['id'], False)
+            continue
+        except (smtplib.SMTPException, OSError):
+            count_attempt(message)
+            raise
+        finish(message['id'], True)
+
+def count_attempt(message: dict):
+    '''
+    Counts a failed attempt to send a message, dropping it after
+    config.mail_max_attempts
+    '''
+    attempts[message['id']] = attempts.get(message['id'], 0) + 1
+    if attempts[message['id']] >= config.mail_max_attempts:
+        finish(message['id'], False)
+
+def start_sender():
+    global sender
+    with cond:
+        if not spool_loaded:
+            load_spool()
+        if sender is None:
+            sender = threading.Thread(target=send_loop, name='mail-sender', daemon=True)
+            sender.start()
+
+def stop_sender():
+    '''
+    Stops the sender once it is done with the batch it is sending; queued
+    messages stay in the spool
+    '''
+    global sender
+    with cond:
+        thread, sender = sender, None
+        cond.notify_all()
+    if thread is not None and thread is not threading.current_thread():
+        thread.join()
+
+atexit.register(stop_sender)
+
+def wait(seconds: Optional[float], ready) -> None:
+    '''
+    Waits on cond, holding it, until ready() or the sender is stopped, for
+    at most seconds (None for no limit)
+    '''
+    deadline = None if seconds is None else monotonic() + seconds
+    while not ready() and sender is threading.current_thread():
+        remaining = None if deadline is None else deadline - monotonic()
+        if remaining is not None and remaining <= 0:
+            return
+        cond.wait(remaining)
+
+def send_loop():
+    failures = 0
+    while True:
+        with cond:
+            wait(config.mail_idle_s if connection is not None else None, lambda: pending)
+            if sender is not threading.current_thread():
+                break
+            batch = list(pending.values())[:config.mail_batch]
+        if not batch:
+            # Idle for mail_idle_s with the connection open
+            disconnect()
+            continue
+        try:
+            send_batch(batch)
+            failures = 0
+        except (smtplib.SMTPException, OSError):
+            disconnect()
+            metrics.increment('mail_retries')
+            delay = min(config.mail_retry_max_s, config.mail_retry_s * 2 ** failures)
+            failures += 1
+            with cond:
+                wait(delay, lambda: False)
+    disconnect()
+
+def flush(timeout: Optional[float] = None) -> bool:
+    '''
+    Waits until every queued message is done, returning whether they were
+    within timeout seconds
+    '''
+    deadline = None if timeout is None else monotonic() + timeout
+    with cond:
+        while pending:
+            remaining = None if deadline is None else deadline - monotonic()
+            if remaining is not None and remaining <= 0:
+                return False
+            cond.wait(remaining)
+    return True
@@ -5,7 +5,8 @@ import uuid
 import threading
 from typing import Union, Optional
 from datetime import datetime
-from src.data import users, channels, dms
+from src.data import users, channels, dms, mark_dirty, locked, locate_message, \
+    index_message, remove_message
 from src.error import InputError, AccessError
 import src.helper as helper
 from src.other import notify, notify_react
@@ -86,12 +87,8 @@ def message_remove_v1(token: Union[str, bytes], message_id: int) -> dict:
         None
     '''
     
-    msg_idx, msg, msg_in_channel = message_errors(token, message_id)
-
-    if msg_in_channel:
-        del channels[msg['dest_id']]['messages'][msg_idx]
-    else:
-        del dms[msg['dest_id']]['messages'][msg_idx]
+    msg, msg_in_channel = message_errors(token, message_id)
+    remove_message_from_db(msg, msg_in_channel)
 
     return {}
 
@@ -114,21 +111,19 @@ def message_edit_v1(token: Union[str, bytes], message_id: int, edited_message: s
     '''
     token_decoded = helper.check_token(token)
 
-    msg_idx, msg, msg_in_channel = message_errors(token, message_id)
+    msg, msg_in_channel = message_errors(token, message_id)
 
     if len(edited_message) > 1000:
         raise InputError('Invalid Message: Message must be within 1000 characters')
-    elif len(edited_message) == 0: # Delete message at message index in list
-        if msg_in_channel:
-            del channels[msg['dest_id']]['messages'][msg_idx]
-        else:
-            del dms[msg['dest_id']]['messages'][msg_idx]
+    elif len(edited_message) == 0: # Delete message
+        remove_message_from_db(msg, msg_in_channel)
     else: # Edit message
+        msg['message'] = edited_message
         if msg_in_channel:
-            channels[msg['dest_id']]['messages'][msg_idx]['message'] = edited_message
+            mark_dirty('channels', msg['dest_id'], message_id)
             check_message_tags(edited_message, token_decoded['auth_user_id'], msg['dest_id'], -1)
         else:
-            dms[msg['dest_id']]['messages'][msg_idx]['message'] = edited_message
+            mark_dirty('dms', msg['dest_id'], message_id)
             check_message_tags(edited_message, token_decoded['auth_user_id'], -1, msg['dest_id'])
 
     return {}
@@ -156,13 +151,9 @@ def message_share_v1(token: Union[str, bytes], og_message_id: int, optional_mess
 
     token_decoded = helper.check_token(token)
 
-    msg_idx, msg, msg_in_channel = message_errors(token, og_message_id)
-    new_message = ''
+    msg, _ = message_errors(token, og_message_id)
     # Extract message from og_message_id and assign to new_message string
-    if msg_in_channel:
-        new_message = channels[msg['dest_id']]['messages'][msg_idx]['message']
-    else:
-        new_message = dms[msg['dest_id']]['messages'][msg_idx]['message']
+    new_message = msg['message']
 
     # Identify if there is an additional optional message
     if optional_message != '':
@@ -236,7 +227,7 @@ def message_send_later_v1(token: Union[str, bytes], ch_or_dm_id: int, message: s
         'is_pinned': False
     }
 
-    threading.Timer(wait_time, add_message_to_db, args=[message_info, ch_or_dm_id, #
+    threading.Timer(wait_time, locked(add_message_to_db), args=[message_info, ch_or_dm_id, #
                     token_decoded['auth_user_id'], to_channel]).start()
 
     return message_id
@@ -271,19 +262,17 @@ def message_react_v1(token: Union[str, bytes], message_id: int, react_id: int) -
     if react_id is not REACT:
         raise InputError('react_id is not a valid React ID')
     
-    m_in_channel = message_channel_check(message_id)
-    m_in_dm = message_dm_check(message_id)
-    if m_in_channel is not None or m_in_dm is not None:
+    located = locate_message(message_id)
+    if located is not None:
+        collection, ch_or_dm_id, m = located
 
         #The authorised user is not a member of the channel or DM that the message is within
         u_id = helper.check_token(token)['auth_user_id']
-        if m_in_channel is None:
-            m = m_in_dm[1]
-            dm_id = m_in_dm[2]
+        if collection == 'dms':
+            dm_id = ch_or_dm_id
             helper.user_in_dm_check(u_id, dm_id)
         else:
-            m = m_in_channel[1]
-            ch_id = m_in_channel[2]
+            ch_id = ch_or_dm_id
             helper.user_in_channel_check(u_id, ch_id)
 
         #Message with ID message_id already contains an active React with ID react_id from the authorised user
@@ -294,9 +283,11 @@ def message_react_v1(token: Union[str, bytes], message_id: int, react_id: int) -
         m['reacts'][0]['u_ids'].append(u_id)
         m_uid = m['u_id']
         handle = helper.user_info(u_id)['handle_str']
-        if m_in_channel is None:
+        if collection == 'dms':
+            mark_dirty('dms', dm_id, message_id)
             notify_react(u_id, m_uid, -1, dm_id, handle)
         else:
+            mark_dirty('channels', ch_id, message_id)
             notify_react(u_id, m_uid, ch_id, -1, handle)
                     
     # Check is message_id a valid message within a channel or DM that the authorised user has joined
@@ -335,18 +326,16 @@ def message_unreact_v1(token: Union[str, bytes], message_id: int, react_id: int)
         raise InputError(description='react_id is not a valid React ID')
     
     #Message with ID message_id already contains an active React with ID react_id from the authorised user
-    m_in_channel = message_channel_check(message_id)
-    m_in_dm = message_dm_check(message_id)
-    if m_in_channel is not None or m_in_dm is not None:
+    located = locate_message(message_id)
+    if located is not None:
+        collection, ch_or_dm_id, m = located
 
         #The authorised user is not a member of the channel or DM that the message is within
         u_id = helper.check_token(token)['auth_user_id']
-        if m_in_channel is None:
-            m = m_in_dm[1]
-            helper.user_in_dm_check(u_id, m_in_dm[2])
+        if collection == 'dms':
+            helper.user_in_dm_check(u_id, ch_or_dm_id)
         else:
-            m = m_in_channel[1]
-            helper.user_in_channel_check(u_id, m_in_channel[2])
+            helper.user_in_channel_check(u_id, ch_or_dm_id)
 
         #Message with ID message_id does not contain an active React with ID react_id from the authorised user
         if u_id not in m['reacts'][0]['u_ids']:
@@ -354,6 +343,7 @@ def message_unreact_v1(token: Union[str, bytes], message_id: int, react_id: int)
 
         #Unreact a message
         m['reacts'][0]['u_ids'].remove(u_id)
+        mark_dirty(collection, ch_or_dm_id, message_id)
 
     # Message with ID message_id does not contain an active React with ID react_id from the authorised user
     else:
@@ -383,45 +373,47 @@ def message_pin_unpin_v1(token: Union[str, bytes], message_id: int, pin: bool) -
     helper.token_check(token)
 
     # Destructure message_values
-    msg_in_channel = check_message_exists(message_id).get('in_channel')
-    msg_idx, _, ch_or_dm_id = check_message_exists(message_id).get('message_values')
+    located = check_message_exists(message_id)
+    msg_in_channel = located.get('in_channel')
+    msg, ch_or_dm_id = located.get('message_values')
 
     # Check authorisation: user must be a member and an owner of the channel/dm (2 separate errors)
     if (msg_in_channel):
-        user_info = helper.user_info(token_decoded['auth_user_id'])
-        if user_info not in channels[ch_or_dm_id]['all_members']:
+        if not helper.is_member(token_decoded['auth_user_id'], ch_or_dm_id):
             raise AccessError(description='Unauthorised User: User not a channel member')
-        elif user_info not in channels[ch_or_dm_id]['owner_members']:
+        elif not helper.is_owner(token_decoded['auth_user_id'], ch_or_dm_id):
             raise AccessError(description='Unauthorised User: User not a channel owner')
         
         if pin:
             # Raise error is message is already pinned
-            if channels[ch_or_dm_id]['messages'][msg_idx]['is_pinned']:
+            if msg['is_pinned']:
                 raise InputError(description='Error: Message is already pinned')
             else:
-                channels[ch_or_dm_id]['messages'][msg_idx]['is_pinned'] = True
+                msg['is_pinned'] = True
         else:
             # Raise error is message is already unpinned
-            if not channels[ch_or_dm_id]['messages'][msg_idx]['is_pinned']:
+            if not msg['is_pinned']:
                 raise InputError(description='Error: Message is already unpinned')
             else:
-                channels[ch_or_dm_id]['messages'][msg_idx]['is_pinned'] = False
+                msg['is_pinned'] = False
+        mark_dirty('channels', ch_or_dm_id, message_id)
     else: 
         if token_decoded['auth_user_id'] != dms[ch_or_dm_id]['owner']:
             raise AccessError(description='Unauthorised User: User not a dm owner')
         
         if pin:
             # Raise error is message is already pinned
-            if dms[ch_or_dm_id]['messages'][msg_idx]['is_pinned']:
+            if msg['is_pinned']:
                 raise InputError(description='Error: Message is already pinned')
             else:
-                dms[ch_or_dm_id]['messages'][msg_idx]['is_pinned'] = True
+                msg['is_pinned'] = True
         else:
             # Raise error is message is already unpinned
-            if not dms[ch_or_dm_id]['messages'][msg_idx]['is_pinned']:
+            if not msg['is_pinned']:
                 raise InputError(description='Error: Message is already unpinned')
             else:
-                dms[ch_or_dm_id]['messages'][msg_idx]['is_pinned'] = False
+                msg['is_pinned'] = False
+        mark_dirty('dms', ch_or_dm_id, message_id)
 
     return {}
     
@@ -437,59 +429,66 @@ def message_errors(token: Union[str, bytes], message_id: int) -> tuple:
                       is making changes.
 
     Return Value:
-        Tuple containing Message index and Message string
+        Tuple containing the Message and whether it is in a channel
     '''
 
     token_decoded = helper.check_token(token)
 
     # Destructure message_values
-    msg_in_channel = check_message_exists(message_id).get('in_channel')
-    msg_idx, msg, ch_or_dm_id = check_message_exists(message_id).get('message_values')
+    located = check_message_exists(message_id)
+    msg_in_channel = located.get('in_channel')
+    msg, ch_or_dm_id = located.get('message_values')
     
     helper.token_check(token)
     # Check authorisation: user is either the global owner of Dreams, message owner, or an owner of the channel/dm 
     if not users[token_decoded['auth_user_id']]['permission_id'] == 1 and token_decoded['auth_user_id'] != msg['u_id']:
-        if (msg_in_channel and helper.user_info(token_decoded['auth_user_id']) not in channels[ch_or_dm_id]['owner_members']) \
+        if (msg_in_channel and not helper.is_owner(token_decoded['auth_user_id'], ch_or_dm_id)) \
             or (not msg_in_channel and token_decoded['auth_user_id'] != dms[ch_or_dm_id]['owner']):
             raise AccessError(description='Unauthorised User: Cannot edit message')
 
-    return (msg_idx, msg, msg_in_channel)
+    return (msg, msg_in_channel)
 
 def check_message_exists(message_id: int) -> dict:
-    # Check if message is in a channel
-    message_values = message_channel_check(message_id)
-    msg_in_channel = True
-    # If message_values is None, check if message is in a DM
-    if (message_values == None):
-        msg_in_channel = False
-        message_values = message_dm_check(message_id)
-    # If message_values is still None, message was not found --> return Input Error
-    if (message_values == None):
+    # Look the message up in the message_id index
+    located = locate_message(message_id)
+    # If it is not there, message was not found --> return Input Error
+    if located is None:
         raise InputError(description='Invalid Message: Message ID does not exist')
-    
+    collection, ch_or_dm_id, msg = located
+
     return {
-        'in_channel': msg_in_channel, 
-        'message_values': message_values
+        'in_channel': collection == 'channels',
+        'message_values': (msg, ch_or_dm_id)
     }
 
 def message_channel_check(message_id: int) -> Optional[tuple]:
     '''
     Checks if message_id exists in channel database
     '''
-    for channel_id in channels:
-        for idx, msg in enumerate(channels[channel_id]['messages']):
-            if msg['message_id'] == message_id:
-                return (idx, msg, channel_id)
-    return None
+    located = locate_message(message_id)
+    if located is None or located[0] != 'channels':
+        return None
+    return message_position(located)
 
 def message_dm_check(message_id: int) -> Optional[tuple]:
     '''
     Checks if message_id exists in dm database
     '''
-    for dm_id in dms:
-        for idx, msg in enumerate(dms[dm_id]['messages']):
-            if msg['message_id'] == message_id:
-                return (idx, msg, dm_id)
+    located = locate_message(message_id)
+    if located is None or located[0] != 'dms':
+        return None
+    return message_position(located)
+
+def message_position(located: tuple) -> tuple:
+    '''
+    (idx, msg, channel_id or dm_id) of a located message, with idx counting
+    from the newest message as the start of channel_messages_v1 does
+    '''
+    collection, ch_or_dm_id, msg = located
+    messages = (channels if collection == 'channels' else dms)[ch_or_dm_id]['messages']
+    for idx, message in enumerate(reversed(messages)):
+        if message is msg:
+            return (idx, msg, ch_or_dm_id)
     return None
 
 def check_message_tags(message: str, auth_user_id: int, channel_id: int, dm_id: int):
@@ -507,8 +506,15 @@ def check_message_tags(message: str, auth_user_id: int, channel_id: int, dm_id:
                 notify(auth_user_id, user, channel_id, dm_id, message, True)
 
 def add_message_to_db(message_info: dict, ch_or_dm_id: int, auth_user_id: int, to_channel: bool):
-    channels[ch_or_dm_id]['messages'].insert(0, message_info) if (to_channel) else \
-        dms[ch_or_dm_id]['messages'].insert(0, message_info)
+    channels[ch_or_dm_id]['messages'].append(message_info) if (to_channel) else \
+        dms[ch_or_dm_id]['messages'].append(message_info)
+    index_message('channels' if to_channel else 'dms', ch_or_dm_id, message_info)
+    mark_dirty('channels' if to_channel else 'dms', ch_or_dm_id, message_info['message_id'])
 
     check_message_tags(message_info['message'], auth_user_id, ch_or_dm_id, -1) if (to_channel) else \
     check_message_tags(message_info['message'], auth_user_id, -1, ch_or_dm_id)
+
+def remove_message_from_db(msg: dict, in_channel: bool):
+    collection = 'channels' if in_channel else 'dms'
+    remove_message(collection, msg['dest_id'], msg)
+    mark_dirty(collection, msg['dest_id'], msg['message_id'])
@@ -0,0 +1,39 @@
+'''
+Counters describing what the server is doing, served by /metrics/v1
+'''
+import threading
+
+counters = {}
+lock = threading.Lock()
+
+def increment(name: str, amount: int = 1):
+    '''
+    Adds amount to the counter called name
+    '''
+    with lock:
+        counters[name] = counters.get(name, 0) + amount
+
+def set_value(name: str, value: int):
+    '''
+    Overwrites the gauge called name
+    '''
+    with lock:
+        counters[name] = value
+
+def get_metrics() -> dict:
+    '''
+    Returns every counter plus the averages derived from them
+    '''
+    with lock:
+        metrics = dict(counters)
+    written = metrics.get('bytes_written', 0)
+    # A group commit writes the changes of many requests at once
+    commits = metrics.get('commits', 0)
+    metrics['bytes_written_per_commit'] = written / commits if commits else 0
+    requests = metrics.get('write_requests', 0)
+    metrics['bytes_written_per_request'] = written / requests if requests else 0
+    return metrics
+
+def reset():
+    with lock:
+        counters.clear()
@@ -1,4 +1,4 @@
-from src.data import users, channels, dms
+from src.data import users, channels, dms, mark_dirty, mark_cleared, rebuild_indexes
 import src.helper as helper
 import typing
 
@@ -13,6 +13,9 @@ def clear_v1() -> dict:
     channels.clear()
     # Clear all dms
     dms.clear()
+    mark_cleared()
+    rebuild_indexes()
+    helper.token_cache.clear()
 
     return {}
 
@@ -52,6 +55,7 @@ def notify(auth_user_id: int, invitee_u_id: int, channel_id: int, dm_id: int, me
     }
 
     users[invitee_u_id]['notifications'].insert(0, notification_info)
+    mark_dirty('users', invitee_u_id)
 
 def get_notifications_v1(token: str) -> list:
     '''
@@ -96,3 +100,4 @@ def notify_react(auth_user_id: int, invitee_u_id: int, channel_id: int, dm_id: i
         'notification_message' : message
     }
     users[invitee_u_id]['notifications'].insert(0, notification_info)
+    mark_dirty('users', invitee_u_id)
@@ -0,0 +1,129 @@
+'''
+Password hashing with a slow KDF, run on a bounded worker pool.
+
+Hashes are stored as '$'-separated strings naming the KDF and its cost:
+    $pbkdf2-sha256$<iterations>$<salt>$<hash>
+    $scrypt$<n>$<r>$<p>$<salt>$<hash>
+with the salt and hash base64-encoded. Hashes without a leading '$' are
+the plain SHA-256 hex digests stored before, which verify_password() still
+accepts and needs_rehash() reports.
+
+hash_password() and verify_password() run the KDF on a pool of
+config.password_workers workers (config.password_pool is 'thread' or
+'process'; hashlib releases the GIL while hashing, so threads are enough
+unless the server runs other CPU-bound work). At most
+config.password_queue jobs are queued or running at once. Past that,
+callers wait up to config.password_queue_timeout seconds for room, then get
+a ServiceUnavailableError. While a job runs, the caller lets go of the
+database lock (see data.unlocked()), so hashing never holds up other
+requests.
+'''
+import os
+import hmac
+import base64
+import hashlib
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from src import config
+from src.data import unlocked
+from src.error import ServiceUnavailableError
+from src import metrics
+
+SALT_BYTES = 16
+
+POOLS = {
+    'thread': ThreadPoolExecutor,
+    'process': ProcessPoolExecutor,
+}
+
+pool = None
+pool_lock = threading.Lock()
+queue = None
+
+def b64(data: bytes) -> str:
+    return base64.b64encode(data).decode()
+
+def kdf(password: str, salt: bytes, name: str, cost: tuple) -> bytes:
+    if name == 'pbkdf2-sha256':
+        iterations, = cost
+        return hashlib.pbkdf2_hmac('sha256', password.encode(), salt, iterations)
+    if name == 'scrypt':
+        n, r, p = cost
+        return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p, maxmem=256 * r * n)
+    raise ValueError(f'Unknown password kdf {name!r}')
+
+def current_cost() -> tuple:
+    '''
+    Name and cost of the KDF new hashes are made with
+    '''
+    if config.password_kdf == 'pbkdf2':
+        return 'pbkdf2-sha256', (config.pbkdf2_iterations,)
+    if config.password_kdf == 'scrypt':
+        return 'scrypt', (config.scrypt_n, config.scrypt_r, config.scrypt_p)
+    raise ValueError(f'Unknown password kdf {config.password_kdf!r}')
+
+def make_hash(password: str, name: str, cost: tuple) -> str:
+    salt = os.urandom(SALT_BYTES)
+    fields = [name, *map(str, cost), b64(salt), b64(kdf(password, salt, name, cost))]
+    return '$' + '$'.join(fields)
+
+def check_hash(password: str, stored: str) -> bool:
+    if not stored.startswith('$'):
+        legacy = hashlib.sha256(password.encode()).hexdigest()
+        return hmac.compare_digest(legacy, stored)
+    name, *cost, salt, expected = stored[1:].split('$')
+    derived = kdf(password, base64.b64decode(salt), name, tuple(map(int, cost)))
+    return hmac.compare_digest(derived, base64.b64decode(expected))
+
+def needs_rehash(stored: str) -> bool:
+    '''
+    Whether a stored hash was made other than with the configured KDF and
+    cost, e.g. a legacy SHA-256 digest
+    '''
+    if not stored.startswith('$'):
+        return True
+    name, *cost, _, _ = stored[1:].split('$')
+    return (name, tuple(map(int, cost))) != current_cost()
+
+@contextmanager
+def queue_slot():
+    '''
+    Holds a place in the queue, waiting up to config.password_queue_timeout
+    seconds for one
+    '''
+    if not queue.acquire(timeout=config.password_queue_timeout):
+        metrics.increment('password_jobs_rejected')
+        raise ServiceUnavailableError(description='Too many logins in progress, try again later')
+    try:
+        yield
+    finally:
+        queue.release()
+
+def run(function, *args):
+    '''
+    Runs function on the pool, waiting for room in the queue first
+    '''
+    global pool, queue
+    with pool_lock:
+        if pool is None:
+            pool = POOLS[config.password_pool](max_workers=config.password_workers)
+            queue = threading.BoundedSemaphore(config.password_queue)
+    with unlocked(), queue_slot():
+        return pool.submit(function, *args).result()
+
+def hash_password(password: str) -> str:
+    metrics.increment('password_hashes')
+    return run(make_hash, password, *current_cost())
+
+def verify_password(password: str, stored: str) -> bool:
+    metrics.increment('password_verifications')
+    return run(check_hash, password, stored)
+
+def shutdown():
+    global pool
+    with pool_lock:
+        if pool is not None:
+            pool.shutdown()
+            pool = None
@@ -0,0 +1,182 @@
+'''
+Shape of the persisted Dreams database and the JSON codec used for it.
+
+JSON object keys are always strings, while the database keys users,
+channels and dms by their integer ids. Everything read back from disk goes
+through load_collection() (or load_entry()/load_messages() for partial
+loads), which restores the integer keys and checks the shape of every
+entry once, so the rest of src/ can trust what it finds.
+
+Message lists (a channel or dm's messages, and a channel's standup buffer)
+are stored newest first, but kept oldest first in memory so new messages
+are appended to them: load_messages() reverses them as they are read, and
+stored() as they are written.
+
+orjson is used to encode and decode when it is installed, falling back to
+the standard library's json. Garbage collection is paused while decoding.
+'''
+import gc
+import json
+from typing import Union
+
+try:
+    from orjson import dumps as orjson_dumps, loads as orjson_loads, \
+        OPT_NON_STR_KEYS, OPT_PASSTHROUGH_SUBCLASS
+except ImportError:
+    orjson_dumps = orjson_loads = None
+
+def plain(value) -> dict:
+    # orjson would read a dict subclass's storage directly, skipping any
+    # items() override (see snapshot.LazyEntry); hand it a plain copy instead
+    if isinstance(value, dict):
+        return dict(value.items())
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+def dumps(data) -> str:
+    if orjson_dumps is not None:
+        return orjson_dumps(data, default=plain, \
+            option=OPT_NON_STR_KEYS | OPT_PASSTHROUGH_SUBCLASS).decode()
+    return json.dumps(data)
+
+def loads(data: Union[str, bytes]):
+    # Decoding a snapshot allocates millions of containers, each counting
+    # towards the next garbage collection pass; none of them can form a
+    # cycle, so collecting while decoding is wasted work
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        if orjson_loads is not None:
+            return orjson_loads(data)
+        return json.loads(data)
+    finally:
+        if enabled:
+            gc.enable()
+
+NUMBER = (int, float)
+
+USER = {
+    'session_id': list,
+    'permission_id': int,
+    'email': str,
+    'password': str,
+    'name_first': str,
+    'name_last': str,
+    'handle_str': str,
+    'notifications': list,
+    'profile_img_url': str,
+    'reset_code': list,
+}
+
+CHANNEL = {
+    'name': str,
+    'public': bool,
+    'owner_members': list,
+    'all_members': list,
+    'messages': list,
+    'is_active': bool,
+    'buffer': list,
+}
+
+DM = {
+    'dm_id': int,
+    'name': str,
+    # None once the owner has left
+    'owner': (int, type(None)),
+    'members': list,
+    'messages': list,
+}
+
+MESSAGE = {
+    'message_id': int,
+    'dest_id': int,
+    'u_id': int,
+    'message': str,
+    'time_created': NUMBER,
+    'reacts': list,
+    'is_pinned': bool,
+}
+
+SCHEMAS = {
+    'users': USER,
+    'channels': CHANNEL,
+    'dms': DM,
+}
+
+def check(value, schema: dict, where: str, skip: tuple = ()) -> dict:
+    '''
+    Checks that value is a dict holding every field of schema with the
+    right type, raising ValueError naming where it was found otherwise
+    '''
+    if not isinstance(value, dict):
+        raise ValueError(f'{where}: expected an object, found {type(value).__name__}')
+    for field, field_type in schema.items():
+        if field in skip:
+            continue
+        if field not in value:
+            raise ValueError(f'{where}: missing field {field!r}')
+        if not isinstance(value[field], field_type):
+            raise ValueError(f'{where}: field {field!r} has type {type(value[field]).__name__}')
+    return value
+
+# Fields of a channel or dm holding a list of messages
+MESSAGE_LISTS = ('messages', 'buffer')
+
+def load_messages(messages, where: str) -> list:
+    '''
+    Checks a stored message list, returning it oldest first
+    '''
+    if not isinstance(messages, list):
+        raise ValueError(f'{where}: expected a list of messages')
+    for position, message in enumerate(messages):
+        check(message, MESSAGE, f'{where}[{position}]')
+    messages.reverse()
+    return messages
+
+def stored(entry: dict) -> dict:
+    '''
+    Copy of an entry as it is stored, with its message lists newest first
+    '''
+    return {field: value[::-1] if field in MESSAGE_LISTS else value \
+        for field, value in entry.items()}
+
+def stored_collection(collection: dict) -> dict:
+    return {key: stored(entry) for key, entry in collection.items()}
+
+def load_members(members: list, where: str) -> list:
+    '''
+    Channel members are stored as u_ids; older databases stored a copy of
+    each member's profile, which is reduced to its u_id
+    '''
+    u_ids = []
+    for position, member in enumerate(members):
+        if isinstance(member, dict) and isinstance(member.get('u_id'), int):
+            member = member['u_id']
+        if not isinstance(member, int):
+            raise ValueError(f'{where}[{position}]: expected a u_id')
+        u_ids.append(member)
+    return u_ids
+
+def load_entry(collection: str, key, entry, with_messages: bool = True) -> dict:
+    '''
+    Checks one entry of a collection. Without with_messages the entry's
+    message history is left out, for the caller to load later.
+    '''
+    where = f'{collection}[{key}]'
+    skip = () if with_messages else ('messages',)
+    check(entry, SCHEMAS[collection], where, skip)
+    if collection == 'channels':
+        for field in ('owner_members', 'all_members'):
+            entry[field] = load_members(entry[field], f'{where}.{field}')
+        entry['buffer'] = load_messages(entry['buffer'], f'{where}.buffer')
+    if collection != 'users' and with_messages:
+        entry['messages'] = load_messages(entry['messages'], f'{where}.messages')
+    return entry
+
+def load_collection(collection: str, raw: dict, with_messages: bool = True) -> dict:
+    '''
+    Restores a collection decoded from JSON: integer keys and checked entries
+    '''
+    if not isinstance(raw, dict):
+        raise ValueError(f'{collection}: expected an object')
+    return {int(key): load_entry(collection, key, entry, with_messages) \
+        for key, entry in raw.items()}
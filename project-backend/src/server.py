@@ -4,10 +4,10 @@ import src.data as db
 import threading
 from time import sleep
 from json import dumps
-from flask import Flask, request, send_from_directory
+from flask import Flask, request, send_from_directory, g
 from flask_cors import CORS
-from src.error import InputError
-from src.auth import auth_login_v1, auth_register_v1, auth_logout_v1, \
+from src.error import InputError, RouteContractError
+from src.auth import auth_login_v1, auth_register_v1, auth_logout_v1, auth_logout_all_v1, \
     auth_passwordreset_request_v1, auth_passwordreset_reset_v1
 from src.admin import admin_user_remove_v1, admin_userpermission_change_v1
 from src.message import message_send_v1, message_edit_v1, \
@@ -26,6 +26,9 @@ from src.user import user_profile_v2, user_profile_setname_v2, \
 from src.standup import standup_active_v1, standup_send_v1, standup_start_v1
 from src.search import search_v2
 from src.other import clear_v1, get_notifications_v1
+from src.metrics import get_metrics, increment
+from src import helper
+from src import mail
 from src import config
 
 def defaultHandler(err):
@@ -45,6 +48,64 @@ CORS(APP)
 APP.config['TRAP_HTTP_EXCEPTIONS'] = True
 APP.register_error_handler(Exception, defaultHandler)
 
+@APP.before_request
+def lock_database():
+    '''
+    Runs each request holding the database lock, so that the flusher and
+    timer callbacks never see a half-applied change. Slow work that needs
+    none of the collections (password hashing, queueing mail, downloading
+    profile photos) lets go of it through data.unlocked().
+    '''
+    # Held across the request, and released in unlock_database
+    db.lock.acquire()  # pylint: disable=consider-using-with
+    g.locked = True
+    if config.debug_routes and is_read_route():
+        g.fingerprint = db.fingerprint()
+
+@APP.before_request
+def verify_token():
+    '''
+    Verifies the request's token once for all the auth checks made while
+    serving it
+    '''
+    token = request.args.get('token')
+    if token is None and request.is_json:
+        incoming = request.get_json(silent=True)
+        if isinstance(incoming, dict):
+            token = incoming.get('token')
+    g.auth = helper.begin_request(token)
+
+@APP.after_request
+def check_route_contract(response):
+    '''
+    Enforces the read/write contract on every successful request: read
+    routes never persist, write routes commit exactly once. With
+    config.debug_routes set, read routes are also checked to have left the
+    database unchanged.
+    '''
+    if response.status_code != 200:
+        return response
+    # Flask turns errors raised here into a bare InternalServerError, so
+    # the error's response is made here
+    if is_read_route():
+        if config.debug_routes and db.fingerprint() != g.fingerprint:
+            return defaultHandler(RouteContractError(description=f'Read route {request.path} changed the database'))
+    elif not g.get('committed'):
+        return defaultHandler(RouteContractError(description=f'Write route {request.path} did not commit'))
+    return response
+
+@APP.teardown_request
+def unlock_database(exc):
+    '''
+    Releases the database lock, then holds the response until the request's
+    changes are durable (see config.durability)
+    '''
+    helper.end_request(g.pop('auth', None))
+    if g.pop('locked', False):
+        db.evict_decoded()
+        db.lock.release()
+    db.wait_durable(g.pop('ticket', None))
+
 ###############################################################
 #                     ECHO FLASK ROUTE                        #
 ###############################################################
@@ -109,6 +170,16 @@ def auth_logout():
     incoming = request.get_json()
     return saveAndReturn(auth_logout_v1(incoming['token']))
 
+@APP.route('/auth/logout/all/v1', methods=['POST'])
+def auth_logout_all():
+    ''' 
+    Flask wrapper for auth_logout_all that takes a token and logs
+    its user out of every session (invalidating all their tokens).
+    Returns a dictionary with the number of sessions ended.
+    '''
+    incoming = request.get_json()
+    return saveAndReturn(auth_logout_all_v1(incoming['token']))
+
 @APP.route('/auth/passwordreset/request/v1', methods=['POST'])
 def auth_passwordreset_request():
     ''' 
@@ -438,7 +509,7 @@ def http_users_all_v1():
     Flask wrapper for users_all that takes a token and returns a
     dictionary with a list of all users and their profiles.
     '''
-    return saveAndReturn(users_all_v1(request.args.get("token")))
+    return dumps(users_all_v1(request.args.get("token")))
 
 @APP.route("/user/profile/v2", methods=['GET'])
 def get_user_profile_v2():
@@ -446,8 +517,8 @@ def get_user_profile_v2():
     Flask wrapper for user_profile that takes a token and the user id
     of the profile that is to be returned.
     '''
-    return saveAndReturn(user_profile_v2(request.args.get("token"), \
-                            int(request.args.get('u_id'))))
+    return dumps(user_profile_v2(request.args.get("token"), \
+                    int(request.args.get('u_id'))))
 
 @APP.route("/user/profile/setname/v2", methods=['PUT'])
 def set_user_profile_name_v2():
@@ -484,14 +555,14 @@ def set_user_stats_v1():
     '''
     Flask wrapper for user_stats_v1 that takes token
     '''
-    return saveAndReturn(user_stats_v1(request.args.get("token")))
+    return dumps(user_stats_v1(request.args.get("token")))
 
 @APP.route("/users/stats/v1", methods=['GET'])
 def set_users_stats_v1():
     '''
     Flask wrapper for users_stats_v1 that takes incoming token
     '''
-    return saveAndReturn(users_stats_v1(request.args.get("token")))
+    return dumps(users_stats_v1(request.args.get("token")))
 
 @APP.route("/user/profile/uploadphoto/v1", methods=['POST'])
 def set_user_profile_uploadphoto():
@@ -564,7 +635,7 @@ def standup_start():
 @APP.route('/standup/active/v1', methods=['GET'])
 def standup_active():
     res = standup_active_v1(request.args.get('token'), int(request.args.get('channel_id')))
-    return saveAndReturn(res)
+    return dumps(res)
 
 @APP.route('/standup/send/v1', methods=['POST'])
 def standup_send():
@@ -589,6 +660,14 @@ def notifications():
         'notifications' : get_notifications_v1(token)
     })
 
+@APP.route("/metrics/v1", methods=["GET"])
+def metrics():
+    ''' 
+    Flask wrapper for get_metrics that returns a dictionary of server
+    counters, such as the number of bytes persisted per commit.
+    '''
+    return dumps(get_metrics())
+
 @APP.route("/clear/v1", methods=["DELETE"])
 def clear():
     ''' 
@@ -601,9 +680,27 @@ def clear():
 #                      AUXILLARY FUNCTIONS                    #
 ###############################################################
 
+# GET routes only read: they return dumps() of their result and never
+# persist anything. Every other route writes, and persists its changes
+# exactly once by returning through saveAndReturn().
+READ_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+def is_read_route() -> bool:
+    return request.method in READ_METHODS
+
 def saveAndReturn(responseObject):
-    db.save_db()
+    if is_read_route():
+        raise RouteContractError(description=f'Read route {request.path} tried to commit')
+    if g.get('committed'):
+        raise RouteContractError(description=f'Write route {request.path} committed twice')
+    g.committed = True
+    increment('write_requests')
+    g.ticket = db.commit()
     return dumps(responseObject)
 
 if __name__ == "__main__":
+    # Sends any mail left queued when the server last stopped
+    mail.start_sender()
+    # Expires the sessions and reset codes loaded from disk
+    helper.start_sweeper()
     APP.run(port=config.port) # Do not edit this port
@@ -0,0 +1,117 @@
+'''
+Sharded snapshot of the Dreams database: a directory holding
+
+    manifest.json       - the ids of every channel and dm
+    users.json          - every user
+    channels-<id>.json  - one channel, with its messages
+    dms-<id>.json       - one dm, with its messages
+
+so a change to one channel or dm rewrites only its own shard (plus the
+manifest), and the shards can be decoded in parallel on startup.
+'''
+import os
+from src.schema import loads, dumps
+from src import schema
+from src import durable
+from typing import Optional
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+MANIFEST = 'manifest.json'
+USERS = 'users.json'
+CONTAINERS = ('channels', 'dms')
+
+POOLS = {
+    'thread': ThreadPoolExecutor,
+    'process': ProcessPoolExecutor,
+}
+
+def shard_name(collection: str, key: int) -> str:
+    return f'{collection}-{key}.json'
+
+def encode(users: dict, channels: dict, dms: dict, stale: Optional[dict]) -> dict:
+    '''
+    Encodes the shards of the entries in stale (collection -> keys), or of
+    every entry when stale is None. Returns shard name -> text, where a text
+    of None means the shard's entry was removed.
+    '''
+    collections = {'channels': channels, 'dms': dms}
+    files = {}
+    if stale is None or stale['users']:
+        files[USERS] = dumps(users)
+    for name, collection in collections.items():
+        for key in (collection if stale is None else stale[name]):
+            entry = collection.get(key)
+            files[shard_name(name, key)] = dumps(schema.stored(entry)) if entry is not None else None
+    files[MANIFEST] = dumps({name: list(collection) for name, collection in collections.items()})
+    return files
+
+def save(directory: str, files: dict, complete: bool = False) -> int:
+    '''
+    Writes encoded shards, the manifest last, then removes the shards of
+    removed entries (every shard not in the manifest, if complete). Returns
+    the number of bytes written.
+    '''
+    os.makedirs(directory, exist_ok=True)
+    written = sum(durable.write_atomic(os.path.join(directory, name), text, sync_directory=False) \
+        for name, text in files.items() if text is not None and name != MANIFEST)
+    durable.fsync_directory(os.path.join(directory, MANIFEST))
+    written += durable.write_atomic(os.path.join(directory, MANIFEST), files[MANIFEST])
+    removed = [name for name, text in files.items() if text is None]
+    if complete:
+        removed = [name for name in os.listdir(directory) if name not in files]
+    for name in removed:
+        try:
+            os.remove(os.path.join(directory, name))
+        except FileNotFoundError:
+            pass
+    return written
+
+def read_shard(path: str):
+    with open(path, 'r', encoding='utf-8') as FILE:
+        return loads(FILE.read())
+
+def load(directory: str, users: dict, channels: dict, dms: dict, *, workers: int, pool: str):
+    '''
+    Fills the collections from the shards listed in the manifest, decoding
+    them on a pool ('thread' or 'process') of the given number of workers
+    '''
+    manifest = read_shard(os.path.join(directory, MANIFEST))
+    keys = [(name, key) for name in CONTAINERS for key in manifest[name]]
+    paths = [os.path.join(directory, USERS)] + \
+        [os.path.join(directory, shard_name(name, key)) for name, key in keys]
+    with POOLS[pool](max_workers=workers) as executor:
+        shards = executor.map(read_shard, paths, chunksize=max(1, len(paths) // (workers * 4)))
+        users.update(schema.load_collection('users', next(shards)))
+        collections = {'channels': channels, 'dms': dms}
+        for (name, key), entry in zip(keys, shards):
+            collections[name][key] = schema.load_entry(name, key, entry)
+
+def fold(directory: str, records: list, apply_record) -> int:
+    '''
+    Applies journal records (none of them a clear) to the shards on disk,
+    reading and rewriting only the shards they touch. Returns the number of
+    bytes written.
+    '''
+    manifest = read_shard(os.path.join(directory, MANIFEST))
+    touched = {'users': set(), 'channels': set(), 'dms': set()}
+    for record in records:
+        touched[record['col']].add(record['key'])
+    state = {'users': {}, 'channels': {}, 'dms': {}}
+    if touched['users']:
+        state['users'] = schema.load_collection('users', read_shard(os.path.join(directory, USERS)))
+    for name in CONTAINERS:
+        for key in touched[name].intersection(manifest[name]):
+            state[name][key] = schema.load_entry(name, key, \
+                read_shard(os.path.join(directory, shard_name(name, key))))
+    for record in records:
+        apply_record(record, state)
+
+    files = {USERS: dumps(state['users'])} if touched['users'] else {}
+    for name in CONTAINERS:
+        for key in touched[name]:
+            files[shard_name(name, key)] = dumps(schema.stored(state[name][key])) \
+                if key in state[name] else None
+        kept = [key for key in manifest[name] if key not in touched[name] or key in state[name]]
+        manifest[name] = kept + [key for key in state[name] if key not in manifest[name]]
+    files[MANIFEST] = dumps(manifest)
+    return save(directory, files)
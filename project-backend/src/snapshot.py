@@ -0,0 +1,181 @@
+'''
+Binary snapshot container for the Dreams database.
+
+Layout (all offsets are from the start of the file):
+    header   - MAGIC, VERSION, then the offset and length of the index
+    blocks   - JSON blocks: the users, the channels and dms without their
+               messages, and one message list per channel/dm
+    index    - JSON block locating every other block
+
+The file is memory-mapped on load. Users and the channel/dm metadata are
+decoded straight away; each message list stays in the mapping until its
+channel/dm's 'messages' are first read (see LazyEntry). Decoded messages
+that were never changed can be dropped again with LazyEntry.unload(), so
+only the message lists in use need to fit in memory.
+'''
+import io
+import mmap
+import struct
+from src.schema import loads, dumps
+from src import schema
+from src import durable
+from typing import Optional, BinaryIO
+
+MAGIC = b'DRMS'
+VERSION = 1
+HEADER = struct.Struct('<4sHQQ')
+
+class LazyEntry(dict):
+    '''
+    Channel or dm whose 'messages' are decoded from a snapshot block the first
+    time they are read. Every other field is available straight away.
+    '''
+    def __init__(self, fields: dict, ref: tuple):
+        super().__init__(fields, messages=None)
+        self.ref = ref
+        # The block the messages were decoded from, while they still match it
+        self.block = ref
+        # Called once the messages are decoded
+        self.on_load = None
+
+    def load(self):
+        if self.ref is not None:
+            messages = schema.load_messages(read_block(self.ref), f"{self['name']}.messages")
+            dict.__setitem__(self, 'messages', messages)
+            self.ref = None
+            if self.on_load is not None:
+                self.on_load()
+
+    def __getitem__(self, key):
+        if key == 'messages':
+            self.load()
+        return dict.__getitem__(self, key)
+
+    def get(self, key, default=None):
+        if key == 'messages':
+            self.load()
+        return dict.get(self, key, default)
+
+    def __setitem__(self, key, value):
+        if key == 'messages':
+            self.ref = None
+            self.block = None
+        dict.__setitem__(self, key, value)
+
+    def changed(self):
+        '''
+        Records that the messages no longer match their block, so they are
+        never unloaded
+        '''
+        self.block = None
+
+    def unload(self) -> bool:
+        '''
+        Drops the decoded messages if they still match their block, to be
+        decoded again when next read. Returns whether they were dropped.
+        '''
+        if self.ref is not None or self.block is None:
+            return False
+        dict.__setitem__(self, 'messages', None)
+        self.ref = self.block
+        return True
+
+    def values(self):
+        self.load()
+        return dict.values(self)
+
+    def items(self):
+        self.load()
+        return dict.items(self)
+
+    def copy(self) -> dict:
+        self.load()
+        return dict(self)
+
+    def __eq__(self, other):
+        self.load()
+        if isinstance(other, LazyEntry):
+            other.load()
+        return dict.__eq__(self, other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __reduce_ex__(self, protocol):
+        # Copies and pickles are plain, fully loaded dicts
+        return dict, (self.copy(),)
+
+def read_block(ref: tuple):
+    buffer, offset, length = ref
+    return loads(buffer[offset:offset + length])
+
+def raw_messages(entry: dict) -> Optional[bytes]:
+    '''
+    Encoded message list of an entry whose messages were never decoded
+    '''
+    if isinstance(entry, LazyEntry) and entry.ref is not None:
+        buffer, offset, length = entry.ref
+        return buffer[offset:offset + length]
+    return None
+
+def encode(stream: BinaryIO, users: dict, channels: dict, dms: dict) -> int:
+    '''
+    Writes a snapshot of the collections to a binary stream, returning the
+    number of bytes written. Message lists that were never decoded are copied
+    across without decoding them.
+    '''
+    offset = HEADER.size
+    stream.write(b'\0' * offset)
+
+    def write_block(data: bytes) -> list:
+        nonlocal offset
+        stream.write(data)
+        block = [offset, len(data)]
+        offset += len(data)
+        return block
+
+    index = {'users': write_block(dumps(users).encode())}
+    for name, collection in (('channels', channels), ('dms', dms)):
+        fields = {key: schema.stored({field: entry[field] for field in entry if field != 'messages'}) \
+            for key, entry in collection.items()}
+        index[name] = write_block(dumps(fields).encode())
+        index[name + '_messages'] = {key: write_block(raw_messages(entry) or \
+            dumps(entry['messages'][::-1]).encode()) for key, entry in collection.items()}
+    index_block = dumps(index).encode()
+    stream.write(index_block)
+    stream.seek(0)
+    stream.write(HEADER.pack(MAGIC, VERSION, offset, len(index_block)))
+    return offset + len(index_block)
+
+def encode_bytes(users: dict, channels: dict, dms: dict) -> bytes:
+    stream = io.BytesIO()
+    encode(stream, users, channels, dms)
+    return stream.getvalue()
+
+def save(path: str, data: bytes) -> int:
+    '''
+    Replaces the snapshot at path. The old file may still be mapped by
+    entries that have not loaded their messages, so it is replaced by a
+    rename rather than overwritten.
+    '''
+    return durable.write_atomic(path, data)
+
+def load(path: str, users: dict, channels: dict, dms: dict):
+    '''
+    Maps the snapshot at path and fills the collections from it, leaving
+    the message lists to be decoded on first access
+    '''
+    with open(path, 'rb') as FILE:
+        buffer = mmap.mmap(FILE.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, version, index_offset, index_length = HEADER.unpack_from(buffer)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f'{path} is not a version {VERSION} Dreams snapshot')
+    index = read_block((buffer, index_offset, index_length))
+    users.update(schema.load_collection('users', read_block((buffer, *index['users']))))
+    for name, collection in (('channels', channels), ('dms', dms)):
+        blocks = index[name + '_messages']
+        entries = schema.load_collection(name, read_block((buffer, *index[name])), with_messages=False)
+        for key, fields in entries.items():
+            collection[key] = LazyEntry(fields, (buffer, *blocks[str(key)]))
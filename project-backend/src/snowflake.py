@@ -0,0 +1,56 @@
+'''
+Snowflake ids for messages, channels and dms.
+
+An id packs, from the most significant bit down,
+    41 bits - milliseconds since EPOCH
+    10 bits - the node id of the server that made it (config.node_id)
+    12 bits - a sequence number counting ids made in the same millisecond
+so ids made by one node are unique and strictly increasing, and ids from
+any node sort by when they were made (to the millisecond), which makes
+them usable as sort keys and pagination cursors.
+
+The ids made before these were time() * 10**7, which are smaller than any
+snowflake id made after February 2021, so new ids also sort after them.
+'''
+import threading
+from time import time
+
+from src import config
+
+# 1 January 2021, in milliseconds since the Unix epoch
+EPOCH = 1609459200000
+
+NODE_BITS = 10
+SEQUENCE_BITS = 12
+MAX_NODE = (1 << NODE_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+
+lock = threading.Lock()
+last_ms = 0
+sequence = 0
+
+def next_id() -> int:
+    '''
+    Makes a new id. More than 4096 ids in a millisecond, or the clock going
+    backwards, borrow from the following milliseconds rather than wait.
+    '''
+    global last_ms, sequence
+    now = int(time() * 1000) - EPOCH
+    with lock:
+        if now > last_ms:
+            last_ms, sequence = now, 0
+        elif sequence < MAX_SEQUENCE:
+            sequence += 1
+        else:
+            last_ms, sequence = last_ms + 1, 0
+        ms, seq = last_ms, sequence
+    return (ms << (NODE_BITS + SEQUENCE_BITS)) | (config.node_id << SEQUENCE_BITS) | seq
+
+def timestamp(snowflake: int) -> float:
+    '''
+    Time, in seconds since the Unix epoch, that an id was made
+    '''
+    return ((snowflake >> (NODE_BITS + SEQUENCE_BITS)) + EPOCH) / 1000
+
+def node(snowflake: int) -> int:
+    return (snowflake >> SEQUENCE_BITS) & MAX_NODE
@@ -0,0 +1,284 @@
+'''
+SQLite storage engine, selected with config.storage = 'sqlite'.
+
+Instead of snapshot files and a journal, the change records built by
+src.data.pending_records() are applied as row updates to normalised,
+indexed tables inside a single transaction. The database runs in WAL
+mode, so a commit appends to SQLite's own log rather than rewriting
+anything. The forum is still served from the in-memory collections in
+src.data; this engine is only responsible for persisting and restoring
+them.
+'''
+import os
+import sqlite3
+import threading
+from json import loads, dumps
+from src import config
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS users (
+    u_id INTEGER PRIMARY KEY,
+    email TEXT NOT NULL,
+    password TEXT NOT NULL,
+    name_first TEXT NOT NULL,
+    name_last TEXT NOT NULL,
+    handle_str TEXT NOT NULL,
+    permission_id INTEGER NOT NULL,
+    profile_img_url TEXT NOT NULL,
+    extra TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS users_email ON users (email);
+CREATE INDEX IF NOT EXISTS users_handle ON users (handle_str);
+
+CREATE TABLE IF NOT EXISTS notifications (
+    u_id INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    channel_id INTEGER NOT NULL,
+    dm_id INTEGER NOT NULL,
+    notification_message TEXT NOT NULL,
+    PRIMARY KEY (u_id, position)
+);
+
+CREATE TABLE IF NOT EXISTS channels (
+    channel_id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    public INTEGER NOT NULL,
+    is_active INTEGER NOT NULL,
+    buffer TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS dms (
+    dm_id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    owner INTEGER
+);
+
+CREATE TABLE IF NOT EXISTS memberships (
+    kind TEXT NOT NULL,
+    container_id INTEGER NOT NULL,
+    u_id INTEGER NOT NULL,
+    is_owner INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    PRIMARY KEY (kind, container_id, is_owner, u_id)
+);
+CREATE INDEX IF NOT EXISTS memberships_user ON memberships (u_id);
+
+CREATE TABLE IF NOT EXISTS messages (
+    message_id INTEGER PRIMARY KEY,
+    kind TEXT NOT NULL,
+    container_id INTEGER NOT NULL,
+    seq INTEGER NOT NULL,
+    u_id INTEGER NOT NULL,
+    message TEXT NOT NULL,
+    time_created INTEGER NOT NULL,
+    is_pinned INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_container ON messages (kind, container_id, seq);
+CREATE INDEX IF NOT EXISTS messages_user ON messages (u_id);
+
+CREATE TABLE IF NOT EXISTS reacts (
+    message_id INTEGER NOT NULL,
+    react_id INTEGER NOT NULL,
+    u_id INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    PRIMARY KEY (message_id, react_id, u_id)
+);
+'''
+
+# Columns of the users table; every other field of a user entry (sessions,
+# reset codes, ...) is kept as JSON in users.extra
+USER_COLUMNS = ('email', 'password', 'name_first', 'name_last', 'handle_str', \
+    'permission_id', 'profile_img_url')
+
+# Collection name -> value of the kind column in memberships and messages
+KINDS = {'channels': 'channel', 'dms': 'dm'}
+
+connection = None
+lock = threading.Lock()
+# Next value of messages.seq; newer messages always get a larger seq
+next_seq = 1
+
+def connect() -> sqlite3.Connection:
+    global connection, next_seq
+    if connection is None:
+        connection = sqlite3.connect(config.sqlite_path, check_same_thread=False)
+        connection.execute('PRAGMA journal_mode=WAL')
+        # In WAL mode NORMAL only syncs at checkpoints, so a commit could be
+        # lost to a power cut after the request was told it was durable
+        synchronous = 'NORMAL' if config.durability == 'async' else 'FULL'
+        connection.execute(f'PRAGMA synchronous={synchronous}')
+        connection.executescript(SCHEMA)
+        next_seq = connection.execute('SELECT COALESCE(MAX(seq), 0) + 1 FROM messages').fetchone()[0]
+    return connection
+
+def close():
+    global connection
+    if connection is not None:
+        connection.close()
+        connection = None
+
+def write(records: list) -> int:
+    '''
+    Applies change records from src.data.pending_records() in one transaction,
+    returning the number of bytes the transaction added to the WAL
+    '''
+    with lock:
+        conn = connect()
+        wal_before = wal_size()
+        with conn:
+            for record in records:
+                apply_record(conn, record)
+        return max(wal_size() - wal_before, 0)
+
+def wal_size() -> int:
+    try:
+        return os.path.getsize(config.sqlite_path + '-wal')
+    except OSError:
+        return 0
+
+def apply_record(conn: sqlite3.Connection, record: dict):
+    if record['op'] == 'clear':
+        for table in ('users', 'notifications', 'channels', 'dms', 'memberships', \
+                'messages', 'reacts'):
+            conn.execute(f'DELETE FROM {table}')
+    elif record['col'] == 'users':
+        if record['op'] == 'del':
+            delete_user(conn, record['key'])
+        else:
+            put_user(conn, record['key'], record['value'])
+    elif record['op'] == 'del':
+        delete_container(conn, KINDS[record['col']], record['key'])
+    elif record['op'] == 'put' and record['col'] == 'channels':
+        put_channel(conn, record['key'], record['value'])
+    elif record['op'] == 'put':
+        put_dm(conn, record['key'], record['value'])
+    elif record['value'] is None:
+        delete_message(conn, record['id'])
+    else:
+        put_message(conn, KINDS[record['col']], record['key'], record['value'])
+
+def put_user(conn: sqlite3.Connection, u_id: int, user: dict):
+    extra = {field: user[field] for field in user \
+        if field not in USER_COLUMNS and field != 'notifications'}
+    conn.execute(
+        'INSERT OR REPLACE INTO users (u_id, email, password, name_first, name_last, '
+        'handle_str, permission_id, profile_img_url, extra) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+        (u_id, *[user[column] for column in USER_COLUMNS], dumps(extra)))
+    conn.execute('DELETE FROM notifications WHERE u_id = ?', (u_id,))
+    conn.executemany(
+        'INSERT INTO notifications VALUES (?, ?, ?, ?, ?)',
+        [(u_id, position, n['channel_id'], n['dm_id'], n['notification_message']) \
+            for position, n in enumerate(user['notifications'])])
+
+def delete_user(conn: sqlite3.Connection, u_id: int):
+    conn.execute('DELETE FROM users WHERE u_id = ?', (u_id,))
+    conn.execute('DELETE FROM notifications WHERE u_id = ?', (u_id,))
+
+def put_members(conn: sqlite3.Connection, kind: str, container_id: int, u_ids: list, is_owner: bool):
+    conn.execute('DELETE FROM memberships WHERE kind = ? AND container_id = ? AND is_owner = ?', \
+        (kind, container_id, int(is_owner)))
+    conn.executemany(
+        'INSERT OR IGNORE INTO memberships VALUES (?, ?, ?, ?, ?)',
+        [(kind, container_id, u_id, int(is_owner), position) \
+            for position, u_id in enumerate(u_ids)])
+
+def put_channel(conn: sqlite3.Connection, channel_id: int, channel: dict):
+    conn.execute('INSERT OR REPLACE INTO channels VALUES (?, ?, ?, ?, ?)', \
+        (channel_id, channel['name'], int(channel['public']), int(channel['is_active']), \
+            dumps(channel['buffer'])))
+    put_members(conn, 'channel', channel_id, channel['all_members'], False)
+    put_members(conn, 'channel', channel_id, channel['owner_members'], True)
+
+def put_dm(conn: sqlite3.Connection, dm_id: int, dm: dict):
+    conn.execute('INSERT OR REPLACE INTO dms VALUES (?, ?, ?)', (dm_id, dm['name'], dm['owner']))
+    put_members(conn, 'dm', dm_id, dm['members'], False)
+
+def delete_container(conn: sqlite3.Connection, kind: str, container_id: int):
+    conn.execute(f'DELETE FROM {kind}s WHERE {kind}_id = ?', (container_id,))
+    conn.execute('DELETE FROM memberships WHERE kind = ? AND container_id = ?', (kind, container_id))
+    conn.execute('DELETE FROM reacts WHERE message_id IN (SELECT message_id FROM messages '
+        'WHERE kind = ? AND container_id = ?)', (kind, container_id))
+    conn.execute('DELETE FROM messages WHERE kind = ? AND container_id = ?', (kind, container_id))
+
+def put_message(conn: sqlite3.Connection, kind: str, container_id: int, msg: dict):
+    global next_seq
+    conn.execute(
+        'INSERT INTO messages VALUES (?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (message_id) '
+        'DO UPDATE SET message = excluded.message, is_pinned = excluded.is_pinned',
+        (msg['message_id'], kind, container_id, next_seq, msg['u_id'], msg['message'], \
+            msg['time_created'], int(msg['is_pinned'])))
+    next_seq += 1
+    conn.execute('DELETE FROM reacts WHERE message_id = ?', (msg['message_id'],))
+    conn.executemany(
+        'INSERT INTO reacts VALUES (?, ?, ?, ?)',
+        [(msg['message_id'], react['react_id'], u_id, position) \
+            for react in msg['reacts'] for position, u_id in enumerate(react['u_ids'])])
+
+def delete_message(conn: sqlite3.Connection, message_id: int):
+    conn.execute('DELETE FROM messages WHERE message_id = ?', (message_id,))
+    conn.execute('DELETE FROM reacts WHERE message_id = ?', (message_id,))
+
+def load(users: dict, channels: dict, dms: dict):
+    '''
+    Fills the (empty) in-memory collections from the database
+    '''
+    with lock:
+        conn = connect()
+        notifications = {}
+        for u_id, channel_id, dm_id, text in conn.execute(
+                'SELECT u_id, channel_id, dm_id, notification_message FROM notifications '
+                'ORDER BY u_id, position'):
+            notifications.setdefault(u_id, []).append(
+                {'channel_id': channel_id, 'dm_id': dm_id, 'notification_message': text})
+        for row in conn.execute('SELECT * FROM users'):
+            user = loads(row[-1])
+            user.update(zip(USER_COLUMNS, row[1:-1]))
+            user['notifications'] = notifications.get(row[0], [])
+            users[row[0]] = user
+
+        members = {}
+        for kind, container_id, u_id, is_owner in conn.execute(
+                'SELECT kind, container_id, u_id, is_owner FROM memberships '
+                'ORDER BY kind, container_id, is_owner, position'):
+            members.setdefault((kind, container_id, is_owner), []).append(u_id)
+        for channel_id, name, public, is_active, buffer in conn.execute('SELECT * FROM channels'):
+            channels[channel_id] = {
+                'name': name,
+                'public': bool(public),
+                'owner_members': members.get(('channel', channel_id, 1), []),
+                'all_members': members.get(('channel', channel_id, 0), []),
+                'messages': [],
+                'is_active': bool(is_active),
+                # Stored newest first, like the message lists of snapshots
+                'buffer': loads(buffer)[::-1],
+            }
+        for dm_id, name, owner in conn.execute('SELECT * FROM dms'):
+            dms[dm_id] = {
+                'dm_id': dm_id,
+                'name': name,
+                'owner': owner,
+                'members': members.get(('dm', dm_id, 0), []),
+                'messages': [],
+            }
+
+        reacts = {}
+        for message_id, u_id in conn.execute(
+                'SELECT message_id, u_id FROM reacts ORDER BY message_id, position'):
+            reacts.setdefault(message_id, []).append(u_id)
+        for message_id, kind, container_id, u_id, message, time_created, is_pinned in conn.execute(
+                'SELECT message_id, kind, container_id, u_id, message, time_created, is_pinned '
+                'FROM messages ORDER BY kind, container_id, seq'):
+            container = channels if kind == 'channel' else dms
+            container[container_id]['messages'].append({
+                'message_id': message_id,
+                'dest_id': container_id,
+                'u_id': u_id,
+                'message': message,
+                'time_created': time_created,
+                'reacts': [{
+                    'react_id': 1,
+                    'u_ids': reacts.get(message_id, []),
+                    'is_this_user_reacted': False,
+                }],
+                'is_pinned': bool(is_pinned),
+            })
@@ -2,16 +2,20 @@ import asyncio
 import time
 import uuid
 from datetime import datetime
-from src.data import channels
+from src.data import channels, mark_dirty, locked, index_message
 from src.error import InputError, AccessError
 import src.helper as helper
 from threading import Timer
 from typing import Union
 
 def end_standup(channel_id: int):
-    channels[channel_id]['messages'] = channels[channel_id]['buffer'] + channels[channel_id]['messages']
+    for message_info in channels[channel_id]['buffer']:
+        index_message('channels', channel_id, message_info)
+        mark_dirty('channels', channel_id, message_info['message_id'])
+    channels[channel_id]['messages'].extend(channels[channel_id]['buffer'])
     channels[channel_id]['buffer'].clear()
     channels[channel_id]['is_active'] = False
+    mark_dirty('channels', channel_id)
     # print(f'end standup# {channel_id} is active = ', channels[channel_id]['is_active'], time.time())
 
 def standup_start_v1(token: Union[str, bytes], channel_id: int, length: int) -> dict:
@@ -53,8 +57,9 @@ def standup_start_v1(token: Union[str, bytes], channel_id: int, length: int) ->
         raise InputError(description='an active standup is currently running in this channel')
 
     channels[channel_id]['is_active'] = True
+    mark_dirty('channels', channel_id)
     # print(f'start# {channel_id} is active = ', channels[channel_id]['is_active'], time.time())
-    t = Timer(length, end_standup, [channel_id])
+    t = Timer(length, locked(end_standup), [channel_id])
     t.start()
     return {'time_finished': datetime.now().timestamp()}
 
@@ -139,6 +144,7 @@ def standup_send_v1(token: Union[str, bytes], channel_id: int, message: str) ->
         'is_pinned': False
     }
 
-    channels[channel_id]['buffer'].insert(0, message_info)
+    channels[channel_id]['buffer'].append(message_info)
+    mark_dirty('channels', channel_id)
 
     return {}
\ No newline at end of file
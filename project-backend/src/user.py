@@ -9,7 +9,7 @@ from typing import Union
 from datetime import datetime
 
 import src.helper as helper 
-from src.data import users, dms, channels
+from src.data import users, dms, channels, mark_dirty, unlocked
 from src.auth import generate_token, new_session_id
 from src.error import InputError
 from src.channels import channels_list_v1
@@ -104,6 +104,7 @@ def user_profile_setname_v2(token: Union[str, bytes], name_first: str, name_last
         
     users[token_decoded['auth_user_id']]['name_last'] = name_last
     users[token_decoded['auth_user_id']]['name_first'] = name_first
+    mark_dirty('users', token_decoded['auth_user_id'])
             
     return {}
     
@@ -133,11 +134,11 @@ def user_profile_setemail_v2(token: Union[str, bytes], email: str) -> dict:
     if email is None or not re.search(email_regex, email):
         raise InputError(description='Invalid email address!')
         
-    for user in users: 
-        if users[user]['email'] == email and user != token_decoded['auth_user_id']:
-            raise InputError(description='Email address is already being used by another.')
+    owner = helper.find_email(email)
+    if owner is not None and owner != token_decoded['auth_user_id']:
+        raise InputError(description='Email address is already being used by another.')
     
-    users[token_decoded['auth_user_id']]['email'] = email
+    helper.set_email(token_decoded['auth_user_id'], email)
     
     return {}
 
@@ -164,12 +165,12 @@ def user_profile_sethandle_v2(token: Union[str, bytes], handle_str: str) -> dict
         raise InputError(description='Invalid length of handle_str!')
   
     # Check for existing handle_str
-    for user in users: 
-        if users[user]['handle_str'] == handle_str and user != token_decoded['auth_user_id']:
-            raise InputError(description='Email address is already being used by another user.')        
+    owner = helper.check_handle(handle_str)
+    if owner is not None and owner != token_decoded['auth_user_id']:
+        raise InputError(description='Email address is already being used by another user.')        
     
     # Change handle
-    users[token_decoded['auth_user_id']]['handle_str'] = handle_str
+    helper.set_handle(token_decoded['auth_user_id'], handle_str)
             
     return {}
     
@@ -274,10 +275,34 @@ def user_profile_uploadphoto(token: Union[str, bytes], img_url: str, x_start: in
 
     file_name = str(token_decoded['auth_user_id']) + '.jpg'
     path_name = 'src/static/' + file_name
+
+    # Downloading and cropping the image touch none of the collections, so
+    # other requests run in the meantime
+    with unlocked():
+        crop_photo(img_url, path_name, (x_start, y_start, x_end, y_end))
+
+    # The session may have ended while the lock was let go
+    helper.token_check(token)
+    new_url = url_for('static', filename=file_name, _external=True)
+    
+    #updating profile photo in global variable 
+    users[token_decoded['auth_user_id']]['profile_img_url'] = new_url
+    mark_dirty('users', token_decoded['auth_user_id'])
+    
+    return {}
+
+
     
+
+def crop_photo(img_url: str, path_name: str, box: tuple):
+    '''
+    Downloads the image at img_url to path_name and crops it to box, as
+    (x_start, y_start, x_end, y_end)
+    '''
+    x_start, y_start, x_end, y_end = box
     #opening the image  
     try:
-        pp = urllib.request.urlretrieve(img_url, path_name)
+        urllib.request.urlretrieve(img_url, path_name)
     except Exception as e:
         raise InputError(description="Image URL cannot be opened") from e
     
@@ -297,13 +322,3 @@ def user_profile_uploadphoto(token: Union[str, bytes], img_url: str, x_start: in
     #cropping image
     pp = pp.crop((x_start, y_start, x_end, y_end))
     pp.save(path_name)
-
-    new_url = url_for('static', filename=file_name, _external=True)
-    
-    #updating profile photo in global variable 
-    users[token_decoded['auth_user_id']]['profile_img_url'] = new_url
-    
-    return {}
-
-
-    
@@ -0,0 +1,64 @@
+'''
+Hashed timing wheel for expiring keys in bulk.
+
+A key due to expire at time t is kept in slot (t // tick) % number of slots,
+so scheduling and cancelling a key are O(1), and advancing the wheel only
+looks at the slots of the ticks that went by. Keys due more than a full turn
+of the wheel away share a slot with sooner ones and are left there until
+their own turn comes.
+'''
+from typing import Hashable
+
+class TimingWheel:
+    def __init__(self, tick: float, num_slots: int):
+        self.tick = tick
+        self.slots = [{} for _ in range(num_slots)]
+        # Slot of every key on the wheel
+        self.keys = {}
+        # Last tick whose slot was swept
+        self.swept = None
+
+    def schedule(self, key: Hashable, expiry: float):
+        '''
+        Schedules key to expire at expiry, in place of any earlier schedule.
+        Keys already due go in the slot swept next.
+        '''
+        self.cancel(key)
+        tick = int(expiry // self.tick)
+        if self.swept is not None:
+            tick = max(tick, self.swept + 1)
+        slot = tick % len(self.slots)
+        self.slots[slot][key] = expiry
+        self.keys[key] = slot
+
+    def cancel(self, key: Hashable):
+        slot = self.keys.pop(key, None)
+        if slot is not None:
+            del self.slots[slot][key]
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def advance(self, now: float) -> list:
+        '''
+        Removes and returns the keys due by now, as of the last whole tick
+        '''
+        last = int(now // self.tick) - 1
+        first = last - len(self.slots) + 1 if self.swept is None else \
+            max(self.swept + 1, last - len(self.slots) + 1)
+        expired = []
+        for tick in range(first, last + 1):
+            slot = self.slots[tick % len(self.slots)]
+            due = [key for key, expiry in slot.items() if expiry <= now]
+            for key in due:
+                del slot[key]
+                del self.keys[key]
+            expired += due
+        self.swept = max(last, self.swept if self.swept is not None else last)
+        return expired
+
+    def clear(self):
+        for slot in self.slots:
+            slot.clear()
+        self.keys.clear()
+        self.swept = None
@@ -68,3 +68,8 @@ def test_remove(setup):
     assert profile['name_last'] == 'user'
     details = channel_messages_v1(setup['user1']['token'], setup['channels'], 0)
     assert details['messages'][0]['message'] == 'Removed user'
+
+def test_removed_user_is_logged_out(setup):
+    admin_user_remove_v1(setup['user1']['token'], 2)
+    with pytest.raises(AccessError):
+        channels_create_v1(setup['user2']['token'], 'channel3', True)
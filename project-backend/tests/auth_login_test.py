@@ -1,8 +1,13 @@
 import pytest
 import json
+import hashlib
+import threading
 
 from src.auth import auth_register_v1, auth_login_v1
-from src.error import InputError
+from src.error import InputError, ServiceUnavailableError
+from src.data import users
+from src import config
+import src.passwords as passwords
 from src.other import clear_v1
 
 #Global safe informations
@@ -51,3 +56,35 @@ def test_incorrect_password(setup):
         auth_login_v1('apple@com.au', 'wrongpassword')
     with pytest.raises(InputError):
         auth_login_v1('banana@com.au', 'wrongpassword')
+
+def test_login_ignores_email_case(setup):
+    login = auth_login_v1('Apple@COM.au', 'password1')
+    assert login['auth_user_id'] == setup['u1']['auth_user_id']
+    with pytest.raises(InputError):
+        auth_register_v1('APPLE@com.au', 'password1', 'Steve', 'Jobs')
+
+def test_login_rehashes_legacy_password(setup):
+    u_id = setup['u1']['auth_user_id']
+    users[u_id]['password'] = hashlib.sha256('password1'.encode()).hexdigest()
+    assert auth_login_v1('apple@com.au', 'password1')['auth_user_id'] == u_id
+    assert users[u_id]['password'].startswith('$pbkdf2-sha256$')
+    assert not passwords.needs_rehash(users[u_id]['password'])
+    assert auth_login_v1('apple@com.au', 'password1')['auth_user_id'] == u_id
+    with pytest.raises(InputError):
+        auth_login_v1('apple@com.au', 'password2')
+
+def test_login_rehashes_on_kdf_change(setup, monkeypatch):
+    monkeypatch.setattr(config, 'password_kdf', 'scrypt')
+    monkeypatch.setattr(config, 'scrypt_n', 2 ** 10)
+    u_id = setup['u1']['auth_user_id']
+    auth_login_v1('apple@com.au', 'password1')
+    assert users[u_id]['password'].startswith('$scrypt$1024$8$1$')
+    assert auth_login_v1('apple@com.au', 'password1')['auth_user_id'] == u_id
+
+def test_hashing_queue_applies_back_pressure(setup, monkeypatch):
+    monkeypatch.setattr(config, 'password_queue_timeout', 0)
+    passwords.run(len, '')
+    monkeypatch.setattr(passwords, 'queue', threading.BoundedSemaphore(1))
+    passwords.queue.acquire()
+    with pytest.raises(ServiceUnavailableError):
+        auth_login_v1('apple@com.au', 'password1')
@@ -1,10 +1,16 @@
 import pytest
 import json
 
-from src.auth import auth_logout_v1, auth_login_v1, auth_register_v1
+from time import time
+
+from src.auth import auth_logout_v1, auth_logout_all_v1, auth_login_v1, auth_register_v1, \
+    new_session_id
 from src.error import AccessError
 from src.other import clear_v1
 import src.helper as helper
+import src.metrics as metrics
+import src.data as data
+from src import config
 
 @pytest.fixture()
 def setup():
@@ -34,3 +40,101 @@ def test_login_logout(setup):
     lo2 = auth_logout_v1(setup['u2'])
     assert lo1['is_success'] == True
     assert lo2['is_success'] == True
+
+def test_logged_out_token_is_rejected(setup):
+    auth_logout_v1(setup['u2'])
+    assert helper.check_token(setup['u2'])['auth_user_id'] is None
+    with pytest.raises(AccessError):
+        auth_logout_v1(setup['u2'])
+
+def test_token_cache_counts_hits_and_misses(setup):
+    helper.token_cache.clear()
+    misses = metrics.get_metrics().get('token_cache_misses', 0)
+    hits = metrics.get_metrics().get('token_cache_hits', 0)
+    helper.token_check(setup['u2'])
+    helper.token_check(setup['u2'])
+    assert metrics.get_metrics()['token_cache_misses'] == misses + 1
+    assert metrics.get_metrics()['token_cache_hits'] == hits + 1
+
+def test_token_cache_evicts_on_logout(setup):
+    helper.token_check(setup['u2'])
+    assert setup['u2'] in helper.token_cache.entries
+    auth_logout_v1(setup['u2'])
+    assert setup['u2'] not in helper.token_cache.entries
+
+def test_token_cache_is_bounded(setup, monkeypatch):
+    monkeypatch.setattr(config, 'token_cache_size', 2)
+    helper.token_cache.clear()
+    for token in (setup['u1']['token'], setup['u2'], setup['u3']):
+        helper.token_check(token)
+    assert list(helper.token_cache.entries) == [setup['u2'], setup['u3']]
+    assert helper.check_token(setup['u1']['token'])['auth_user_id'] == setup['u1']['auth_user_id']
+
+def test_token_cache_keys_bytes_tokens_as_str(setup, monkeypatch):
+    monkeypatch.setattr(config, 'token_cache_size', 1)
+    helper.token_cache.clear()
+    helper.token_check(setup['u2'])
+    helper.token_check(setup['u2'].encode())
+    assert list(helper.token_cache.entries) == [setup['u2']]
+    helper.token_check(setup['u3'])
+    assert list(helper.token_cache.entries) == [setup['u3']]
+    auth_logout_v1(setup['u3'].encode())
+    assert helper.token_cache.entries == {} and helper.token_cache.tokens == {}
+    with pytest.raises(AccessError):
+        helper.token_check(setup['u3'])
+
+def session_of(token) -> str:
+    return helper.decode_session(token)
+
+def test_session_issued_from_session_id():
+    assert abs(data.session_issued(new_session_id(), 0) - time()) < 5
+
+def test_idle_session_expires(setup):
+    session_id = session_of(setup['u2'])
+    issued, last_seen = data.session_times[session_id]
+    data.session_times[session_id][1] -= config.session_idle_s + 1
+    assert helper.check_token(setup['u2'])['auth_user_id'] is None
+    helper.sweep(last_seen + config.session_idle_s + 2 * config.sweep_s)
+    assert session_id not in data.sessions
+    assert session_id not in data.users[2]['session_id']
+
+def test_used_session_stays_live(setup):
+    session_id = session_of(setup['u2'])
+    last_seen = data.session_times[session_id][1]
+    # Used again 100 seconds later
+    data.session_times[session_id][1] += 100
+    helper.sweep(last_seen + config.session_idle_s + 2 * config.sweep_s)
+    assert session_id in data.users[2]['session_id']
+    helper.sweep(last_seen + config.session_idle_s + 100 + 2 * config.sweep_s)
+    assert session_id not in data.users[2]['session_id']
+
+def test_old_session_expires(setup):
+    session_id = session_of(setup['u2'])
+    data.session_times[session_id][0] -= config.session_max_age_s + 1
+    with pytest.raises(AccessError):
+        helper.token_check(setup['u2'])
+
+def test_sessions_per_user_capped(setup, monkeypatch):
+    monkeypatch.setattr(config, 'sessions_per_user', 3)
+    expired = metrics.get_metrics().get('sessions_evicted', 0)
+    tokens = [setup['u1']['token']] + \
+        [auth_login_v1('apple@com.au', 'password1')['token'] for _ in range(2)]
+    data.session_times[session_of(tokens[1])][1] -= 10
+    latest = auth_login_v1('apple@com.au', 'password1')['token']
+    assert len(data.users[1]['session_id']) == 3
+    with pytest.raises(AccessError):
+        helper.token_check(tokens[1])
+    for token in (tokens[0], tokens[2], latest):
+        helper.token_check(token)
+    assert metrics.get_metrics()['sessions_evicted'] == expired + 1
+    assert metrics.get_metrics()['sessions_live'] == len(data.sessions) == 5
+
+def test_logout_everywhere(setup):
+    tokens = [setup['u1']['token']] + [auth_login_v1('apple@com.au', 'password1')['token'] \
+        for _ in range(2)]
+    assert auth_logout_all_v1(tokens[1]) == {'num_sessions': 3}
+    for token in tokens:
+        with pytest.raises(AccessError):
+            helper.token_check(token)
+    assert data.users[setup['u1']['auth_user_id']]['session_id'] == []
+    helper.token_check(setup['u2'])
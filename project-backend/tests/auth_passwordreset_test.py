@@ -2,11 +2,16 @@ import pytest
 import json
 
 from src.auth import auth_register_v1, auth_passwordreset_request_v1, \
-                    auth_passwordreset_reset_v1, password_encode
+                    auth_passwordreset_reset_v1
+import src.passwords as passwords
 from src.error import InputError, AccessError
 from src.other import clear_v1
 from src.data import users
 import src.helper as helper
+import src.auth as auth
+import src.data as data
+from src import config
+from time import time
 
 '''
 These tests will test the functionality of of the auth_password_reset_v1 and 
@@ -34,7 +39,7 @@ def test_password_reset_valid_owner():
     # Dreams Owner change the password
     assert auth_passwordreset_reset_v1(users[user1['auth_user_id']]['reset_code'][0], "X3e$rfv") == {}
 
-    assert users[user1['auth_user_id']]['password'] == password_encode("X3e$rfv")
+    assert passwords.check_hash("X3e$rfv", users[user1['auth_user_id']]['password'])
 
 def test_password_reset_invalid_user():
     clear_v1()
@@ -58,7 +63,7 @@ def test_password_reset_valid_member():
     # User 2 change the password
     assert auth_passwordreset_reset_v1(users[user2['auth_user_id']]['reset_code'][0], "X3e$rfv") == {}
 
-    assert users[user2['auth_user_id']]['password'] == password_encode("X3e$rfv")
+    assert passwords.check_hash("X3e$rfv", users[user2['auth_user_id']]['password'])
   
 
 def test_password_reset_invalid_reset_code():
@@ -103,3 +108,75 @@ def test_new_password_reset():
     with pytest.raises(InputError):
         auth_passwordreset_reset_v1(reset_code, "Q67")
 
+
+@pytest.fixture
+def offline(monkeypatch):
+    '''
+    Registers a user, with reset emails going nowhere
+    '''
+    monkeypatch.setattr(auth, 'send_email', lambda email, reset_code: None)
+    clear_v1()
+    return auth_register_v1('apple@gmail.com', 'password1', 'Steve', 'Jobs')
+
+def test_reset_code_is_single_use(offline):
+    '''
+    This test checks that a reset code cannot be redeemed twice
+    '''
+    auth_passwordreset_request_v1('apple@gmail.com')
+    reset_code = users[offline['auth_user_id']]['reset_code'][0]
+    auth_passwordreset_reset_v1(reset_code, 'password2')
+    assert users[offline['auth_user_id']]['reset_code'] == []
+    with pytest.raises(InputError):
+        auth_passwordreset_reset_v1(reset_code, 'password3')
+
+def test_reset_code_expires(offline):
+    '''
+    This test checks that expired reset codes are rejected, then swept away
+    '''
+    auth_passwordreset_request_v1('apple@gmail.com')
+    reset_code = users[offline['auth_user_id']]['reset_code'][0]
+    expired = time() + config.reset_code_ttl + 2 * config.sweep_s
+    helper.expire_reset_codes(expired - 3 * config.reset_code_ttl)
+    assert helper.reset_code_user(reset_code) == offline['auth_user_id']
+    helper.expire_reset_codes(expired)
+    assert users[offline['auth_user_id']]['reset_code'] == []
+    assert reset_code not in data.reset_codes
+    with pytest.raises(InputError):
+        auth_passwordreset_reset_v1(reset_code, 'password2')
+
+def test_reset_codes_are_unique(offline, monkeypatch):
+    '''
+    This test checks that every unredeemed reset code is different
+    '''
+    monkeypatch.setattr(config, 'reset_codes_per_user', 200)
+    for _ in range(200):
+        auth_passwordreset_request_v1('apple@gmail.com')
+    assert len(set(users[offline['auth_user_id']]['reset_code'])) == 200
+
+def test_reset_codes_replace_oldest(offline):
+    '''
+    This test checks that a user's oldest reset code is revoked once they hold
+    the most they may
+    '''
+    for _ in range(config.reset_codes_per_user):
+        auth_passwordreset_request_v1('apple@gmail.com')
+    oldest = users[offline['auth_user_id']]['reset_code'][0]
+    auth_passwordreset_request_v1('apple@gmail.com')
+    assert len(users[offline['auth_user_id']]['reset_code']) == config.reset_codes_per_user
+    assert oldest not in data.reset_codes
+    with pytest.raises(InputError):
+        auth_passwordreset_reset_v1(oldest, 'password2')
+
+def test_reset_codes_never_run_out(offline, monkeypatch):
+    '''
+    This test checks that once every reset code is taken, the oldest is
+    revoked rather than refusing new requests
+    '''
+    monkeypatch.setattr(config, 'reset_codes_per_user', 10 ** data.RESET_CODE_DIGITS + 1)
+    for _ in range(10 ** data.RESET_CODE_DIGITS):
+        auth_passwordreset_request_v1('apple@gmail.com')
+    issued = users[offline['auth_user_id']]['reset_code']
+    oldest = issued[0]
+    auth_passwordreset_request_v1('apple@gmail.com')
+    assert len(data.reset_codes) == 10 ** data.RESET_CODE_DIGITS
+    assert issued[0] != oldest and issued[-1] == oldest
@@ -4,6 +4,8 @@ import json
 from src.auth import auth_register_v1
 from src.error import InputError
 from src.other import clear_v1
+from src.user import user_profile_sethandle_v2
+from src.data import users
     
 #Global safe informations
 safe_email = 'iamhappy@unsw.org'
@@ -64,3 +66,41 @@ def test_return_new_id():
     assert result['auth_user_id'] == 2
     result = auth_register_v1('watermelon@com.au', safe_password, 'Looooooooooooooong', 'Name')
     assert result['auth_user_id'] == 3
+
+def scanned_handle(name_first, name_last):
+    '''
+    Handle generation by scanning every user, as make_handle used to do
+    '''
+    concat = (name_first + name_last).lower()[:20]
+    copy_concat = concat
+    append_number = 0
+    for user in users:
+        if users[user]['handle_str'] == copy_concat:
+            copy_concat = concat + str(append_number)
+            append_number += 1
+    return copy_concat
+
+#handles are unique, and the same as scanning every user would generate
+def test_handles_match_scan():
+    clear_v1()
+    names = [('Steve', 'Jobs'), ('Steve', 'Jobs'), ('Steven', 'Jacobs'), ('Steve', 'Jobs'),
+             ('Thisisaverylongname', 'Forahandle'), ('Thisisaverylongname', 'Forahandlex'),
+             ('Steve', 'Jobs0')]
+    for i, (name_first, name_last) in enumerate(names):
+        expected = scanned_handle(name_first, name_last)
+        u_id = auth_register_v1(f'user{i}@email.com', safe_password, name_first, name_last)['auth_user_id']
+        assert users[u_id]['handle_str'] == expected
+    assert len({user['handle_str'] for user in users.values()}) == len(names)
+
+#a handle given up through sethandle is generated again
+def test_freed_handle_is_reused():
+    clear_v1()
+    tokens = [auth_register_v1(f'user{i}@email.com', safe_password, 'Steve', 'Jobs')['token'] \
+        for i in range(3)]
+    user_profile_sethandle_v2(tokens[1], 'stevo')
+    expected = scanned_handle('Steve', 'Jobs')
+    assert expected == 'stevejobs0'
+    u_id = auth_register_v1('user3@email.com', safe_password, 'Steve', 'Jobs')['auth_user_id']
+    assert users[u_id]['handle_str'] == expected
+    u_id = auth_register_v1('user4@email.com', safe_password, 'Steve', 'Jobs')['auth_user_id']
+    assert users[u_id]['handle_str'] == 'stevejobs2'
@@ -11,6 +11,7 @@ from src.channel import channel_invite_v1, channel_details_v1, \
 from src.channels import channels_create_v1, channels_list_v1
 from src.error import InputError, AccessError
 from src.other import clear_v1
+from src.user import user_profile_setname_v2, user_profile_sethandle_v2
 import time
 
 @pytest.fixture
@@ -188,3 +189,17 @@ def test_channel_invite_v1_except(setup):
         # test case: u_id does not refer to a valid user
         channel_invite_v1(setup['sample_user1']['token'], setup['private_channel'], 0)
 
+
+def test_channel_details_shows_current_profiles(setup):
+    channel_invite_v1(setup['sample_user1']['token'], setup['private_channel'], setup['sample_user2']['auth_user_id'])
+    user_profile_setname_v2(setup['sample_user2']['token'], 'Tim', 'Cook')
+    user_profile_sethandle_v2(setup['sample_user1']['token'], 'steve')
+
+    # Members are still members after changing their profile
+    channel_leave_v1(setup['sample_user2']['token'], setup['private_channel'])
+    channel_invite_v1(setup['sample_user1']['token'], setup['private_channel'], setup['sample_user2']['auth_user_id'])
+
+    details = channel_details_v1(setup['sample_user2']['token'], setup['private_channel'])
+    assert [member['handle_str'] for member in details['owner_members']] == ['steve']
+    assert [(member['name_first'], member['name_last']) for member in details['all_members']] == \
+        [('Steve', 'Jobs'), ('Tim', 'Cook')]
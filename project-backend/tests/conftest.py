@@ -0,0 +1,40 @@
+'''
+Settings shared by every test
+'''
+import socket
+import pytest
+
+import src.mail as mail
+from src import config
+
+@pytest.fixture(autouse=True, scope='session')
+def cheap_password_hashing():
+    '''
+    Hashes passwords at a fraction of the production cost, as the tests
+    register and log in hundreds of users
+    '''
+    iterations = config.pbkdf2_iterations
+    config.pbkdf2_iterations = 1000
+    yield
+    config.pbkdf2_iterations = iterations
+
+@pytest.fixture(autouse=True)
+def local_mail(tmp_path, monkeypatch):
+    '''
+    Spools each test's mail in its own directory, for a local SMTP server
+    that is not running, so no test writes to the working directory or
+    reaches the real mail server
+    '''
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    monkeypatch.setattr(config, 'mail_spool_path', str(tmp_path / 'maildb.jsonl'))
+    monkeypatch.setattr(config, 'mail_host', '127.0.0.1')
+    monkeypatch.setattr(config, 'mail_port', port)
+    monkeypatch.setattr(config, 'mail_starttls', False)
+    monkeypatch.setattr(config, 'mail_user', '')
+    yield
+    mail.stop_sender()
+    mail.pending.clear()
+    mail.attempts.clear()
+    mail.spool_loaded = False
@@ -0,0 +1,513 @@
+'''
+Tests for persisting the database through the journal
+'''
+import io
+import os
+import copy
+import threading
+import pytest
+
+import src.data as db
+import src.sqlite_storage as sqlite_storage
+import src.compressed as compressed
+import src.metrics as metrics
+import src.helper as helper
+from src import config
+from src.auth import auth_register_v1, auth_login_v1
+from src.channels import channels_create_v1
+from src.channel import channel_invite_v1, channel_details_v1, channel_messages_v1
+from src.dm import dm_create_v1, dm_remove_v1, dm_leave_v1, dm_messages_v1
+from src.message import message_send_v1, message_edit_v1, message_remove_v1, \
+                        message_react_v1
+from src.other import clear_v1
+
+@pytest.fixture
+def setup(tmp_path, monkeypatch):
+    '''
+    Runs each test in an empty directory with the journal enabled, and
+    creates two users sharing a channel and a dm.
+    '''
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(config, 'journal', True)
+    monkeypatch.setattr(config, 'durability', 'sync')
+    clear_v1()
+    user1 = auth_register_v1('apple@com.au', 'password1', 'Steve', 'Jobs')
+    user2 = auth_register_v1('banana@com.au', 'password2', 'Steven', 'Jacobs')
+    channel = channels_create_v1(user1['token'], 'channel1', True)
+    channel_invite_v1(user1['token'], channel, user2['auth_user_id'])
+    dm = dm_create_v1(user1['token'], [user2['auth_user_id']])['dm_id']
+    db.commit()
+    yield {
+        'user1': user1,
+        'user2': user2,
+        'channel': channel,
+        'dm': dm,
+    }
+    db.stop_flusher()
+
+def snapshot_state() -> dict:
+    return copy.deepcopy({'users': db.users, 'channels': db.channels, 'dms': db.dms})
+
+def restart():
+    '''
+    Drops the in-memory database without journaling it and loads it back
+    from disk, as a server restart would.
+    '''
+    for collection in db.COLLECTIONS.values():
+        collection.clear()
+    db.load_db()
+
+def test_journal_replay(setup):
+    m1 = message_send_v1(setup['user1']['token'], setup['channel'], 'hello', True)
+    m2 = message_send_v1(setup['user2']['token'], setup['channel'], 'world', True)
+    m3 = message_send_v1(setup['user1']['token'], setup['dm'], 'psst', False)
+    message_edit_v1(setup['user1']['token'], m1, 'hello @stevenjacobs')
+    message_react_v1(setup['user2']['token'], m3, 1)
+    message_remove_v1(setup['user2']['token'], m2)
+    db.commit()
+
+    state = snapshot_state()
+    restart()
+    assert snapshot_state() == state
+
+def test_journal_records_only_changes(setup):
+    for _ in range(20):
+        message_send_v1(setup['user1']['token'], setup['channel'], 'filler', True)
+    db.commit()
+
+    message_send_v1(setup['user1']['token'], setup['channel'], 'one more', True)
+    records = db.pending_records()
+    assert len(records) == 1
+    assert records[0]['op'] == 'msg'
+    assert records[0]['value']['message'] == 'one more'
+
+def test_journal_delete_and_clear(setup):
+    dm_remove_v1(setup['user1']['token'], setup['dm'])
+    db.commit()
+    restart()
+    assert setup['dm'] not in db.dms
+
+    clear_v1()
+    db.commit()
+    restart()
+    assert db.users == {} and db.channels == {} and db.dms == {}
+
+def test_journal_compaction(setup, monkeypatch):
+    monkeypatch.setattr(config, 'journal_compact_records', 5)
+    for _ in range(5):
+        message_send_v1(setup['user1']['token'], setup['dm'], 'hi', False)
+        db.commit()
+    db.join_compaction()
+    assert db.journal_records < 5
+    assert db.snapshot_lsn > 0
+
+    message_send_v1(setup['user1']['token'], setup['dm'], 'after compaction', False)
+    db.commit()
+    state = snapshot_state()
+    restart()
+    assert snapshot_state() == state
+    assert len(db.dms[setup['dm']]['messages']) == 6
+
+def test_compaction_runs_without_the_database_lock(setup):
+    message_send_v1(setup['user1']['token'], setup['dm'], 'hi', False)
+    db.commit()
+    # Requests hold the lock for their whole duration; compaction must not
+    # need it
+    with db.lock:
+        db.start_compaction()
+        db.compactor.join(timeout=10)
+        assert not db.compactor.is_alive()
+    assert not os.path.exists(config.journal_path)
+    state = snapshot_state()
+    restart()
+    assert snapshot_state() == state
+
+def test_recovery_from_interrupted_compaction(setup):
+    message_send_v1(setup['user1']['token'], setup['dm'], 'before', False)
+    db.commit()
+    # A crash right after the journal was renamed aside for compaction
+    os.rename(config.journal_path, db.frozen_journal_path())
+    message_send_v1(setup['user1']['token'], setup['dm'], 'after', False)
+    db.commit()
+    state = snapshot_state()
+    restart()
+    assert snapshot_state() == state
+
+    db.compact_journal()
+    assert not os.path.exists(db.frozen_journal_path())
+    restart()
+    assert snapshot_state() == state
+    assert db.replay_journal() == 0
+
+@pytest.fixture
+def sqlite_setup(setup, monkeypatch):
+    '''
+    Switches the setup database over to the SQLite storage engine.
+    '''
+    monkeypatch.setattr(config, 'storage', 'sqlite')
+    db.save_db()
+    yield setup
+    sqlite_storage.close()
+
+def test_sqlite_round_trip(sqlite_setup):
+    setup = sqlite_setup
+    m1 = message_send_v1(setup['user1']['token'], setup['channel'], 'hello', True)
+    message_send_v1(setup['user2']['token'], setup['channel'], 'world', True)
+    message_send_v1(setup['user1']['token'], setup['dm'], 'psst', False)
+    message_react_v1(setup['user2']['token'], m1, 1)
+    db.commit()
+
+    state = snapshot_state()
+    restart()
+    assert snapshot_state() == state
+
+def test_sqlite_syncs_every_durable_commit(sqlite_setup, monkeypatch):
+    # 2 is FULL, 1 is NORMAL
+    assert sqlite_storage.connect().execute('PRAGMA synchronous').fetchone()[0] == 2
+    sqlite_storage.close()
+    monkeypatch.setattr(config, 'durability', 'async')
+    assert sqlite_storage.connect().execute('PRAGMA synchronous').fetchone()[0] == 1
+
+def test_sqlite_delete_and_clear(sqlite_setup):
+    setup = sqlite_setup
+    message_send_v1(setup['user1']['token'], setup['dm'], 'psst', False)
+    db.commit()
+    dm_remove_v1(setup['user1']['token'], setup['dm'])
+    db.commit()
+    restart()
+    assert setup['dm'] not in db.dms
+    assert setup['channel'] in db.channels
+
+    clear_v1()
+    db.commit()
+    restart()
+    assert db.users == {} and db.channels == {} and db.dms == {}
+
+def test_snapshot_writes_only_dirty_collections(setup, monkeypatch):
+    monkeypatch.setattr(config, 'journal', False)
+    db.save_db()
+    message_send_v1(setup['user1']['token'], setup['dm'], 'psst', False)
+    assert db.dirty_collections() == ['dms']
+
+    users_written = os.path.getmtime('usersdb.json')
+    db.commit()
+    assert os.path.getmtime('usersdb.json') == users_written
+    assert metrics.get_metrics()['bytes_written_last_commit'] == os.path.getsize('dmsdb.json')
+
+def test_journal_bytes_written(setup):
+    message_send_v1(setup['user1']['token'], setup['dm'], 'psst', False)
+    journal_size = os.path.getsize(config.journal_path)
+    db.commit()
+    written = metrics.get_metrics()['bytes_written_last_commit']
+    assert written == os.path.getsize(config.journal_path) - journal_size
+
+def test_group_commit(setup, monkeypatch):
+    monkeypatch.setattr(config, 'durability', 'group')
+    monkeypatch.setattr(config, 'group_commit_ms', 50)
+    commits = metrics.get_metrics()['commits']
+
+    def send(token, count):
+        for _ in range(count):
+            with db.lock:
+                message_send_v1(token, setup['dm'], 'hi', False)
+                ticket = db.commit()
+            db.wait_durable(ticket)
+            assert db.flushed_generation >= ticket
+
+    threads = [threading.Thread(target=send, args=[setup[user]['token'], 10]) \
+        for user in ('user1', 'user2') for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    db.stop_flusher()
+    assert db.flusher is None
+
+    # 80 requests, but waiting requests share flushes
+    assert metrics.get_metrics()['commits'] - commits < 80
+    state = snapshot_state()
+    restart()
+    assert snapshot_state() == state
+    assert len(db.dms[setup['dm']]['messages']) == 80
+
+def test_failed_flush_is_retried(setup, monkeypatch):
+    monkeypatch.setattr(config, 'durability', 'group')
+    # Flushed by hand below
+    monkeypatch.setattr(db, 'start_flusher', lambda: None)
+    append_journal = db.append_journal
+    def failing_append(lines):
+        raise OSError('disk full')
+    monkeypatch.setattr(db, 'append_journal', failing_append)
+
+    with db.lock:
+        message_id = message_send_v1(setup['user1']['token'], setup['dm'], 'hi', False)
+        ticket = db.commit()
+    db.flush()
+    # Not durable, so not acknowledged
+    assert db.flushed_generation < ticket
+
+    monkeypatch.setattr(db, 'append_journal', append_journal)
+    db.flush()
+    assert db.flushed_generation >= ticket
+    restart()
+    assert [msg['message_id'] for msg in db.dms[setup['dm']]['messages']] == [message_id]
+
+def test_failed_sync_commit_is_retried(setup, monkeypatch):
+    append_journal = db.append_journal
+    def failing_append(lines):
+        raise OSError('disk full')
+    monkeypatch.setattr(db, 'append_journal', failing_append)
+    message_id = message_send_v1(setup['user1']['token'], setup['dm'], 'hi', False)
+    with pytest.raises(OSError):
+        db.commit()
+
+    monkeypatch.setattr(db, 'append_journal', append_journal)
+    db.commit()
+    restart()
+    assert [msg['message_id'] for msg in db.dms[setup['dm']]['messages']] == [message_id]
+
+def test_binary_snapshot_loads_messages_lazily(setup, monkeypatch):
+    monkeypatch.setattr(config, 'snapshot_format', 'binary')
+    message_send_v1(setup['user1']['token'], setup['channel'], 'hello', True)
+    message_send_v1(setup['user2']['token'], setup['dm'], 'psst', False)
+    db.commit()
+    db.compact_journal()
+    state = snapshot_state()
+    restart()
+
+    channel = db.channels[setup['channel']]
+    assert channel['name'] == 'channel1'
+    assert dict.get(channel, 'messages') is None
+    assert channel['messages'][0]['message'] == 'hello'
+    assert snapshot_state() == state
+
+def test_binary_snapshot_copies_undecoded_messages(setup, monkeypatch):
+    monkeypatch.setattr(config, 'snapshot_format', 'binary')
+    message_send_v1(setup['user1']['token'], setup['channel'], 'hello', True)
+    db.commit()
+    db.compact_journal()
+    restart()
+
+    # The channel's messages are never decoded, only copied to the new snapshot
+    message_send_v1(setup['user2']['token'], setup['dm'], 'psst', False)
+    db.commit()
+    db.compact_journal()
+    assert dict.get(db.channels[setup['channel']], 'messages') is None
+    state = snapshot_state()
+    restart()
+    assert snapshot_state() == state
+    assert db.channels[setup['channel']]['messages'][0]['message'] == 'hello'
+
+def test_binary_snapshot_indexes_messages_when_looked_up(setup, monkeypatch):
+    monkeypatch.setattr(config, 'snapshot_format', 'binary')
+    m1 = message_send_v1(setup['user1']['token'], setup['channel'], 'hello', True)
+    db.commit()
+    db.compact_journal()
+    restart()
+
+    assert dict.get(db.channels[setup['channel']], 'messages') is None
+    m2 = message_send_v1(setup['user2']['token'], setup['dm'], 'psst', False)
+    assert db.locate_message(m2)[:2] == ('dms', setup['dm'])
+    assert dict.get(db.channels[setup['channel']], 'messages') is None
+    message_edit_v1(setup['user1']['token'], m1, 'hello again')
+    assert db.locate_message(m1)[2] is db.channels[setup['channel']]['messages'][0]
+    assert db.locate_message(0) is None
+
+def test_message_removal_keeps_order(setup):
+    sent = [message_send_v1(setup['user1']['token'], setup['channel'], f'message {i}', True) \
+        for i in range(5)]
+    message_remove_v1(setup['user1']['token'], sent[1])
+    db.commit()
+    restart()
+    message_remove_v1(setup['user1']['token'], sent[3])
+    message_remove_v1(setup['user1']['token'], sent[4])
+    assert [m['message_id'] for m in db.channels[setup['channel']]['messages']] == [sent[0], sent[2]]
+    assert db.locate_message(sent[3]) is None
+    assert sent[3] not in db.message_orders
+
+def test_binary_snapshot_indexes_messages_when_decoded(setup, monkeypatch):
+    monkeypatch.setattr(config, 'snapshot_format', 'binary')
+    m1 = message_send_v1(setup['user1']['token'], setup['channel'], 'hello', True)
+    m2 = message_send_v1(setup['user2']['token'], setup['dm'], 'psst', False)
+    db.commit()
+    db.compact_journal()
+    restart()
+
+    channel_messages_v1(setup['user1']['token'], setup['channel'], 0)
+    assert db.unindexed_messages == {('dms', setup['dm'])}
+    assert db.locate_message(m1)[:2] == ('channels', setup['channel'])
+    assert dict.get(db.dms[setup['dm']], 'messages') is None
+    # Only a miss decodes the rest, after which misses need no decoding
+    assert db.locate_message(0) is None
+    assert db.unindexed_messages == set()
+    assert db.locate_message(m2)[:2] == ('dms', setup['dm'])
+
+def test_binary_snapshot_evicts_unchanged_message_lists(setup, monkeypatch):
+    monkeypatch.setattr(config, 'snapshot_format', 'binary')
+    m1 = message_send_v1(setup['user1']['token'], setup['channel'], 'hello', True)
+    m2 = message_send_v1(setup['user1']['token'], setup['dm'], 'psst', False)
+    db.commit()
+    db.compact_journal()
+    restart()
+    monkeypatch.setattr(config, 'decoded_lists_max', 1)
+
+    channel_messages_v1(setup['user1']['token'], setup['channel'], 0)
+    dm_messages_v1(setup['user1']['token'], setup['dm'], 0)
+    db.evict_decoded()
+    assert dict.get(db.channels[setup['channel']], 'messages') is None
+    assert m1 not in db.message_ids
+    assert dict.get(db.dms[setup['dm']], 'messages') is not None
+    assert db.locate_message(m1)[2]['message'] == 'hello'
+
+    # Changed lists stay in memory
+    message_edit_v1(setup['user1']['token'], m2, 'psst again')
+    monkeypatch.setattr(config, 'decoded_lists_max', 0)
+    db.evict_decoded()
+    assert dict.get(db.channels[setup['channel']], 'messages') is None
+    assert dm_messages_v1(setup['user1']['token'], setup['dm'], 0)['messages'][0]['message'] == 'psst again'
+
+@pytest.fixture
+def sharded_setup(setup, monkeypatch):
+    '''
+    Switches the setup database over to sharded snapshots.
+    '''
+    monkeypatch.setattr(config, 'snapshot_format', 'sharded')
+    # As on a start from the JSON files: no shard written yet
+    monkeypatch.setattr(db, 'stale_shards', None)
+    db.save_db()
+    return setup
+
+def shard_mtimes() -> dict:
+    return {name: os.path.getmtime(os.path.join(config.shard_dir, name)) \
+        for name in os.listdir(config.shard_dir)}
+
+def test_sharded_snapshot_writes_only_changed_shards(sharded_setup, monkeypatch):
+    setup = sharded_setup
+    db.compact_journal()
+    monkeypatch.setattr(config, 'journal', False)
+    before = shard_mtimes()
+    message_send_v1(setup['user1']['token'], setup['dm'], 'psst', False)
+    db.commit()
+    after = shard_mtimes()
+    changed = {name for name in after if after[name] != before.get(name)}
+    assert changed == {f'dms-{setup["dm"]}.json', 'manifest.json'}
+
+    dm_remove_v1(setup['user1']['token'], setup['dm'])
+    db.commit()
+    assert f'dms-{setup["dm"]}.json' not in os.listdir(config.shard_dir)
+    state = snapshot_state()
+    restart()
+    assert snapshot_state() == state
+
+@pytest.mark.parametrize('pool', ['thread', 'process'])
+def test_sharded_snapshot_compaction(sharded_setup, monkeypatch, pool):
+    setup = sharded_setup
+    monkeypatch.setattr(config, 'shard_pool', pool)
+    message_send_v1(setup['user1']['token'], setup['channel'], 'hello', True)
+    message_send_v1(setup['user2']['token'], setup['dm'], 'psst', False)
+    db.commit()
+    before = shard_mtimes()
+    db.compact_journal()
+    after = shard_mtimes()
+    assert after['users.json'] == before['users.json']
+    assert after[f'channels-{setup["channel"]}.json'] != before[f'channels-{setup["channel"]}.json']
+
+    state = snapshot_state()
+    restart()
+    assert snapshot_state() == state
+
+def test_load_restores_integer_keys(setup, monkeypatch):
+    monkeypatch.setattr(config, 'journal', False)
+    db.save_db()
+    restart()
+    assert all(isinstance(key, int) for collection in db.COLLECTIONS.values() for key in collection)
+    assert channel_details_v1(setup['user2']['token'], setup['channel'])['name'] == 'channel1'
+
+def test_load_rejects_malformed_snapshot(setup, monkeypatch):
+    monkeypatch.setattr(config, 'journal', False)
+    db.save_db()
+    with open('dmsdb.json', 'w') as FILE:
+        FILE.write('{"1": {"dm_id": 1, "name": "dm", "owner": "1", "members": [], "messages": []}}')
+    with pytest.raises(ValueError, match=r"dms\[1\]: field 'owner'"):
+        restart()
+
+def test_load_dm_whose_owner_left(setup):
+    dm_leave_v1(setup['user1']['token'], setup['dm'])
+    db.commit()
+    # From the journal, then from a snapshot
+    restart()
+    assert db.dms[setup['dm']]['owner'] is None
+    db.save_db()
+    restart()
+    assert db.dms[setup['dm']]['owner'] is None
+    assert db.dms[setup['dm']]['members'] == [setup['user2']['auth_user_id']]
+
+def test_load_reduces_member_profiles_to_u_ids(setup, monkeypatch):
+    monkeypatch.setattr(config, 'journal', False)
+    user1, user2 = setup['user1']['auth_user_id'], setup['user2']['auth_user_id']
+    # Channels used to hold a copy of each member's profile
+    for field in ('owner_members', 'all_members'):
+        db.channels[setup['channel']][field] = [helper.user_info(u_id) \
+            for u_id in db.channels[setup['channel']][field]]
+    db.save_db()
+    restart()
+    assert db.channels[setup['channel']]['all_members'] == [user1, user2]
+    assert db.channel_members[setup['channel']] == {user1, user2}
+    assert db.channel_owners[setup['channel']] == {user1}
+    assert channel_details_v1(setup['user2']['token'], setup['channel'])['owner_members'] == \
+        [helper.user_info(user1)]
+
+@pytest.mark.parametrize('snapshot_format', ['json', 'binary', 'sharded'])
+def test_messages_are_stored_newest_first(setup, monkeypatch, snapshot_format):
+    monkeypatch.setattr(config, 'journal', False)
+    monkeypatch.setattr(config, 'snapshot_format', snapshot_format)
+    monkeypatch.setattr(db, 'stale_shards', None)
+    sent = [message_send_v1(setup['user1']['token'], setup['channel'], f'message {i}', True) \
+        for i in range(3)]
+    db.save_db()
+    if snapshot_format == 'json':
+        with open(db.snapshot_file('channels')) as FILE:
+            stored = db.loads(FILE.read())[str(setup['channel'])]['messages']
+        assert [msg['message_id'] for msg in stored] == sent[::-1]
+
+    restart()
+    assert [msg['message_id'] for msg in db.channels[setup['channel']]['messages']] == sent
+    page = channel_messages_v1(setup['user1']['token'], setup['channel'], 1)
+    assert [msg['message_id'] for msg in page['messages']] == sent[1::-1]
+    assert page['end'] == -1
+
+@pytest.mark.parametrize('compression', ['gzip', 'zstd'])
+def test_compressed_snapshot_round_trip(setup, monkeypatch, compression):
+    if compression == 'zstd':
+        pytest.importorskip('zstandard')
+    monkeypatch.setattr(config, 'snapshot_compression', compression)
+    for _ in range(20):
+        message_send_v1(setup['user1']['token'], setup['channel'], 'hello hello hello', True)
+    db.commit()
+    db.compact_journal()
+    assert os.path.exists(db.snapshot_file('channels'))
+    assert db.snapshot_file('channels').startswith('channelsdb.jsonl')
+
+    state = snapshot_state()
+    restart()
+    assert snapshot_state() == state
+
+def test_compressed_snapshot_streams_lines():
+    lines = [b'[1, {"a": 1}]', b'[2, {"b": "' + b'x' * 3000 + b'"}]', b'[3, {}]']
+    reader = io.BytesIO(b'\n'.join(lines) + b'\n')
+    assert list(compressed.split_lines(reader, chunk_size=7)) == lines
+
+def test_session_index_is_rebuilt_on_load(setup):
+    token = auth_login_v1('apple@com.au', 'password1')['token']
+    db.commit()
+    restart()
+    assert db.sessions == {session_id: u_id for u_id, user in db.users.items() \
+        for session_id in user['session_id']}
+    assert helper.check_token(token)['auth_user_id'] == setup['user1']['auth_user_id']
+
+def test_membership_index_is_rebuilt_on_load(setup):
+    user1, user2 = setup['user1']['auth_user_id'], setup['user2']['auth_user_id']
+    db.commit()
+    restart()
+    assert db.user_channels == {user1: {setup['channel']}, user2: {setup['channel']}}
+    assert db.user_dms == {user1: {setup['dm']}, user2: {setup['dm']}}
@@ -87,6 +87,11 @@ def test_dm_list_v1(setup):
     assert dm_list_v1(setup['sample_user3']['token']) == answer
 
 
+def test_dm_list_v1_members_before_owners(setup):
+    dm3 = dm_create_v1(setup['sample_user3']['token'], [setup['sample_user2']['auth_user_id']])
+    assert [dm['dm_id'] for dm in dm_list_v1(setup['sample_user2']['token'])] == [
+        setup['sample_dm1']['dm_id'], dm3['dm_id'], setup['sample_dm2']['dm_id']]
+
 def test_dm_list_v1_except(setup):
     with pytest.raises(AccessError):
         # invalid auth_user_id
@@ -108,6 +113,17 @@ def test_dm_leave_v1_except(setup):
 def test_dm_remove_v1(setup):
     assert dm_remove_v1(setup['sample_user2']['token'], setup['sample_dm2']['dm_id']) == {}
 
+def test_dm_list_v1_after_leave_and_remove(setup):
+    dm_leave_v1(setup['sample_user3']['token'], setup['sample_dm1']['dm_id'])
+    dm_remove_v1(setup['sample_user2']['token'], setup['sample_dm2']['dm_id'])
+    assert dm_list_v1(setup['sample_user3']['token']) == []
+    assert dm_list_v1(setup['sample_user2']['token']) == [
+        {'dm_id': setup['sample_dm1']['dm_id'], 'name': setup['sample_dm1']['dm_name']}]
+
+    dm_invite_v1(setup['sample_user1']['token'], setup['sample_dm1']['dm_id'], setup['sample_user3']['auth_user_id'])
+    assert dm_list_v1(setup['sample_user3']['token']) == [
+        {'dm_id': setup['sample_dm1']['dm_id'], 'name': setup['sample_dm1']['dm_name']}]
+
 
 def test_dm_remove_v1_except(setup):
     with pytest.raises(AccessError):
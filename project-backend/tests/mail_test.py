@@ -0,0 +1,111 @@
+'''
+Tests for the outbound mail queue, against a local SMTP server
+'''
+import socket
+import pytest
+
+import src.mail as mail
+import src.metrics as metrics
+from src import config
+from src.auth import auth_register_v1, auth_passwordreset_request_v1
+from src.data import users
+from src.other import clear_v1
+
+controller = pytest.importorskip('aiosmtpd.controller')
+
+class Collect:
+    def __init__(self):
+        self.envelopes = []
+
+    async def handle_DATA(self, server, session, envelope):
+        self.envelopes.append(envelope)
+        return '250 OK'
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def restart_queue():
+    '''
+    Drops the queue's in-memory state, as a server restart would
+    '''
+    mail.stop_sender()
+    mail.pending.clear()
+    mail.attempts.clear()
+    mail.spool_loaded = False
+
+@pytest.fixture
+def smtp(tmp_path, monkeypatch):
+    '''
+    Runs each test in an empty directory, with mail going to a local SMTP
+    server that is not started yet
+    '''
+    monkeypatch.chdir(tmp_path)
+    port = free_port()
+    monkeypatch.setattr(config, 'mail_host', '127.0.0.1')
+    monkeypatch.setattr(config, 'mail_port', port)
+    monkeypatch.setattr(config, 'mail_starttls', False)
+    monkeypatch.setattr(config, 'mail_user', '')
+    monkeypatch.setattr(config, 'mail_retry_s', 0.05)
+    monkeypatch.setattr(config, 'mail_retry_max_s', 0.2)
+    restart_queue()
+    handler = Collect()
+    server = controller.Controller(handler, hostname='127.0.0.1', port=port)
+    yield server, handler
+    restart_queue()
+    try:
+        server.stop()
+    except AssertionError:
+        # Never started
+        pass
+
+def test_messages_sent_in_one_connection(smtp):
+    server, handler = smtp
+    server.start()
+    connections = metrics.get_metrics().get('mail_connections', 0)
+    for i in range(5):
+        mail.enqueue('dreams@com.au', f'user{i}@com.au', f'Subject: {i}\n\nmessage {i}')
+    assert mail.flush(5)
+    assert sorted(envelope.rcpt_tos[0] for envelope in handler.envelopes) == \
+        [f'user{i}@com.au' for i in range(5)]
+    assert metrics.get_metrics()['mail_connections'] == connections + 1
+    with open(config.mail_spool_path) as FILE:
+        assert FILE.read() == ''
+
+def test_retries_until_server_is_up(smtp):
+    server, handler = smtp
+    retries = metrics.get_metrics().get('mail_retries', 0)
+    mail.enqueue('dreams@com.au', 'apple@com.au', 'Subject: hi\n\nhello')
+    assert not mail.flush(0.3)
+    assert metrics.get_metrics()['mail_retries'] > retries
+    server.start()
+    assert mail.flush(5)
+    assert len(handler.envelopes) == 1
+
+def test_gives_up_when_server_stays_down(smtp, monkeypatch):
+    monkeypatch.setattr(config, 'mail_max_attempts', 3)
+    dropped = metrics.get_metrics().get('mail_dropped', 0)
+    for i in range(2):
+        mail.enqueue('dreams@com.au', f'user{i}@com.au', f'Subject: {i}\n\nmessage {i}')
+    assert mail.flush(5)
+    assert metrics.get_metrics()['mail_dropped'] == dropped + 2
+
+def test_queued_messages_survive_restart(smtp):
+    server, handler = smtp
+    mail.enqueue('dreams@com.au', 'apple@com.au', 'Subject: hi\n\nhello')
+    restart_queue()
+    server.start()
+    mail.start_sender()
+    assert mail.flush(5)
+    assert [envelope.rcpt_tos for envelope in handler.envelopes] == [['apple@com.au']]
+
+def test_password_reset_request_is_mailed(smtp):
+    server, handler = smtp
+    server.start()
+    clear_v1()
+    user = auth_register_v1('apple@com.au', 'password1', 'Steve', 'Jobs')
+    auth_passwordreset_request_v1('apple@com.au')
+    assert mail.flush(5)
+    reset_code = users[user['auth_user_id']]['reset_code'][0]
+    assert f'Your four digit reset pin is: {reset_code}.' in handler.envelopes[0].content.decode()
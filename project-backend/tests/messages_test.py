@@ -6,7 +6,7 @@ from time import sleep
 from src.auth import auth_register_v1
 from src.channel import channel_messages_v1, channel_addowner_v1, channel_invite_v1
 from src.channels import channels_create_v1
-from src.dm import dm_create_v1, dm_messages_v1
+from src.dm import dm_create_v1, dm_messages_v1, dm_remove_v1
 from src.message import message_send_v1, message_edit_v1, \
                         message_remove_v1, message_share_v1, message_send_later_v1, \
                         message_pin_unpin_v1
@@ -337,6 +337,24 @@ def test_message_pin_unpin(setup):
 Tests for message_send_later_v1
 '''
 
+def test_removed_messages_no_longer_exist(setup):
+    m1 = message_send_v1(setup['sample_user1'], setup['private_channel'], 'one', True)
+    m2 = message_send_v1(setup['sample_user1'], setup['private_channel'], 'two', True)
+    m3 = message_send_v1(setup['sample_user1'], setup['dm1'], 'three', False)
+    message_remove_v1(setup['sample_user1'], m1)
+    message_edit_v1(setup['sample_user1'], m2, '')
+    dm_remove_v1(setup['sample_user1'], setup['dm1'])
+    for message_id in (m1, m2, m3):
+        with pytest.raises(InputError):
+            message_edit_v1(setup['sample_user1'], message_id, 'edited')
+
+    # Shared copies are messages of their own
+    m4 = message_send_v1(setup['sample_user1'], setup['public_channel'], 'four', True)
+    m5 = message_share_v1(setup['sample_user1'], m4, '', setup['private_channel'], -1)
+    message_edit_v1(setup['sample_user1'], m5, 'five')
+    assert channel_messages_v1(setup['sample_user1'], setup['public_channel'], 0)['messages'][0]['message'] == 'four'
+    assert channel_messages_v1(setup['sample_user1'], setup['private_channel'], 0)['messages'][0]['message'] == 'five'
+
 def test_message_send_past(setup):
     past_time = int(datetime.now().timestamp()) - 10
     
@@ -0,0 +1,183 @@
+'''
+Tests for the read/write contract of the server routes
+'''
+import os
+import json
+import threading
+import pytest
+from PIL import Image
+
+import src.data as db
+import src.server as server
+import src.user as user
+import src.metrics as metrics
+from src import config
+from src.auth import auth_register_v1, auth_logout_v1
+from src.channels import channels_create_v1
+from src.dm import dm_create_v1
+from src.other import clear_v1
+import src.helper as helper
+
+@pytest.fixture
+def setup(tmp_path, monkeypatch):
+    '''
+    Runs each test in an empty directory, persisting synchronously, with a
+    registered user in a channel and a client for the server.
+    '''
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(config, 'durability', 'sync')
+    clear_v1()
+    db.commit()
+    user = auth_register_v1('apple@com.au', 'password1', 'Steve', 'Jobs')
+    other = auth_register_v1('banana@com.au', 'password2', 'Steven', 'Jacobs')
+    channel_id = channels_create_v1(user['token'], 'channel1', True)
+    dm = dm_create_v1(user['token'], [other['auth_user_id']])
+    db.commit()
+    yield {
+        'user': user,
+        'ids': {
+            'u_id': user['auth_user_id'],
+            'channel_id': channel_id,
+            'dm_id': dm['dm_id'],
+        },
+        'client': server.APP.test_client(),
+    }
+    db.stop_flusher()
+
+# Every GET route taking a token, with the rest of its query; '{...}' fields
+# are filled in from the ids of the setup
+READ_ROUTES = [
+    ('/channel/details/v2', {'channel_id': '{channel_id}'}),
+    ('/channel/messages/v2', {'channel_id': '{channel_id}', 'start': '0'}),
+    ('/channels/list/v2', {}),
+    ('/channels/listall/v2', {}),
+    ('/dm/details/v1', {'dm_id': '{dm_id}'}),
+    ('/dm/list/v1', {}),
+    ('/dm/messages/v1', {'dm_id': '{dm_id}', 'start': '0'}),
+    ('/users/all/v1', {}),
+    ('/user/profile/v2', {'u_id': '{u_id}'}),
+    ('/user/stats/v1', {}),
+    ('/users/stats/v1', {}),
+    ('/search/v2', {'query_str': 'hello'}),
+    ('/standup/active/v1', {'channel_id': '{channel_id}'}),
+    ('/notifications/get/v1', {}),
+]
+
+@pytest.mark.parametrize('route, args', READ_ROUTES)
+def test_read_routes_do_not_persist(setup, monkeypatch, route, args):
+    monkeypatch.setattr(config, 'debug_routes', True)
+    commits = metrics.get_metrics().get('commits', 0)
+    query = {'token': setup['user']['token']}
+    query.update({arg: value.format(**setup['ids']) for arg, value in args.items()})
+    response = setup['client'].get(route, query_string=query)
+    assert response.status_code == 200
+    assert metrics.get_metrics().get('commits', 0) == commits
+
+def test_write_route_commits(setup):
+    commits = metrics.get_metrics().get('commits', 0)
+    response = setup['client'].post('/channels/create/v2', json={
+        'token': setup['user']['token'],
+        'name': 'channel2',
+        'is_public': True,
+    })
+    assert response.status_code == 200
+    assert metrics.get_metrics()['commits'] == commits + 1
+
+def test_bytes_written_per_request(setup, monkeypatch):
+    monkeypatch.setattr(config, 'durability', 'group')
+    metrics.reset()
+    for name in ('channel2', 'channel3'):
+        response = setup['client'].post('/channels/create/v2', json={
+            'token': setup['user']['token'],
+            'name': name,
+            'is_public': True,
+        })
+        assert response.status_code == 200
+    counted = metrics.get_metrics()
+    assert counted['write_requests'] == 2
+    assert counted['bytes_written'] > 0
+    assert counted['bytes_written_per_request'] == counted['bytes_written'] / 2
+
+def test_debug_catches_mutating_read(setup, monkeypatch):
+    def users_all_renaming(token):
+        db.users[setup['user']['auth_user_id']]['name_first'] = 'Changed'
+        return {'users': []}
+    monkeypatch.setattr(server, 'users_all_v1', users_all_renaming)
+    monkeypatch.setattr(config, 'debug_routes', True)
+    commits = metrics.get_metrics().get('commits', 0)
+    response = setup['client'].get('/users/all/v1', query_string={'token': setup['user']['token']})
+    assert response.status_code == 500
+    assert 'Read route /users/all/v1 changed the database' in json.loads(response.data)['message']
+    # The change was never persisted
+    assert metrics.get_metrics().get('commits', 0) == commits
+    for collection in db.COLLECTIONS.values():
+        collection.clear()
+    db.load_db()
+    assert db.users[setup['user']['auth_user_id']]['name_first'] == 'Steve'
+
+def test_token_verified_once_per_request(setup, monkeypatch):
+    monkeypatch.setattr(config, 'token_cache_size', 0)
+    helper.token_cache.clear()
+    decodes = []
+    decode = helper.jwt.decode
+    def counting_decode(*args, **kwargs):
+        decodes.append(args[0])
+        return decode(*args, **kwargs)
+    monkeypatch.setattr(helper.jwt, 'decode', counting_decode)
+    channel_id = json.loads(setup['client'].post('/channels/create/v2', json={
+        'token': setup['user']['token'],
+        'name': 'channel2',
+        'is_public': True,
+    }).data)['channel_id']
+    response = setup['client'].post('/message/send/v2', json={
+        'token': setup['user']['token'],
+        'channel_id': channel_id,
+        'message': 'hello',
+    })
+    assert response.status_code == 200
+    assert len(decodes) == 2
+    assert helper.request_auth.get() is None
+
+def test_photo_download_lets_go_of_lock(setup, monkeypatch):
+    os.makedirs('src/static')
+    lock_free = []
+    def other_request():
+        lock_free.append(db.lock.acquire(timeout=5))
+        if lock_free[-1]:
+            db.lock.release()
+    def fake_download(url, path):
+        # Another request can take the lock while the photo downloads
+        other = threading.Thread(target=other_request)
+        other.start()
+        other.join()
+        Image.new('RGB', (10, 10)).save(path, 'JPEG')
+    monkeypatch.setattr(user.urllib.request, 'urlretrieve', fake_download)
+    response = setup['client'].post('/user/profile/uploadphoto/v1', json={
+        'token': setup['user']['token'],
+        'img_url': 'http://example.com/photo.jpg',
+        'x_start': 0, 'y_start': 0, 'x_end': 5, 'y_end': 5,
+    })
+    assert response.status_code == 200
+    assert lock_free == [True]
+    assert db.users[setup['user']['auth_user_id']]['profile_img_url'].endswith('.jpg')
+
+def test_photo_upload_after_logout_is_rejected(setup, monkeypatch):
+    os.makedirs('src/static')
+    photo = db.users[setup['user']['auth_user_id']]['profile_img_url']
+    def logout():
+        with db.lock:
+            auth_logout_v1(setup['user']['token'])
+    def fake_download(url, path):
+        # The user logs out while the photo downloads
+        other = threading.Thread(target=logout)
+        other.start()
+        other.join()
+        Image.new('RGB', (10, 10)).save(path, 'JPEG')
+    monkeypatch.setattr(user.urllib.request, 'urlretrieve', fake_download)
+    response = setup['client'].post('/user/profile/uploadphoto/v1', json={
+        'token': setup['user']['token'],
+        'img_url': 'http://example.com/photo.jpg',
+        'x_start': 0, 'y_start': 0, 'x_end': 5, 'y_end': 5,
+    })
+    assert response.status_code == 403
+    assert db.users[setup['user']['auth_user_id']]['profile_img_url'] == photo
@@ -0,0 +1,32 @@
+'''
+Tests for the snowflake id generator
+'''
+import threading
+from time import time
+
+import src.snowflake as snowflake
+from src import config
+
+def test_ids_increase_and_carry_time_and_node(monkeypatch):
+    monkeypatch.setattr(config, 'node_id', 5)
+    ids = [snowflake.next_id() for _ in range(10000)]
+    assert all(earlier < later for earlier, later in zip(ids, ids[1:]))
+    assert abs(snowflake.timestamp(ids[-1]) - time()) < 5
+    assert snowflake.node(ids[0]) == 5
+
+def test_ids_unique_across_threads():
+    made = [[] for _ in range(8)]
+    def make(ids):
+        for _ in range(5000):
+            ids.append(snowflake.next_id())
+    threads = [threading.Thread(target=make, args=[ids]) for ids in made]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len({snowflake_id for ids in made for snowflake_id in ids}) == 8 * 5000
+    for ids in made:
+        assert ids == sorted(ids)
+
+def test_ids_sort_after_legacy_ids():
+    assert snowflake.next_id() > int(time() * 10000000)
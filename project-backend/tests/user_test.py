@@ -287,4 +287,16 @@ def test_users_stats_lone_user():
 
     assert users_stats_v1(test_user1['token']).get('dreams_stats') == answer
 
-clear_v1()
\ No newline at end of file
+clear_v1()
+#test that the old email is freed up and the new one taken
+def test_user_profile_setemail_v2_login():
+    
+    clear_v1()
+    
+    test_user = generate_user()
+    user_profile_setemail_v2(test_user['token'], "testEmail@email.com")
+    
+    assert auth_login_v1("testemail@email.com", "password")['auth_user_id'] == test_user['auth_user_id']
+    with pytest.raises(InputError):
+        auth_login_v1("validEmail@email.com", "password")
+    auth_register_v1("validEmail@email.com", "password", "Hayden", "James")